@@ -3,10 +3,28 @@ import numpy as np
 import matplotlib.pyplot as plt
 import cv2
 from scipy.stats import zscore
+from scipy.sparse import csr_matrix
 import os
+import time
+import hashlib
+import pickle as pkl
+from joblib import Parallel, delayed
 from tqdm import tqdm
 from CaImaging import util
 from CaImaging.Behavior import spatial_bin
+from CaImaging.PlaceFields import PlaceFields
+from CircleTrack.utils import (
+    iter_video_frames,
+    position_indicator,
+    bin_activity,
+    spatial_bin_index,
+)
+from util import write_atomic
+
+# Version of the spatial information test stored in AssemblyFields.pkl.
+# Files without it (made by PlaceFields(shuffle_test=True)) are rebuilt,
+# so z-scores and p-values from both tests are never mixed.
+assembly_fields_version = 2
 
 
 def plot_assembly(
@@ -92,14 +110,335 @@ def plot_assembly(
     return activation_ax, spikes_ax
 
 
-def write_assembly_triggered_movie(
-    activation,
-    frame_numbers,
-    behavior_movie,
-    fpath=None,
-    threshold=2.58,
-    trials=None,
+def circular_shift_null(zactmat, shifts):
+    """
+    Largest eigenvalue of the covariance matrix of circularly shifted
+    copies of the data, one per row of shifts.
+
+    :parameters
+    ---
+    zactmat: (neuron, frame) array
+        z-scored activity.
+
+    shifts: (shuffle, neuron) array of ints
+        Shift of each neuron in each surrogate.
+
+    :return
+    ---
+    lambda_max: (shuffle,) array
+    """
+    n_neurons, n_frames = zactmat.shape
+    frames = np.arange(n_frames)
+    neurons = np.arange(n_neurons)[:, np.newaxis]
+
+    lambda_max = np.zeros(len(shifts))
+    for i, shift in enumerate(shifts):
+        surrogate = zactmat[neurons, (frames - shift[:, np.newaxis]) % n_frames]
+        surrogate = surrogate - surrogate.mean(axis=1, keepdims=True)
+        covariance = surrogate @ surrogate.T / (n_frames - 1)
+        lambda_max[i] = np.linalg.eigvalsh(covariance)[-1]
+
+    return lambda_max
+
+
+def null_cache_key(zactmat, n_shuffles=500, percentile=99, seed=0, smoothing=None):
+    """
+    Key of a null threshold in a cache file (see null_threshold()).
+
+    """
+    n_neurons, n_frames = zactmat.shape
+    data_hash = hashlib.sha1(np.ascontiguousarray(zactmat).tobytes()).hexdigest()
+
+    return n_neurons, n_frames, smoothing, seed, n_shuffles, percentile, data_hash
+
+
+def read_null_cache(cache_path):
+    if cache_path is None or not os.path.exists(cache_path):
+        return dict()
+
+    with open(cache_path, "rb") as file:
+        return pkl.load(file)
+
+
+def write_null_cache(cache_path, cache):
+    def write(tmp_path):
+        with open(tmp_path, "wb") as file:
+            pkl.dump(cache, file)
+
+    write_atomic(cache_path, write)
+
+
+def null_shift_batches(n_neurons, n_frames, n_shuffles=500, seed=0, batch_size=25):
+    """
+    Seeded circular shifts for the null, split into batches.
+
+    :return
+    ---
+    batches: list of (shuffle, neuron) arrays
+    """
+    # Same range of shifts as the original circular shuffling.
+    shifts = np.random.RandomState(seed).randint(
+        n_frames * 2, size=(n_shuffles, n_neurons)
+    )
+
+    return np.array_split(shifts, max(1, int(np.ceil(n_shuffles / batch_size))))
+
+
+def null_threshold(
+    zactmat,
+    n_shuffles=500,
+    percentile=99,
+    seed=0,
+    smoothing=None,
+    n_jobs=-1,
+    batch_size=25,
+    cache_path=None,
 ):
+    """
+    Eigenvalue threshold for significant assemblies from a circular
+    shift null: each neuron's activity is shifted by a random amount,
+    and the given percentile of the surrogates' largest covariance
+    eigenvalues is taken. Surrogates are drawn with a seeded RNG up
+    front and evaluated in batches in parallel, so the result does
+    not depend on n_jobs or batch_size.
+
+    :parameters
+    ---
+    zactmat: (neuron, frame) array
+        z-scored activity without silent neurons.
+
+    n_shuffles: int
+        Number of surrogates.
+
+    percentile: float
+        Percentile of the null distribution to use as the threshold.
+
+    seed: int
+        Seed for the shifts.
+
+    smoothing: float or None
+        Smoothing applied to the data before detection. Only used to
+        identify cached thresholds.
+
+    n_jobs: int
+        Number of processes.
+
+    batch_size: int
+        Surrogates per task.
+
+    cache_path: str or None
+        Pickle file of thresholds keyed on the data and parameters.
+        If None, nothing is cached.
+
+    :return
+    ---
+    lambda_max: float
+    """
+    return null_thresholds(
+        [zactmat],
+        n_shuffles=n_shuffles,
+        percentile=percentile,
+        seed=seed,
+        smoothing=smoothing,
+        n_jobs=n_jobs,
+        batch_size=batch_size,
+        cache_paths=[cache_path],
+    )[0]
+
+
+def null_thresholds(
+    zactmats,
+    n_shuffles=500,
+    percentile=99,
+    seed=0,
+    smoothing=None,
+    n_jobs=-1,
+    batch_size=25,
+    cache_paths=None,
+):
+    """
+    null_threshold() for many datasets, with the shuffle batches of
+    every dataset that is not cached yet evaluated in one process pool.
+
+    :parameters
+    ---
+    zactmats: list of (neuron, frame) arrays
+        z-scored activity without silent neurons.
+
+    cache_paths: list of str or None, or None
+        Cache file of each dataset. Datasets can share a file.
+
+    n_shuffles, percentile, seed, smoothing, n_jobs, batch_size:
+        See null_threshold().
+
+    :return
+    ---
+    lambda_max: list of floats
+    """
+    if cache_paths is None:
+        cache_paths = [None] * len(zactmats)
+    keys = [
+        null_cache_key(zactmat, n_shuffles, percentile, seed, smoothing)
+        for zactmat in zactmats
+    ]
+    caches = {cache_path: read_null_cache(cache_path) for cache_path in set(cache_paths)}
+    thresholds = [
+        caches[cache_path].get(key) for cache_path, key in zip(cache_paths, keys)
+    ]
+
+    uncached = [i for i, threshold in enumerate(thresholds) if threshold is None]
+    jobs = [
+        (i, batch)
+        for i in uncached
+        for batch in null_shift_batches(
+            *zactmats[i].shape, n_shuffles, seed, batch_size
+        )
+    ]
+    nulls = Parallel(n_jobs=n_jobs)(
+        delayed(circular_shift_null)(zactmats[i], batch) for i, batch in jobs
+    )
+    for i in uncached:
+        lambda_max = np.concatenate(
+            [null for (j, _), null in zip(jobs, nulls) if j == i]
+        )
+        thresholds[i] = np.percentile(lambda_max, percentile)
+        caches[cache_paths[i]][keys[i]] = thresholds[i]
+
+    # Written here rather than in the workers so that no entries are lost.
+    for cache_path in {cache_paths[i] for i in uncached} - {None}:
+        write_null_cache(cache_path, caches[cache_path])
+
+    return thresholds
+
+
+def zscore_active(data):
+    """
+    z-score the neurons that are not silent, as used for assembly detection.
+
+    :return
+    ---
+    actmat: (active neuron, frame) array
+
+    silent_neurons: (neuron,) boolean array
+    """
+    silent_neurons = np.var(data, axis=1) == 0
+
+    return zscore(data[~silent_neurons], axis=1), silent_neurons
+
+
+def compute_assembly_activity(patterns, zactmat):
+    """
+    Activation strength of each assembly in each frame: the projection
+    of the activity onto the pattern's outer product, without its
+    diagonal.
+
+    """
+    activations = np.zeros((len(patterns), zactmat.shape[1]))
+    for i, pattern in enumerate(patterns):
+        projection = zactmat.T @ pattern
+        activations[i] = projection ** 2 - (zactmat.T ** 2) @ (pattern ** 2)
+
+    return activations
+
+
+def detect_assemblies(
+    data,
+    n_shuffles=500,
+    percentile=99,
+    seed=0,
+    smoothing=None,
+    n_jobs=-1,
+    cache_path=None,
+    lambda_max=None,
+):
+    """
+    Find assemblies with PCA/ICA like CaImaging.Assemblies.find_assemblies
+    with nullhyp="circ", but computing the circular shift null in
+    parallel with a seeded RNG and caching its threshold (see
+    null_threshold()).
+
+    :parameters
+    ---
+    data: (neuron, frame) array
+        Preprocessed activity, e.g., from preprocess_multiple_sessions().
+
+    n_shuffles, percentile, seed, smoothing, n_jobs, cache_path:
+        See null_threshold().
+
+    lambda_max: float or None
+        Null threshold, if it was already computed (e.g., for many
+        datasets in one process pool). If None, it is computed here.
+
+    :return
+    ---
+    assemblies: dict
+        patterns: (assembly, neuron) array.
+        significance: fitted sklearn PCA with nneurons, nbins, nshu,
+            percentile, tracywidom, nullhyp and nassemblies.
+        z_data: (neuron, frame) z-scored activity.
+        orig_data: data.
+        activations: (assembly, frame) array.
+    """
+    from sklearn.decomposition import PCA, FastICA
+
+    n_neurons, n_frames = data.shape
+    actmat, silent_neurons = zscore_active(data)
+
+    significance = PCA()
+    significance.fit(actmat.T)
+    significance.nneurons = n_neurons
+    significance.nbins = n_frames
+    significance.nshu = n_shuffles
+    significance.percentile = percentile
+    significance.tracywidom = False
+    significance.nullhyp = "circ"
+
+    if lambda_max is None:
+        lambda_max = null_threshold(
+            actmat,
+            n_shuffles=n_shuffles,
+            percentile=percentile,
+            seed=seed,
+            smoothing=smoothing,
+            n_jobs=n_jobs,
+            cache_path=cache_path,
+        )
+    significance.nassemblies = int(np.sum(significance.explained_variance_ > lambda_max))
+
+    z_data = np.array(data, dtype=float)
+    z_data[~silent_neurons] = actmat
+    patterns = np.zeros((significance.nassemblies, n_neurons))
+    if significance.nassemblies < 1:
+        print("WARNING! No assembly detected!")
+    else:
+        ica = FastICA(n_components=significance.nassemblies, random_state=seed)
+        ica.fit(actmat.T)
+        patterns_ = ica.components_
+        patterns[:, ~silent_neurons] = (
+            patterns_ / np.linalg.norm(patterns_, axis=1, keepdims=True)
+        )
+
+    return {
+        "patterns": patterns,
+        "significance": significance,
+        "z_data": z_data,
+        "orig_data": data,
+        "activations": compute_assembly_activity(patterns, z_data),
+    }
+
+
+def assembly_movie_plan(activation, frame_numbers, threshold=2.58, trials=None):
+    """
+    Behavior frames to write for one assembly's triggered movie: the
+    frames where its activation is above threshold, in clusters, each
+    followed by a title card.
+
+    :return
+    ---
+    plan: list of (frames, title) tuples
+        frames: array of behavior frame numbers.
+        title: tuple of strs, the lines of the title card.
+    """
     z_activation = zscore(activation)
     inds = np.where(z_activation > threshold)[0]
     above_threshold_frames = frame_numbers[inds]
@@ -107,87 +446,178 @@ def write_assembly_triggered_movie(
     grouped_frames = util.cluster(above_threshold_frames, 30)
     grouped_inds = util.cluster(inds, 30)
 
-    compressionCodec = "XVID"
-    codec = cv2.VideoWriter_fourcc(*compressionCodec)
-    cap = cv2.VideoCapture(behavior_movie)
-    ret, frame = cap.read()
-    rows, cols = int(cap.get(4)), int(cap.get(3))
-
-    if fpath is None:
-        folder = os.path.split(behavior_movie)[0]
-        fpath = os.path.join(folder, "Assembly activity.avi")
-
-    writeFile = cv2.VideoWriter(fpath, codec, 15, (cols, rows), isColor=True)
-    print(f"Writing {fpath}")
+    plan = []
     for i, (chunked_frames, chunked_inds) in enumerate(
         zip(grouped_frames, grouped_inds)
     ):
-        for frame_number in chunked_frames:
-            cap.set(1, frame_number)
-            ret, frame = cap.read()
-            writeFile.write(frame)
+        title = [f"Activation #{i}"]
+        if trials is not None:
+            title.append(f"Lap # {trials[chunked_inds[0]]}")
+        plan.append((np.asarray(chunked_frames, dtype=int), tuple(title)))
+
+    return plan
 
-        blank_frame = np.zeros_like(frame)
-        text = f"Activation #{i}"
 
+def title_card(title, shape):
+    blank_frame = np.zeros(shape, dtype=np.uint8)
+    for line, text in enumerate(title):
         cv2.putText(
-            blank_frame, text, (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2
+            blank_frame,
+            text,
+            (50, 50 * (line + 1)),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            1,
+            (255, 255, 255),
+            2,
         )
 
-        if trials is not None:
-            trial_text = f"Lap # {trials[chunked_inds[0]]}"
-            cv2.putText(
-                blank_frame,
-                trial_text,
-                (50, 100),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                1,
-                (255, 255, 255),
-                2,
-            )
+    return blank_frame
 
-        for i in range(15):
-            writeFile.write(blank_frame)
 
-    writeFile.release()
+def write_assembly_triggered_movies(
+    activations,
+    frame_numbers,
+    behavior_movie,
+    fpaths,
+    threshold=2.58,
+    trials=None,
+):
+    """
+    Write assembly-triggered movies for several assemblies while
+    decoding the behavior video only once, in frame order. Each decoded
+    frame is written to every movie that needs it. Title cards are
+    rendered once and reused.
+
+    :parameters
+    ---
+    activations: (assembly, frame) array
+        Activation profiles of the assemblies to write.
+
+    frame_numbers: array
+        Behavior frame number for each imaging frame (nondecreasing).
+
+    behavior_movie: str
+        Path to the behavior video.
+
+    fpaths: list of strs
+        Output path for each assembly.
+
+    threshold: float
+        z-scored activation above which frames are written.
+
+    trials: array or None
+        Lap number for each imaging frame, printed on the title cards.
+    """
+    plans = [
+        assembly_movie_plan(activation, frame_numbers, threshold=threshold, trials=trials)
+        for activation in activations
+    ]
+
+    # Each movie is a queue of frame numbers and title cards, in order.
+    queues = []
+    for plan in plans:
+        queue = []
+        for frames, title in plan:
+            queue.extend(frames)
+            queue.append(title)
+        queue_frames = [item for item in queue if not isinstance(item, tuple)]
+        if np.any(np.diff(queue_frames) < 0):
+            raise ValueError("Behavior frame numbers must be nondecreasing.")
+        queues.append(queue)
+
+    cap = cv2.VideoCapture(behavior_movie)
+    rows, cols = int(cap.get(4)), int(cap.get(3))
+    codec = cv2.VideoWriter_fourcc(*"XVID")
+    writers = []
+    for fpath in fpaths:
+        print(f"Writing {fpath}")
+        writers.append(cv2.VideoWriter(fpath, codec, 15, (cols, rows), isColor=True))
+
+    title_cards = dict()
+    positions = [0] * len(queues)
+
+    def advance(movie, frame_number=None, frame=None):
+        # Write the title cards and copies of frame_number that are
+        # next in line for this movie.
+        queue = queues[movie]
+        while positions[movie] < len(queue):
+            item = queue[positions[movie]]
+            if isinstance(item, tuple):
+                if item not in title_cards:
+                    title_cards[item] = title_card(item, (rows, cols, 3))
+                for _ in range(15):
+                    writers[movie].write(title_cards[item])
+            elif item == frame_number:
+                if frame is not None:
+                    writers[movie].write(frame)
+            else:
+                break
+            positions[movie] += 1
+
+    needed_frames = np.unique(
+        np.concatenate([[-1]] + [frames for plan in plans for frames, _ in plan])
+    )[1:]
+    for movie in range(len(queues)):
+        advance(movie)
+    for frame_number, frame in tqdm(
+        iter_video_frames(cap, needed_frames), total=len(needed_frames)
+    ):
+        for movie in range(len(queues)):
+            advance(movie, frame_number, frame)
+
+    for writer in writers:
+        writer.release()
     cap.release()
 
 
-def find_members(patterns, filter_method="sd", thresh=2):
+def write_assembly_triggered_movie(
+    activation,
+    frame_numbers,
+    behavior_movie,
+    fpath=None,
+    threshold=2.58,
+    trials=None,
+):
+    if fpath is None:
+        folder = os.path.split(behavior_movie)[0]
+        fpath = os.path.join(folder, "Assembly activity.avi")
+
+    write_assembly_triggered_movies(
+        [activation],
+        frame_numbers,
+        behavior_movie,
+        [fpath],
+        threshold=threshold,
+        trials=trials,
+    )
+
+
+def membership_matrix(patterns, filter_method="sd", thresh=2):
     """
-    Find the members of an ensemble defined by high weights exceeding some threshold.
+    Boolean membership matrix of ensembles. See find_members().
 
     :parameters
     ---
     patterns: (assembly, neuron) array
         Patterns to find members from.
 
-    filter_method: str ('sd' or 'z')
-        Determines the method for finding members. If 'sd', looks for neurons above x standard deviations above or below
-        the mean, determined by thresh.
-
-    thresh: float
-        Threshold for calling a neuron an ensemble member. If filter_method is 'sd', denotes the number of standard
-        deviations above or below the mean. If filter method is 'z', denotes the z-score (positive or negative).
-
     :return
     ---
+    bool_members: (assembly, neuron) boolean array
+        Whether each neuron is a member of each ensemble.
 
+    signs: (assembly,) array
+        1 where the members of an ensemble are its negative weights.
     """
-    if patterns.ndim == 1:
-        patterns = patterns[np.newaxis, :]
-    n_patterns, n_neurons = patterns.shape
-
-    member_candidates = np.zeros((2, *patterns.shape))
     if filter_method == "sd":
         # Take the mean and standard deviation to find high neuron weights.
-        pattern_mean = np.mean(patterns, axis=1)
-        pattern_stds = np.std(patterns, axis=1)
-        member_candidates[0] = (
-            patterns > np.tile(pattern_mean + thresh * pattern_stds, (n_neurons, 1)).T
-        )
-        member_candidates[1] = (
-            patterns < np.tile(pattern_mean - thresh * pattern_stds, (n_neurons, 1)).T
+        pattern_mean = np.mean(patterns, axis=1, keepdims=True)
+        pattern_stds = np.std(patterns, axis=1, keepdims=True)
+        member_candidates = np.stack(
+            (
+                patterns > pattern_mean + thresh * pattern_stds,
+                patterns < pattern_mean - thresh * pattern_stds,
+            )
         )
 
         # Determine if the weight vectors have negative or positive values for ensemble members.
@@ -196,18 +626,7 @@ def find_members(patterns, filter_method="sd", thresh=2):
         signs = np.argmax(np.sum(member_candidates, axis=2), axis=0)
 
         # For each assembly, select the positive or negative signed weights.
-        bool_members = np.zeros_like(patterns)
-        corrected_patterns = patterns.copy()
-        for assembly_i, assembly_sign in enumerate(signs):
-            bool_members[assembly_i] = member_candidates[assembly_sign, assembly_i]
-
-            # assembly_sign == 1 means the negative weights contain highly-contributing neurons.
-            # In this case, negate the pattern and store it.
-            if assembly_sign == 1:
-                corrected_patterns[assembly_i] = -corrected_patterns[assembly_i]
-
-        # For each ensemble, get the index of bool_members.
-        member_idx_ = [np.where(members)[0] for members in bool_members]
+        bool_members = member_candidates[signs, np.arange(len(signs))]
 
     elif filter_method == "z":
         raise ValueError("z method not done yet")
@@ -217,12 +636,54 @@ def find_members(patterns, filter_method="sd", thresh=2):
     else:
         raise ValueError("Unaccepted filter_method.")
 
+    return bool_members, signs
+
+
+def find_members(patterns, filter_method="sd", thresh=2):
+    """
+    Find the members of an ensemble defined by high weights exceeding some threshold.
+
+    :parameters
+    ---
+    patterns: (assembly, neuron) array
+        Patterns to find members from.
+
+    filter_method: str ('sd' or 'z')
+        Determines the method for finding members. If 'sd', looks for neurons above x standard deviations above or below
+        the mean, determined by thresh.
+
+    thresh: float
+        Threshold for calling a neuron an ensemble member. If filter_method is 'sd', denotes the number of standard
+        deviations above or below the mean. If filter method is 'z', denotes the z-score (positive or negative).
+
+    :return
+    ---
+    bool_members: (assembly, neuron) boolean array
+        Whether each neuron is a member of each ensemble.
+
+    member_idx: list of arrays (or an array if there is one pattern)
+        Members of each ensemble, sorted by increasing weight.
+
+    corrected_patterns: (assembly, neuron) array
+        Patterns with members' weights made positive, each sorted.
+    """
+    if patterns.ndim == 1:
+        patterns = patterns[np.newaxis, :]
+    n_patterns, n_neurons = patterns.shape
+
+    bool_members, signs = membership_matrix(
+        patterns, filter_method=filter_method, thresh=thresh
+    )
+
+    # signs == 1 means the negative weights contain highly-contributing neurons.
+    # In this case, negate the pattern.
+    corrected_patterns = np.where(signs[:, np.newaxis] == 1, -patterns, patterns)
+
     # Sort neurons by their weight.
-    member_idx = []
     sort_orders = np.argsort(corrected_patterns, axis=1)
-    for i, order in enumerate(sort_orders):
-        corrected_patterns[i] = corrected_patterns[i, order]
-        member_idx.append([neuron for neuron in order if neuron in member_idx_[i]])
+    corrected_patterns = np.take_along_axis(corrected_patterns, sort_orders, axis=1)
+    sorted_members = np.take_along_axis(bool_members, sort_orders, axis=1)
+    member_idx = [order[members] for order, members in zip(sort_orders, sorted_members)]
 
     # If there was only one pattern in the input, just take the first row/list entry.
     if n_patterns == 1:
@@ -232,6 +693,16 @@ def find_members(patterns, filter_method="sd", thresh=2):
     return bool_members, member_idx, corrected_patterns
 
 
+def inverse_memberships(bool_members):
+    """
+    Ensembles that each neuron belongs to, as a sparse
+    (neuron, assembly) matrix. For neuron n, the ensembles are
+    indices[indptr[n]:indptr[n + 1]].
+
+    """
+    return csr_matrix(np.atleast_2d(bool_members).T)
+
+
 def find_memberships(patterns, filter_method="sd", thresh=2):
     """
     Rather than finding the members for each ensemble, do the inverse -- find which ensemble each neuron belongs to.
@@ -241,18 +712,17 @@ def find_memberships(patterns, filter_method="sd", thresh=2):
     :param thresh:
     :return:
     """
-    member_list = find_members(patterns, filter_method=filter_method, thresh=thresh)[1]
-
-    memberships = []
-    n_neurons = patterns.shape[1]
-
-    for neuron in range(n_neurons):
-        memberships.append([])
-        for i, ensemble in enumerate(member_list):
-            if neuron in ensemble:
-                memberships[neuron].append(i)
+    if patterns.ndim == 1:
+        patterns = patterns[np.newaxis, :]
+    bool_members = membership_matrix(
+        patterns, filter_method=filter_method, thresh=thresh
+    )[0]
+    memberships = inverse_memberships(bool_members)
 
-    return memberships
+    return [
+        memberships.indices[start:stop].tolist()
+        for start, stop in zip(memberships.indptr[:-1], memberships.indptr[1:])
+    ]
 
 
 def spatial_bin_ensemble_activations(
@@ -264,24 +734,166 @@ def spatial_bin_ensemble_activations(
 ):
 
     # Bin all the assembly activations in space.
-    ensemble_fields = []
     if do_zscore:
         activations = zscore(activations, axis=1)
-    for assembly in activations:
-        assembly_field = spatial_bin(
-            lin_position,
-            np.zeros_like(lin_position),
-            bin_size_cm=spatial_bin_size_radians,
-            show_plot=False,
-            weights=assembly,
-            one_dim=True,
-        )[0]
-        ensemble_fields.append(assembly_field / occupancy_normalization)
-    ensemble_fields = np.vstack(ensemble_fields)
+    bin_edges = spatial_bin(
+        lin_position,
+        np.zeros_like(lin_position),
+        bin_size_cm=spatial_bin_size_radians,
+        show_plot=False,
+        one_dim=True,
+    )[1]
+    indicator = position_indicator(lin_position, bin_edges)
+    ensemble_fields = bin_activity(activations, indicator) / occupancy_normalization
 
     return ensemble_fields
 
 
+def spatial_information(fields, occupancy):
+    """
+    Skaggs spatial information of many units at once.
+
+    :parameters
+    ---
+    fields: (..., bin) array
+        Occupancy-normalized activity in each spatial bin.
+
+    occupancy: (bin,) array
+        Time spent in each bin.
+
+    :return
+    ---
+    SI: (...) array
+    """
+    p = occupancy / np.sum(occupancy)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_rate = np.nansum(fields * p, axis=-1, keepdims=True)
+        ratio = fields / mean_rate
+        SI = np.nansum(p * ratio * np.log2(ratio), axis=-1)
+
+    return SI
+
+
+def spatial_shuffle_test(
+    activations, lin_position, bin_edges, n_shuffles=500, seed=0, mask=None
+):
+    """
+    Spatial information of each unit compared with a null where the
+    activity is circularly shifted relative to position. All units are
+    binned together for each shift.
+
+    :parameters
+    ---
+    activations: (unit, frame) array
+
+    lin_position: (frame,) array
+
+    bin_edges: array
+        Spatial bin edges.
+
+    mask: (frame,) boolean array or None
+        Frames to bin (e.g., running). Masked frames shift along with
+        position, so the activity is shifted relative to both.
+
+    n_shuffles: int
+        Number of circular shifts.
+
+    seed: int
+        Seed for the shifts.
+
+    :return
+    ---
+    SI: (unit,) array
+
+    SI_z: (unit,) array
+        z-score of SI relative to the shuffles.
+
+    pvals: (unit,) array
+        Proportion of shuffles with SI at least as large.
+    """
+    activations = np.atleast_2d(activations).astype(float)
+    n_units, n_frames = activations.shape
+    n_bins = len(bin_edges) - 1
+
+    # Frames outside the bins or the mask go to an extra bin that is dropped.
+    bins = spatial_bin_index(lin_position, bin_edges)
+    bins[bins < 0] = n_bins
+    if mask is not None:
+        bins[~np.asarray(mask, dtype=bool)] = n_bins
+    occupancy = np.bincount(bins, minlength=n_bins + 1)[:n_bins]
+    units = np.arange(n_units)[:, np.newaxis] * (n_bins + 1)
+
+    def shifted_fields(shift):
+        # Shifting the activity forward is the same as shifting the bin
+        # of each frame backward.
+        index = (units + np.roll(bins, -shift)).ravel()
+        binned = np.bincount(
+            index, weights=activations.ravel(), minlength=n_units * (n_bins + 1)
+        ).reshape(n_units, n_bins + 1)[:, :n_bins]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return binned / occupancy
+
+    SI = spatial_information(shifted_fields(0), occupancy)
+    shifts = np.random.RandomState(seed).randint(n_frames, size=n_shuffles)
+    shuffled_SIs = np.vstack(
+        [spatial_information(shifted_fields(shift), occupancy) for shift in shifts]
+    )
+
+    SI_z = (SI - np.mean(shuffled_SIs, axis=0)) / np.std(shuffled_SIs, axis=0)
+    pvals = np.sum(shuffled_SIs >= SI, axis=0) / n_shuffles
+
+    return SI, SI_z, pvals
+
+
+def make_assembly_fields(t, x, y, activations, bin_size, fps, n_shuffles=500, seed=0):
+    """
+    PlaceFields of assembly activations with the spatial information
+    shuffle test done by spatial_shuffle_test(), on the position, bins
+    and running frames of the PlaceFields object itself.
+
+    :return
+    ---
+    fields: PlaceFields
+        With data["spatial_info_z"] and data["spatial_info_pvals"], and
+        meta["version"] set to assembly_fields_version.
+    """
+    fields = PlaceFields(
+        t,
+        x,
+        y,
+        activations,
+        bin_size=bin_size,
+        circular=True,
+        shuffle_test=False,
+        fps=fps,
+        velocity_threshold=0,
+    )
+
+    _, SI_z, pvals = spatial_shuffle_test(
+        activations,
+        fields.data["x"],
+        fields.data["occupancy_bins"],
+        n_shuffles=n_shuffles,
+        seed=seed,
+        mask=fields.data["running"],
+    )
+    fields.data["spatial_info_z"] = SI_z
+    fields.data["spatial_info_pvals"] = pvals
+    fields.meta["n_shuffles"] = n_shuffles
+    fields.meta["version"] = assembly_fields_version
+
+    return fields
+
+
+def try_make_assembly_fields(*args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return make_assembly_fields(*args, **kwargs), None, time.perf_counter() - start
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}", time.perf_counter() - start
+
+
 def plot_pattern(
     pattern, ax=None, color="k", alpha=1, linewidth=0.5, markersize=5, order=None
 ):
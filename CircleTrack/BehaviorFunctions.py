@@ -1,7 +1,8 @@
 import os
+import time
+from pathlib import Path
 import numpy as np
 import pandas as pd
-from matplotlib.animation import FFMpegWriter
 from CaImaging.LickArduino import clean_Arduino_output
 from CaImaging.util import (
     find_closest,
@@ -18,21 +19,141 @@ from CaImaging.Behavior import read_eztrack, convert_dlc_to_eztrack
 from scipy.stats import zscore, norm
 from scipy.signal import savgol_filter
 import matplotlib.pyplot as plt
+from matplotlib.colors import to_rgb
 import cv2
+from joblib import Parallel, delayed, effective_n_jobs
 
 from numpy.lib.stride_tricks import sliding_window_view
 
 from CircleTrack.plotting import spiral_plot, highlight_column
-from CircleTrack.utils import circle_sizes
-from util import grab_paths, Session_Metadata, find_timestamp_file
-import tkinter as tk
-
-tkroot = tk.Tk()
-tkroot.withdraw()
-from tkinter import filedialog
+from CircleTrack.utils import (
+    circle_sizes,
+    iter_video_frames,
+    iter_frame_batches,
+    background_image,
+    concat_videos,
+)
+from CircleTrack.Instrumentation import stage
+from CircleTrack.BehaviorStore import (
+    cast_behavior_df,
+    get_store_path,
+    read_behavior,
+    write_behavior,
+    store_version,
+)
+from CircleTrack.sql import log_artifact
+from util import grab_paths, Session_Metadata, find_timestamp_file, ask_directory
 from scipy.ndimage import gaussian_filter1d
 from skimage.feature import blob_doh
 
+# Colors that the cursor will flash for licking each port.
+port_colors = [
+    "saddlebrown",
+    "red",
+    "orange",
+    "yellow",
+    "green",
+    "blue",
+    "darkviolet",
+    "gray",
+]
+
+
+def draw_tracking_frame(frame, frame_number, x, y, lick_port=-1, fps=15):
+    """
+    Draw the position cursor, frame/time label, and lick indicator onto
+    a behavior video frame in place.
+
+    :parameters
+    ---
+    frame: (h, w, 3) BGR array
+        Video frame.
+
+    frame_number: int
+        Frame number, for the label.
+
+    x, y: float
+        Position of the mouse in pixels.
+
+    lick_port: int
+        Port being licked, -1 if none.
+
+    fps: int
+        Sampling rate, for the time label.
+    """
+    label = f"Frame: {frame_number}   Time: {np.round(frame_number / fps, 1)} s"
+    cv2.putText(frame, label, (2, 14), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 0, 0), 1)
+
+    if np.isnan(x) or np.isnan(y):
+        return frame
+
+    position = (int(round(x)), int(round(y)))
+    cv2.drawMarker(frame, position, (255, 255, 255), cv2.MARKER_CROSS, 10, 1)
+
+    if lick_port >= 0:
+        r, g, b = to_rgb(port_colors[lick_port])
+        color = (int(b * 255), int(g * 255), int(r * 255))
+        cv2.drawMarker(frame, position, color, cv2.MARKER_CROSS, 20, 2)
+
+    return frame
+
+
+def write_tracking_chunk(
+    vid_path, output_path, frames, x, y, lick_port=None, fps=15, codec="XVID"
+):
+    """
+    Write the tracking overlay for a list of frames to one video file,
+    reading the behavior video sequentially.
+
+    :parameters
+    ---
+    vid_path: str
+        Behavior video.
+
+    output_path: str
+        Video to write.
+
+    frames: array-like of ints
+        Frame numbers to write.
+
+    x, y: arrays
+        Position for every frame of the behavior video.
+
+    lick_port: array or None
+        Port licked on every frame, or None to skip lick indicators.
+
+    fps: int
+        Sampling rate of the behavior camera.
+
+    codec: str
+        FourCC of the output video.
+    """
+    cap = cv2.VideoCapture(vid_path)
+    size = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(
+        cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+    )
+    writer = cv2.VideoWriter(
+        output_path, cv2.VideoWriter_fourcc(*codec), float(fps), size
+    )
+
+    for frame_number, frame in iter_video_frames(cap, frames):
+        if frame is None:
+            continue
+
+        # Don't draw on the same array twice if a frame number repeats.
+        frame = frame.copy()
+        port = -1 if lick_port is None else lick_port[frame_number]
+        draw_tracking_frame(
+            frame, frame_number, x[frame_number], y[frame_number], port, fps
+        )
+        writer.write(frame)
+
+    writer.release()
+    cap.release()
+
+    return output_path
+
+
 def make_tracking_video(
     session_folder,
     preprocessed=True,
@@ -41,6 +162,7 @@ def make_tracking_video(
     stop=None,
     frames=None,
     fps=15,
+    n_jobs=1,
 ):
     """
     Makes a video to visualize licking at water ports and position of the animal.
@@ -66,6 +188,11 @@ def make_tracking_video(
     fps: int
         Sampling rate of the behavior camera.
 
+    n_jobs: int
+        Number of worker processes (-1 for all CPUs). Long frame lists are split into
+        contiguous chunks that are written in parallel and then
+        concatenated without re-encoding.
+
     Arduino_path:
         Full path to the Arduino output txt. If None, doesn't show_plot licking.
 
@@ -80,9 +207,11 @@ def make_tracking_video(
     vid = cv2.VideoCapture(vid_path)
     if stop is None:
         stop = int(vid.get(7))  # 7 is the index for total frames.
+    vid.release()
 
     if frames is None:
         frames = np.arange(start, stop)
+    frames = np.asarray(frames)
 
     # Save data to the same folder.
     folder = os.path.split(vid_path)[0]
@@ -99,58 +228,32 @@ def make_tracking_video(
         else:
             eztrack = read_eztrack(csv_path)
 
-    # Define the colors that the cursor will flash for licking each port.
-    port_colors = [
-        "saddlebrown",
-        "red",
-        "orange",
-        "yellow",
-        "green",
-        "blue",
-        "darkviolet",
-        "gray",
-    ]
-
-    # Make video.
-    fig, ax = plt.subplots()
-    writer = FFMpegWriter(fps=fps)
-    with writer.saving(fig, output_path, 100):
-        for frame_number in frames:
-            # Plot frame.
-            vid.set(1, frame_number)
-            ret, frame = vid.read()
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            ax.imshow(frame)
-
-            # Plot position.
-            x = eztrack.at[frame_number, "x"]
-            y = eztrack.at[frame_number, "y"]
-            ax.scatter(x, y, marker="+", s=60, c="w")
-
-            ax.text(
-                0,
-                0,
-                "Frame: "
-                + str(frame_number)
-                + "   Time: "
-                + str(np.round(frame_number / fps, 1))
-                + " s",
-            )
-
-            # Lick indicator.
-            if (Arduino_path is not None) or preprocessed:
-                licking_at_port = eztrack.at[frame_number, "lick_port"]
-                if licking_at_port >= 0:
-                    ax.scatter(x, y, s=200, marker="+", c=port_colors[licking_at_port])
-
-            ax.set_aspect("equal")
-            ax.set_ylim([frame.shape[0], 0])
-            ax.set_xlim([0, frame.shape[1]])
-            plt.axis("off")
-
-            writer.grab_frame()
+    x = eztrack["x"].to_numpy()
+    y = eztrack["y"].to_numpy()
+    if (Arduino_path is not None) or preprocessed:
+        lick_port = eztrack["lick_port"].to_numpy()
+    else:
+        lick_port = None
+
+    # Make video. Negative n_jobs count back from the number of CPUs,
+    # as in joblib.
+    n_jobs = effective_n_jobs(n_jobs)
+    if n_jobs == 1 or len(frames) < 2 * n_jobs:
+        write_tracking_chunk(vid_path, output_path, frames, x, y, lick_port, fps)
+        return
+
+    name, ext = os.path.splitext(output_path)
+    chunk_paths = [f"{name}_chunk{i}{ext}" for i in range(n_jobs)]
+    Parallel(n_jobs=n_jobs)(
+        delayed(write_tracking_chunk)(vid_path, chunk_path, chunk, x, y, lick_port, fps)
+        for chunk_path, chunk in zip(chunk_paths, np.array_split(frames, n_jobs))
+    )
 
-            plt.cla()
+    try:
+        concat_videos(chunk_paths, output_path)
+    finally:
+        for chunk_path in chunk_paths:
+            os.remove(chunk_path)
 
 
 def sync_Arduino_outputs(
@@ -405,6 +508,30 @@ def linearize_trajectory(behavior_df, x=None, y=None):
     return angles, radii
 
 
+def find_blob(mask, max_sigma=50, threshold=0.05):
+    """
+    Find the first blob in a binary mask of pixels that differ from the
+    background.
+
+    :parameter
+    ---
+    mask: (h, w) boolean array
+        Pixels that differ from the background.
+
+    :return
+    ---
+    blob: (2,) array or None
+        First two coordinates of the blob returned by blob_doh, or None
+        if there are no blobs.
+    """
+    blobs = blob_doh(mask, max_sigma=max_sigma, threshold=threshold)
+
+    if len(blobs) < 1:
+        return None
+
+    return blobs[0, :2]
+
+
 def plot_licks(behavior_df):
     """
     Plot points where mouse licks.
@@ -479,6 +606,76 @@ def find_rewarded_ports(behavior_df):
     return rewarded_ports
 
 
+def behavior_fps(timestamp_paths):
+    """
+    Get sampling frequency of behavior video. We don't trust the
+    cv2 method for extracting fps from video files. Instead,
+    count time intervals in between video frames in the timestamp file.
+
+    :parameter
+    ---
+    timestamp_paths: str or list of strs
+        timestamp.dat path or, for v4 recordings, the timeStamps.csv paths.
+
+    :return
+    ---
+    fps: int
+        Frames per second.
+    """
+    if type(timestamp_paths) is list:
+        key = "Time Stamp (ms)"
+        timestamps = pd.read_csv(
+            find_timestamp_file(timestamp_paths, "BehavCam"), usecols=[key]
+        )
+    else:
+        key = "sysClock"
+        timestamps = pd.read_csv(timestamp_paths, sep="\t", usecols=[key])
+
+    # Inter-frame interval in milliseconds.
+    interframe_intervals = np.diff(timestamps[key].iloc[1:])
+    mean_interval = np.mean(interframe_intervals)
+    fps = round(1 / (mean_interval / 1000))
+
+    return fps
+
+
+def behavior_metadata(behavior_df, timestamp_paths, fps=None):
+    """
+    Compute the session metadata that is derived from preprocessed
+    behavior so it can be cached alongside it.
+
+    :parameters
+    ---
+    behavior_df: DataFrame
+        Output from Preprocess(), in pixels.
+
+    timestamp_paths: str or list of strs
+        Timestamp file path(s) from Session_Metadata.
+
+    fps: int or None
+        Sampling rate if already known. If None, read from the timestamps.
+
+    :return
+    ---
+    meta: dict
+        fps, port locations (pixels), linearized port locations, and
+        a boolean array of rewarded ports.
+    """
+    ports, lin_ports = find_water_ports(behavior_df)
+    rewarded_ports = np.zeros(8, dtype=bool)
+    rewarded_ports[find_rewarded_ports(behavior_df)] = True
+
+    meta = {
+        "fps": behavior_fps(timestamp_paths) if fps is None else fps,
+        "ports_x": ports["x"].to_numpy(),
+        "ports_y": ports["y"].to_numpy(),
+        "lin_ports": np.asarray(lin_ports, dtype=float),
+        "rewarded_ports": rewarded_ports,
+    }
+
+    return meta
+
+
 def bin_position(linearized_position):
     """
     Bin radial position.
@@ -706,8 +903,12 @@ def undo_lick_cleaning(folder, rename_old=True):
     P.behavior_df['water'] = df['water']
 
     if rename_old:
-        new_fname = os.path.join(folder, 'PreprocessedBehavior_old.csv')
-        os.rename(P.paths['PreprocessedBehavior'], new_fname)
+        if os.path.exists(P.paths['PreprocessedBehavior']):
+            new_fname = os.path.join(folder, 'PreprocessedBehavior_old.csv')
+            os.rename(P.paths['PreprocessedBehavior'], new_fname)
+        if os.path.exists(P.paths['BehaviorStore']):
+            new_fname = os.path.join(folder, 'PreprocessedBehavior_old.npz')
+            os.rename(P.paths['BehaviorStore'], new_fname)
 
     P.final_save()
 
@@ -724,7 +925,7 @@ class Preprocess:
             Folder path to session.
         """
         if folder is None:
-            self.folder = filedialog.askdirectory()
+            self.folder = ask_directory()
         else:
             self.folder = folder
 
@@ -733,6 +934,8 @@ class Preprocess:
         self.paths["PreprocessedBehavior"] = os.path.join(
             self.folder, "PreprocessedBehavior.csv"
         )
+        self.paths["BehaviorStore"] = get_store_path(self.folder)
+        self.fps = None
 
         if type(self.paths["timestamps"]) is str:
             self.camera_numbers = {
@@ -744,12 +947,20 @@ class Preprocess:
             self.v4 = True
 
         # Check if Preprocess has been ran already by attempting
-        # to load a pkl file.
-        try:
-            self.behavior_df = pd.read_csv(self.paths["PreprocessedBehavior"])
+        # to load the binary file, then the csv (also if the csv is
+        # newer). The binary file also has the fps, so save() doesn't
+        # need to read it again.
+        if store_is_current(self.folder):
+            self.behavior_df, meta = read_behavior(self.paths["BehaviorStore"])
+            self.fps = meta["fps"]
+        else:
+            try:
+                self.behavior_df = pd.read_csv(self.paths["PreprocessedBehavior"])
+            except FileNotFoundError:
+                self.behavior_df = None
 
         # If not, sync Arduino data.
-        except:
+        if self.behavior_df is None:
             if not self.paths["BehaviorData"]:
                 try:
                     convert_dlc_to_eztrack(self.paths["DLC"])
@@ -791,23 +1002,39 @@ class Preprocess:
         )
         self.behavior_df["t"] = self.get_timestamps()
 
-    def save(self, path=None, fname="PreprocessedBehavior.csv"):
+    def save(self, path=None, fname="PreprocessedBehavior.npz"):
         """
-        Save preprocessed data.
+        Save preprocessed data along with its derived metadata (fps,
+        port locations, rewarded ports) to the binary session file.
 
         path: str
             Folder path to save to. If None, default to session folder.
 
         fname: str
-            File name to call the pkl file.
+            File name. Names ending in .csv are written as csv instead.
 
         """
         if path is None:
-            fpath = self.paths["PreprocessedBehavior"]
-        else:
-            fpath = os.path.join(path, fname)
+            path = self.folder
+        fpath = os.path.join(path, fname)
 
-        self.behavior_df.to_csv(fpath, index=False)
+        if fname.endswith(".csv"):
+            self.behavior_df.to_csv(fpath, index=False)
+        else:
+            start = time.perf_counter()
+            if self.fps is None:
+                self.fps = behavior_fps(self.paths["timestamps"])
+            meta = behavior_metadata(
+                self.behavior_df, self.paths["timestamps"], fps=self.fps
+            )
+            write_behavior(fpath, self.behavior_df, meta)
+            log_artifact(
+                self.folder,
+                "PreprocessedBehavior",
+                fpath,
+                params={"version": store_version},
+                duration=time.perf_counter() - start,
+            )
 
     def final_save(self):
         self.behavior_df = clean_lick_detection(self.behavior_df)
@@ -841,23 +1068,45 @@ class Preprocess:
 
     def autocorrect_outliers(self, velocity_threshold=40,
                              blob_threshold=30,
-                             show_plot=False):
+                             show_plot=False,
+                             n_jobs=1):
+        """
+        Replace positions on frames where the mouse jumps faster than
+        velocity_threshold with the largest blob that differs from the
+        background. Jump frames are read in sorted batches and blob
+        detection runs in a worker pool.
+
+        :parameters
+        ---
+        velocity_threshold: float
+            Frames whose distance exceeds this are corrected.
+
+        blob_threshold: float
+            Minimum difference from background for a pixel to count.
+
+        show_plot: bool
+            Whether to plot old and new positions of each corrected frame.
+
+        n_jobs: int
+            Number of workers for blob detection.
+        """
         reference = self.get_reference()
         jump_frames = np.where((self.behavior_df["distance"] > velocity_threshold))[0]
 
-        cap = cv2.VideoCapture(self.paths["BehaviorVideo"], cv2.CAP_FFMPEG)
         if show_plot:
             fig, ax = plt.subplots()
-        for frame_num in jump_frames:
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
-            ret, frame = cap.read()
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            difference = reference-frame
+        for frame_nums, frames in iter_frame_batches(
+            self.paths["BehaviorVideo"], jump_frames, gray=True
+        ):
+            blobs = Parallel(n_jobs=n_jobs)(
+                delayed(find_blob)(reference - frame > blob_threshold)
+                for frame in frames
+            )
 
-            blobs = blob_doh(difference > blob_threshold,
-                             max_sigma=50, threshold=0.05)
+            for frame_num, frame, blob in zip(frame_nums, frames, blobs):
+                if blob is None:
+                    continue
 
-            if len(blobs) >= 1:
                 if show_plot:
                     ax.cla()
                     ax.imshow(frame)
@@ -865,35 +1114,22 @@ class Preprocess:
                                self.behavior_df.loc[frame_num, "y"],
                                marker='+',
                                color='r')
-                    ax.scatter(blobs[0,0], blobs[0,1],
+                    ax.scatter(blob[0], blob[1],
                                marker='+', color='g')
 
-                self.behavior_df.loc[frame_num, "x"] = blobs[0,0]
-                self.behavior_df.loc[frame_num, "y"] = blobs[0,1]
+                self.behavior_df.loc[frame_num, "x"] = blob[0]
+                self.behavior_df.loc[frame_num, "y"] = blob[1]
 
         self.preprocess()
         self.save()
 
-    def get_reference(self):
-        cap = cv2.VideoCapture(self.paths["BehaviorVideo"], cv2.CAP_FFMPEG)
-        ret, frame = cap.read()
-        (h, w) = frame.shape[:2]
-        total_nframes = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        nframes = 100
-        frames = np.random.randint(0, total_nframes, nframes)
-        collection = np.zeros((nframes, h, w))
-
-        for i, frame_num in enumerate(frames):
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
-            ret, frame = cap.read()
-
-            if ret:
-                collection[i] = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-        cap.release()
-
-        return np.median(collection, axis=0)
+    def get_reference(self, nframes=100):
+        """
+        Median background of the behavior video. Cached per video, so
+        repeated calls (and SessionStitcher) reuse it.
 
+        """
+        return background_image(self.paths["BehaviorVideo"], nframes=nframes)
 
     def get_timestamps(self):
         if not self.v4:
@@ -1052,9 +1288,14 @@ class Preprocess:
         ax.plot(x[idx], y[idx])
         ax.set_aspect("equal")
 
-    def track_video(self, start=0, stop=None, fname="Tracking.avi", fps=15):
+    def track_video(self, start=0, stop=None, fname="Tracking.avi", fps=15, n_jobs=1):
         make_tracking_video(
-            self.folder, start=start, stop=stop, output_fname=fname, fps=fps
+            self.folder,
+            start=start,
+            stop=stop,
+            output_fname=fname,
+            fps=fps,
+            n_jobs=n_jobs,
         )
 
 
@@ -1085,7 +1326,7 @@ class BehaviorSession:
         # If folder is not specified, open a dialog box.
         self.meta = dict()
         if folder is None:
-            self.meta["folder"] = filedialog.askdirectory()
+            self.meta["folder"] = ask_directory()
         else:
             self.meta["folder"] = folder
 
@@ -1094,31 +1335,32 @@ class BehaviorSession:
         self.meta["paths"]["PreprocessedBehavior"] = os.path.join(
             self.meta["folder"], "PreprocessedBehavior.csv"
         )
+        self.meta["paths"]["BehaviorStore"] = get_store_path(self.meta["folder"])
 
         # Determine if this was a recording with the new QT system.
         self.meta["v4"] = (
             True if type(self.meta["paths"]["timestamps"]) is list else False
         )
 
-        # Try loading a presaved csv.
+        # Try loading the binary session file. If there is only a csv,
+        # or the csv is newer, derive the metadata from it in memory.
+        # Loading never writes to the session folder; see
+        # batch_convert_preprocessed_csvs().
         self.data = dict()
-        try:
-            self.data["df"] = pd.read_csv(self.meta["paths"]["PreprocessedBehavior"])
-        except:
-            raise FileNotFoundError("Run Preprocess() first.")
-
-        # Get timing information.
-        if self.meta["v4"]:
-            self.meta["behavior_timestamps"] = pd.read_csv(
-                find_timestamp_file(self.meta["paths"]["timestamps"], "BehavCam")
-            )
-        else:
-            self.meta["behavior_timestamps"] = pd.read_csv(
-                self.meta["paths"]["timestamps"], sep="\t"
-            )
+        with stage("BehaviorStore") as s:
+            if store_is_current(self.meta["folder"]):
+                self.data["df"], cached = read_behavior(
+                    self.meta["paths"]["BehaviorStore"]
+                )
+                s.cache = "hit"
+            else:
+                s.cache = "miss"
+                self.data["df"], cached = read_preprocessed_csv(
+                    self.meta["folder"], paths=self.meta["paths"]
+                )
         self.meta['local'] = False
 
-        self.meta["fps"] = self.get_fps()
+        self.meta["fps"] = cached["fps"]
 
         # Convert x, y, and distance values to cm.
         self.data["df"]["x"] = self.data["df"]["x"] / pix_per_cm
@@ -1131,17 +1373,18 @@ class BehaviorSession:
         # Amount of time spent per trial (in frames).
         self.data["frames_per_trial"] = np.bincount(self.data["df"]["trials"])
 
-        # Find water ports.
-        self.data["ports"], self.data["lin_ports"] = find_water_ports(self.data["df"])
-
-        # Find rewarded ports
-        rewarded_ports = find_rewarded_ports(self.data["df"])
-        self.data["rewarded_ports"] = np.zeros(8, dtype=bool)
-        self.data["rewarded_ports"][rewarded_ports] = True
+        # Water ports and rewarded ports were found when the file was written.
+        self.data["ports"] = pd.DataFrame(
+            {
+                "x": cached["ports_x"] / pix_per_cm,
+                "y": cached["ports_y"] / pix_per_cm,
+            }
+        )
+        self.data["lin_ports"] = cached["lin_ports"].tolist()
+        self.data["rewarded_ports"] = cached["rewarded_ports"].astype(bool)
         self.data["n_rewarded_ports"] = np.sum(self.data["rewarded_ports"])
 
-        self.data["all_licks"] = self.get_licks(plot=False)[0]
-        self.data["n_drinks"] = self.count_drinks()
+        self.data["all_licks"], self.data["n_drinks"] = self.tally_licks_and_drinks()
 
         self.data["learning"] = dict()
         (
@@ -1154,25 +1397,52 @@ class BehaviorSession:
 
     def get_fps(self):
         """
-        Get sampling frequency of behavior video. We don't trust the
-        cv2 method for extracting fps from video files. Instead,
-        count time intervals in between video frames in timeStamp.csv.
+        Get sampling frequency of behavior video from timeStamp.csv.
 
         :return:
         """
-        # Take difference.
-        if self.meta["v4"]:
-            key = "Time Stamp (ms)"
-        else:
-            key = "sysClock"
+        return behavior_fps(self.meta["paths"]["timestamps"])
 
-        interframe_intervals = np.diff(self.meta["behavior_timestamps"][key].iloc[1:])
+    def tally_licks_and_drinks(self, n_ports=8):
+        """
+        Count licks on each port and water deliveries per trial with a
+        single 2-D bincount over (trial, port) codes. Water deliveries
+        get their own column after the last port.
 
-        # Inter-frame interval in milliseconds.
-        mean_interval = np.mean(interframe_intervals)
-        fps = round(1 / (mean_interval / 1000))
+        :parameter
+        ---
+        n_ports: int
+            Number of water ports on the maze.
+
+        :returns
+        ---
+        all_licks: (trial, port) array
+            Number of licks on each port per trial.
 
-        return fps
+        n_rewards: (trial,) array
+            Number of rewards retrieved per trial.
+        """
+        ntrials = self.data["ntrials"]
+        trials = self.data["df"]["trials"].to_numpy()
+        lick_port = self.data["df"]["lick_port"].to_numpy()
+        water = self.data["df"]["water"].to_numpy(dtype=bool)
+        in_session = (trials >= 0) & (trials < ntrials)
+
+        # Licks get coded by their port, water by an extra column.
+        licked = in_session & (lick_port >= 0) & (lick_port < n_ports)
+        drank = in_session & water
+        codes = np.concatenate(
+            (
+                trials[licked] * (n_ports + 1) + lick_port[licked],
+                trials[drank] * (n_ports + 1) + n_ports,
+            )
+        ).astype(np.int64)
+
+        tallies = np.bincount(codes, minlength=ntrials * (n_ports + 1)).reshape(
+            ntrials, n_ports + 1
+        )
+
+        return tallies[:, :n_ports], tallies[:, n_ports]
 
     def count_drinks(self):
         """
@@ -1180,14 +1450,7 @@ class BehaviorSession:
 
         :return:
         """
-        n_rewards = []
-        for trial in range(self.data["ntrials"]):
-            water_deliveries = np.sum(
-                self.data["df"].loc[self.data["df"]["trials"] == trial]["water"]
-            )
-            n_rewards.append(water_deliveries)
-
-        return np.asarray(n_rewards)
+        return self.tally_licks_and_drinks()[1]
 
     def plot_licks_spiral(self):
         """
@@ -1279,17 +1542,7 @@ class BehaviorSession:
         show_plot: boolean
             Whether or not to show_plot.
         """
-        ports = range(8)
-        all_licks = []
-        for trial in range(self.data["ntrials"]):
-            this_trial = self.data["df"]["trials"] == trial
-            licks = list(self.data["df"].loc[this_trial, "lick_port"])
-
-            licks_per_port = [licks.count(port) for port in ports]
-
-            all_licks.append(licks_per_port)
-
-        all_licks = np.asarray(all_licks)
+        all_licks = self.tally_licks_and_drinks()[0]
         if binarize:
             all_licks = all_licks > 0
         if plot:
@@ -1510,6 +1763,134 @@ class BehaviorSession:
             print("Learning data not found.")
 
 
+def store_is_current(session_folder, verbose=True):
+    """
+    Whether a session's binary file exists and is at least as new as
+    its PreprocessedBehavior.csv. The csv can be newer if it was
+    corrected by hand or written by Preprocess.save() to a .csv name.
+
+    :parameters
+    ---
+    session_folder: str
+        Session folder.
+
+    verbose: bool
+        Print a warning when the csv is newer.
+    """
+    store_path = get_store_path(session_folder)
+    csv_path = os.path.join(session_folder, "PreprocessedBehavior.csv")
+    if not os.path.exists(store_path):
+        return False
+
+    if os.path.exists(csv_path) and os.path.getmtime(csv_path) > os.path.getmtime(
+        store_path
+    ):
+        if verbose:
+            print(
+                f"{csv_path} is newer than {store_path}. Reading the csv; run "
+                f"convert_preprocessed_csv() to update the binary file."
+            )
+        return False
+
+    return True
+
+
+def read_preprocessed_csv(session_folder, paths=None):
+    """
+    Read a session's PreprocessedBehavior.csv and compute its derived
+    metadata, as they would be stored in the binary session file.
+
+    :parameters
+    ---
+    session_folder: str
+        Session folder containing PreprocessedBehavior.csv.
+
+    paths: dict or None
+        Session_Metadata paths. If None, they are looked up.
+
+    :returns
+    ---
+    behavior_df: DataFrame
+        Typed preprocessed behavior.
+
+    meta: dict
+        Derived metadata.
+    """
+    if paths is None:
+        paths = Session_Metadata(session_folder).meta_dict
+
+    csv_path = os.path.join(session_folder, "PreprocessedBehavior.csv")
+    try:
+        behavior_df = pd.read_csv(csv_path)
+    except FileNotFoundError:
+        raise FileNotFoundError("Run Preprocess() first.")
+
+    meta = behavior_metadata(behavior_df, paths["timestamps"])
+
+    return cast_behavior_df(behavior_df), meta
+
+
+def convert_preprocessed_csv(session_folder, paths=None):
+    """
+    Convert a session's PreprocessedBehavior.csv into the binary session
+    file, computing and caching the derived metadata along the way.
+
+    :parameters
+    ---
+    session_folder: str
+        Session folder containing PreprocessedBehavior.csv.
+
+    paths: dict or None
+        Session_Metadata paths. If None, they are looked up.
+
+    :returns
+    ---
+    behavior_df: DataFrame
+        Typed preprocessed behavior.
+
+    meta: dict
+        Derived metadata that was written.
+    """
+    start = time.perf_counter()
+    behavior_df, meta = read_preprocessed_csv(session_folder, paths=paths)
+    fpath = get_store_path(session_folder)
+    write_behavior(fpath, behavior_df, meta)
+    log_artifact(
+        session_folder,
+        "PreprocessedBehavior",
+        fpath,
+        params={"version": store_version},
+        duration=time.perf_counter() - start,
+    )
+
+    return read_behavior(fpath)
+
+
+def batch_convert_preprocessed_csvs(folder, overwrite=False):
+    """
+    One-shot conversion of every PreprocessedBehavior.csv under a folder
+    (e.g., a project's Data folder) into binary session files.
+
+    :parameters
+    ---
+    folder: str
+        Top folder to search.
+
+    overwrite: bool
+        Whether to rewrite sessions that already have a binary file.
+    """
+    for csv_path in Path(folder).rglob("PreprocessedBehavior.csv"):
+        session_folder = str(csv_path.parent)
+        if store_is_current(session_folder, verbose=False) and not overwrite:
+            continue
+
+        try:
+            convert_preprocessed_csv(session_folder)
+            print(f"Converted {csv_path}")
+        except Exception as e:
+            print(f"Failed to convert {csv_path}: {e}")
+
+
 def dlc_to_csv(folder: str):
     """
     Finds the DLC output file and converts it to csv, mirroring
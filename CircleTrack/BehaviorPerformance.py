@@ -0,0 +1,399 @@
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+from CaImaging.util import nan_array
+from util import lazy_import
+
+xr = lazy_import("xarray")
+
+sdt_metrics = ["hits", "misses", "FAs", "CRs", "d_prime"]
+
+
+def sdt_blocks(all_licks, rewarded_ports, window=None, strides=None, trial_limit=None):
+    """
+    Count the licked rewarded and unrewarded port passes for every trial
+    block of one session without looping over blocks. Blocks match
+    BehaviorSession.sdt_trials() when n_trial_blocks is None.
+
+    :parameters
+    ---
+    all_licks: (trial, port) array
+        Lick counts from BehaviorSession.data['all_licks'].
+
+    rewarded_ports: (port,) boolean array
+        Which ports were rewarded.
+
+    window: int or None
+        Number of trials per rolling window. If None, the whole session
+        (up to trial_limit) is a single block.
+
+    strides: int or None
+        Number of trials between the starts of consecutive windows.
+
+    trial_limit: int or None
+        Only consider trials before this one.
+
+    :returns
+    ---
+    correct, incorrect: (block,) arrays
+        Number of rewarded and unrewarded port passes that were licked.
+
+    block_size: int
+        Number of trials in each block.
+    """
+    licks = all_licks if trial_limit is None else all_licks[:trial_limit]
+    binarized = licks > 0
+    ntrials = len(binarized)
+
+    # Cumulative sums let us get every window with two lookups.
+    correct = np.concatenate(([0], np.cumsum(binarized[:, rewarded_ports].sum(axis=1))))
+    incorrect = np.concatenate(
+        ([0], np.cumsum(binarized[:, ~rewarded_ports].sum(axis=1)))
+    )
+
+    if window is None:
+        starts = np.array([0])
+        block_size = ntrials
+    else:
+        starts = np.arange(0, max(ntrials - window + 1, 0), strides)
+        block_size = window
+    ends = starts + block_size
+
+    return correct[ends] - correct[starts], incorrect[ends] - incorrect[starts], block_size
+
+
+def sdt_rates(correct, incorrect, go_trials, nogo_trials):
+    """
+    Convert lick counts into signal detection rates. Works on arrays of
+    blocks from any number of sessions at once.
+
+    :parameters
+    ---
+    correct, incorrect: arrays
+        Number of licked rewarded and unrewarded port passes.
+
+    go_trials, nogo_trials: arrays
+        Number of rewarded and unrewarded port passes.
+
+    :return
+    ---
+    sdt: dict
+        Rates keyed by "hits", "misses", "FAs", "CRs", and "d_prime".
+    """
+    Z = norm.ppf
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sdt = {
+            "hits": correct / go_trials,
+            "misses": (go_trials - correct) / go_trials,
+            "FAs": incorrect / nogo_trials,
+            "CRs": (nogo_trials - incorrect) / nogo_trials,
+        }
+
+    # To correct d' of infinity or -infinity refer to Stanislaw & Todorov (1999).
+    sdt["d_prime"] = Z((correct + 0.5) / (go_trials + 1)) - Z(
+        (incorrect + 0.5) / (nogo_trials + 1)
+    )
+
+    return sdt
+
+
+class PerformanceStore:
+    def __init__(self, get_behavior, grouped_mice, session_types):
+        """
+        Cohort-level store of behavioral performance. Hits, misses, false
+        alarms, correct rejections, and d' are computed for every trial
+        block of every session in one vectorized pass and kept in a
+        long-form table with columns (mouse, group, session, window,
+        metric, value). Padded (mouse x trial block) matrices are
+        cached per parameter set.
+
+        :parameters
+        ---
+        get_behavior: callable
+            get_behavior(mouse, session_type) returns the BehaviorSession.
+            Sessions are only accessed once a table is requested.
+
+        grouped_mice: dict
+            {group: list of mice}. Group order determines plotting order.
+
+        session_types: list of str
+            Session types, in order.
+        """
+        self.get_behavior = get_behavior
+        self.grouped_mice = grouped_mice
+        self.session_types = session_types
+        self.mice = [mouse for group in grouped_mice.values() for mouse in group]
+        self.groups = {
+            mouse: group for group, mice in grouped_mice.items() for mouse in mice
+        }
+
+        self.tables = dict()
+        self.padded_views = dict()
+        self.session_sdt = dict()
+
+    def clear(self):
+        """
+        Drop all cached tables, e.g. after modifying a BehaviorSession.
+
+        """
+        self.tables = dict()
+        self.padded_views = dict()
+        self.session_sdt = dict()
+
+    def table(self, window=6, strides=2, trial_limit=None):
+        """
+        Get the long-form performance table for a set of windowing
+        parameters, computing it if needed. As with
+        BehaviorSession.sdt_trials(), each session's sdt attribute is
+        set to its performance under these parameters.
+
+        :parameters
+        ---
+        window: int or None
+            Trial window size. None computes performance over the whole session.
+
+        strides: int or None
+            Number of trials between windows.
+
+        trial_limit: int or None
+            Only consider trials before this one.
+
+        :return
+        ---
+        df: DataFrame
+            Columns are mouse, group, session, window, metric, value.
+        """
+        key = (window, strides, trial_limit)
+        if key not in self.tables:
+            self.tables[key], self.session_sdt[key] = self.build(*key)
+
+        for (mouse, session_type), sdt in self.session_sdt[key].items():
+            self.get_behavior(mouse, session_type).sdt = {
+                metric: list(values) for metric, values in sdt.items()
+            }
+
+        return self.tables[key]
+
+    def build(self, window, strides, trial_limit):
+        correct, incorrect, go_trials, nogo_trials = [], [], [], []
+        mice, sessions, windows, keys = [], [], [], []
+        for mouse in self.mice:
+            for session_type in self.session_types:
+                behavior = self.get_behavior(mouse, session_type).data
+                n_rewarded = behavior["n_rewarded_ports"]
+                correct_, incorrect_, block_size = sdt_blocks(
+                    behavior["all_licks"],
+                    behavior["rewarded_ports"],
+                    window=window,
+                    strides=strides,
+                    trial_limit=trial_limit,
+                )
+                n_blocks = len(correct_)
+
+                correct.append(correct_)
+                incorrect.append(incorrect_)
+                go_trials.append(np.full(n_blocks, block_size * n_rewarded))
+                nogo_trials.append(np.full(n_blocks, block_size * (8 - n_rewarded)))
+                mice.append(np.repeat(mouse, n_blocks))
+                sessions.append(np.repeat(session_type, n_blocks))
+                windows.append(np.arange(n_blocks))
+                keys.append((mouse, session_type))
+
+        sdt = sdt_rates(
+            np.concatenate(correct),
+            np.concatenate(incorrect),
+            np.concatenate(go_trials),
+            np.concatenate(nogo_trials),
+        )
+
+        # Per-session values, in the format of BehaviorSession.sdt.
+        splits = np.cumsum([len(block) for block in windows])[:-1]
+        by_session = {metric: np.split(sdt[metric], splits) for metric in sdt_metrics}
+        session_sdt = {
+            (mouse, session_type): {
+                metric: by_session[metric][i] for metric in sdt_metrics
+            }
+            for i, (mouse, session_type) in enumerate(keys)
+        }
+
+        # Stack the metrics into a long-form table.
+        n_metrics = len(sdt_metrics)
+        mice = np.concatenate(mice)
+        df = pd.DataFrame(
+            {
+                "mouse": np.tile(mice, n_metrics),
+                "group": np.tile([self.groups[mouse] for mouse in mice], n_metrics),
+                "session": np.tile(np.concatenate(sessions), n_metrics),
+                "window": np.tile(np.concatenate(windows), n_metrics),
+                "metric": np.repeat(sdt_metrics, len(mice)),
+                "value": np.concatenate([sdt[metric] for metric in sdt_metrics]),
+            }
+        )
+        for col, categories in zip(
+            ["mouse", "group", "session", "metric"],
+            [self.mice, list(self.grouped_mice), self.session_types, sdt_metrics],
+        ):
+            df[col] = pd.Categorical(df[col], categories=categories)
+
+        return df, session_sdt
+
+    def get(self, mouse, session_type, performance_metric="d_prime", **kwargs):
+        """
+        Get the performance of one mouse on one session across trial blocks.
+
+        :return
+        ---
+        values: (block,) array
+        """
+        df = self.table(**kwargs)
+        rows = (
+            (df["mouse"] == mouse)
+            & (df["session"] == session_type)
+            & (df["metric"] == performance_metric)
+        )
+
+        return df.loc[rows, "value"].to_numpy()
+
+    def session_df(self, session_type, performance_metric="d_prime", **kwargs):
+        """
+        Performance of all mice on one session, formatted as
+        (t, dv, mice, session, group).
+
+        """
+        df = self.table(**kwargs)
+        df = df.loc[
+            (df["session"] == session_type) & (df["metric"] == performance_metric)
+        ]
+
+        return pd.DataFrame(
+            {
+                "t": df["window"].to_numpy(),
+                "dv": df["value"].to_numpy(),
+                "mice": df["mouse"].astype(str).to_numpy(),
+                "session": df["session"].astype(str).to_numpy(),
+                "group": df["group"].astype(str).to_numpy(),
+            }
+        )
+
+    def peak(self, session_type, performance_metric="d_prime", **kwargs):
+        """
+        Peak performance of each mouse on one session, split by group.
+
+        :return
+        ---
+        peak_performance: dict
+            {group: list of peak values, in the order of grouped_mice}.
+        """
+        df = self.table(**kwargs)
+        df = df.loc[
+            (df["session"] == session_type) & (df["metric"] == performance_metric)
+        ]
+        peaks = df.groupby("mouse", observed=False)["value"].max()
+
+        return {
+            group: [peaks[mouse] for mouse in mice]
+            for group, mice in self.grouped_mice.items()
+        }
+
+    def padded(self, performance_metric="d_prime", **kwargs):
+        """
+        Padded (mouse x trial block) matrices for each group with all
+        sessions placed side by side. Sessions are padded with NaNs to
+        the longest mouse's length.
+
+        :returns
+        ---
+        metrics: dict
+            {group: (mouse, trial block) array}.
+
+        borders: array
+            Trial block index where each session starts (plus the end).
+
+        longest_sessions: list of ints
+            Number of trial blocks in the longest mouse for each session.
+        """
+        key = (
+            performance_metric,
+            kwargs.get("window", 6),
+            kwargs.get("strides", 2),
+            kwargs.get("trial_limit"),
+        )
+        if key in self.padded_views:
+            return self.padded_views[key]
+
+        df = self.table(**kwargs)
+        df = df.loc[df["metric"] == performance_metric]
+
+        n_blocks = df.groupby(["mouse", "session"], observed=False).size()
+        longest_sessions = [
+            int(n_blocks.xs(session, level="session").max())
+            for session in self.session_types
+        ]
+        borders = np.insert(np.cumsum(longest_sessions), 0, 0)
+        session_offsets = dict(zip(self.session_types, borders[:-1]))
+
+        columns = df["window"].to_numpy() + np.asarray(
+            [session_offsets[session] for session in df["session"]]
+        )
+        values = df["value"].to_numpy()
+        mouse_col = df["mouse"].to_numpy()
+
+        metrics = dict()
+        for group, mice in self.grouped_mice.items():
+            metrics[group] = nan_array((len(mice), borders[-1]))
+            for row, mouse in enumerate(mice):
+                in_mouse = mouse_col == mouse
+                metrics[group][row, columns[in_mouse]] = values[in_mouse]
+
+        self.padded_views[key] = (metrics, borders, longest_sessions)
+
+        return self.padded_views[key]
+
+    def whole_session_df(self, performance_metric="d_prime", trial_limit=None):
+        """
+        Performance computed over whole sessions, in the format used for
+        ANOVAs (metric, session_types, mice, group).
+
+        """
+        df = self.table(window=None, strides=None, trial_limit=trial_limit)
+        df = df.loc[df["metric"] == performance_metric]
+
+        return pd.DataFrame(
+            {
+                "metric": df["value"].to_numpy(),
+                "session_types": df["session"].astype(str).to_numpy(),
+                "mice": df["mouse"].astype(str).to_numpy(),
+                "group": df["group"].astype(str).to_numpy(),
+            }
+        )
+
+    def to_xarray(self, categories=("hits", "CRs", "d_prime"), mice=None, **kwargs):
+        """
+        Legacy (metric, mouse, session) DataArray where each element is
+        the list of values across trial blocks.
+
+        """
+        if mice is None:
+            mice = self.mice
+
+        df = self.table(**kwargs)
+        arr = np.zeros((len(categories), len(mice), len(self.session_types)), dtype=object)
+        grouped = {
+            key: values["value"].tolist()
+            for key, values in df.groupby(["metric", "mouse", "session"], observed=False)
+        }
+        for i, metric in enumerate(categories):
+            for j, mouse in enumerate(mice):
+                for k, session in enumerate(self.session_types):
+                    arr[i, j, k] = grouped[(metric, mouse, session)]
+
+        return xr.DataArray(
+            arr,
+            dims=("metric", "mouse", "session"),
+            coords={
+                "metric": list(categories),
+                "mouse": mice,
+                "session": self.session_types,
+            },
+        )
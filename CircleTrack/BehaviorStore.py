@@ -0,0 +1,128 @@
+import os
+import numpy as np
+import pandas as pd
+
+store_fname = "PreprocessedBehavior.npz"
+store_version = 1
+
+# Column types for the preprocessed behavior table. Columns not listed
+# here are stored with whatever type pandas gave them.
+behavior_dtypes = {
+    "frame": np.int32,
+    "trials": np.int32,
+    "lick_port": np.int8,
+    "water": bool,
+    "x": np.float32,
+    "y": np.float32,
+    "distance": np.float32,
+    "lin_position": np.float32,
+    "t": np.float64,
+}
+
+
+def get_store_path(folder):
+    """
+    Path to the binary preprocessed behavior file of a session folder.
+
+    """
+    return os.path.join(folder, store_fname)
+
+
+def cast_behavior_df(behavior_df):
+    """
+    Cast the columns of a preprocessed behavior DataFrame to their
+    storage types. Integer columns that contain NaNs are left alone.
+
+    :parameter
+    ---
+    behavior_df: DataFrame
+        Output from Preprocess.
+
+    :return
+    ---
+    behavior_df: DataFrame
+        Same data with typed columns.
+    """
+    dtypes = {}
+    for column, dtype in behavior_dtypes.items():
+        if column not in behavior_df:
+            continue
+
+        if np.issubdtype(dtype, np.integer) and behavior_df[column].isna().any():
+            continue
+
+        dtypes[column] = dtype
+
+    return behavior_df.astype(dtypes)
+
+
+def write_behavior(fpath, behavior_df, meta):
+    """
+    Write preprocessed behavior and its derived metadata to a binary
+    columnar file. The file is written next to its destination and
+    then moved over it so readers never see a partial file.
+
+    :parameters
+    ---
+    fpath: str
+        Destination, usually from get_store_path().
+
+    behavior_df: DataFrame
+        Output from Preprocess.
+
+    meta: dict
+        Derived metadata (fps, ports_x, ports_y, lin_ports, rewarded_ports).
+    """
+    behavior_df = cast_behavior_df(behavior_df)
+
+    arrays = {
+        "version": np.asarray(store_version),
+        "columns": np.asarray(behavior_df.columns, dtype=str),
+    }
+    for i, column in enumerate(behavior_df.columns):
+        values = behavior_df[column].to_numpy()
+        if values.dtype == object:
+            values = values.astype(str)
+        arrays[f"col_{i}"] = values
+
+    for key, value in meta.items():
+        arrays[f"meta_{key}"] = np.asarray(value)
+
+    tmp_path = fpath + ".tmp"
+    with open(tmp_path, "wb") as file:
+        np.savez(file, **arrays)
+    os.replace(tmp_path, fpath)
+
+
+def read_behavior(fpath):
+    """
+    Read a file written by write_behavior().
+
+    :parameter
+    ---
+    fpath: str
+        Path to the file.
+
+    :returns
+    ---
+    behavior_df: DataFrame
+        Typed preprocessed behavior.
+
+    meta: dict
+        Derived metadata.
+    """
+    with np.load(fpath, allow_pickle=False) as file:
+        if int(file["version"]) != store_version:
+            raise ValueError(f"{fpath} was written by an incompatible version.")
+
+        columns = file["columns"].tolist()
+        behavior_df = pd.DataFrame(
+            {column: file[f"col_{i}"] for i, column in enumerate(columns)}
+        )
+        meta = {
+            key[len("meta_"):]: file[key] for key in file.files if key.startswith("meta_")
+        }
+
+    meta["fps"] = meta["fps"].item()
+
+    return behavior_df, meta
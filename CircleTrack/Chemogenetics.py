@@ -1,8 +1,8 @@
 import numpy as np
 from CircleTrack.SessionCollation import MultiAnimal
 from CircleTrack.BehaviorFunctions import BehaviorSession
+from CircleTrack.BehaviorPerformance import PerformanceStore
 import matplotlib.pyplot as plt
-import xarray as xr
 from scipy.stats import ttest_ind, mannwhitneyu, ranksums
 from CaImaging.util import nan_array, sem, stack_padding, group_consecutives
 import pandas as pd
@@ -123,6 +123,13 @@ class Chemogenetics:
                 ]
             self.meta["grouped_mice"][key] = mouse_list
 
+        # Behavioral performance of the whole cohort, computed on demand.
+        self.performance = PerformanceStore(
+            lambda mouse, session_type: self.data[mouse][session_type],
+            self.meta["grouped_mice"],
+            self.meta["session_types"],
+        )
+
     def save_fig(self, fig, fname, folder):
         fpath = os.path.join(
             self.save_configs["path"],
@@ -151,39 +158,14 @@ class Chemogenetics:
         performance_metric="CRs",
         trial_limit=None,
     ):
-        dv, mice, sessions, groups, trial_blocks = [], [], [], [], []
-        for group in self.meta["groups"]:
-            for mouse in self.meta["grouped_mice"][group]:
-                session = self.data[mouse][session_type]
-                session.sdt_trials(
-                    rolling_window=window,
-                    trial_interval=strides,
-                    plot=False,
-                    trial_limit=trial_limit,
-                )
-
-                n = range(len(session.sdt[performance_metric]))
-                dv.extend(session.sdt[performance_metric])
-                mice.extend([mouse for i in n])
-                sessions.extend([session_type for i in n])
-                groups.extend([group for i in n])
-                trial_blocks.extend([i for i in n])
-
-        df = pd.DataFrame(
-            {
-                "t": trial_blocks,
-                "dv": dv,
-                "mice": mice,
-                "session": sessions,
-                "group": groups,
-            }
+        df = self.performance.session_df(
+            session_type,
+            performance_metric=performance_metric,
+            window=window,
+            strides=strides,
+            trial_limit=trial_limit,
         )
 
-        # cols = ['mice', 'session', 'group']
-        # df[cols] = df[cols].mask(df[cols]=='nan', None).ffill(axis=0)
-        # df['t'] = df['t'].isna().cumsum() + df['t'].ffill()
-        # df = df.dropna(axis=0)
-
         return df
 
     def stack_behavior_dv(self, df):
@@ -409,102 +391,15 @@ class Chemogenetics:
         performance_metric="d_prime",
         trial_limit=None,
     ):
-        # Preallocate array.
-        behavioral_performance_arr = np.zeros(
-            (3, len(self.meta["mice"]), len(self.meta["session_types"])),
-            dtype=object,
-        )
-        categories = ["hits", "CRs", "d_prime"]
-
-        # Fill array with hits/CRs/d' x mouse x session data.
-        for j, mouse in enumerate(self.meta["mice"]):
-            for k, session_type in enumerate(self.meta["session_types"]):
-                session = self.data[mouse][session_type]
-                session.sdt_trials(
-                    rolling_window=window,
-                    trial_interval=strides,
-                    plot=False,
-                    trial_limit=trial_limit,
-                )
-
-                for i, key in enumerate(categories):
-                    behavioral_performance_arr[i, j, k] = session.sdt[key]
-
-        # Place into xarray.
-        behavioral_performance = xr.DataArray(
-            behavioral_performance_arr,
-            dims=("metric", "mouse", "session"),
-            coords={
-                "metric": categories,
-                "mouse": self.meta["mice"],
-                "session": self.meta["session_types"],
-            },
+        kwargs = dict(window=window, strides=strides, trial_limit=trial_limit)
+        behavioral_performance = self.performance.to_xarray(
+            mice=self.meta["mice"], **kwargs
         )
-
-        # Make awkward array of all mice and sessions. Begin by
-        # finding the longest session for each mouse and session.
-        longest_sessions = [
-            max(
-                [
-                    len(i)
-                    for i in behavioral_performance.sel(
-                        metric="d_prime", session=session
-                    ).values.tolist()
-                ]
-            )
-            for session in self.meta["session_types"]
-        ]
-        # This will tell us where to draw session borders.
-        borders = np.cumsum(longest_sessions)
-        borders = np.insert(borders, 0, 0)
-
-        # Get dimensions of new arrays.
-        dims = {
-            group: (len(self.meta["grouped_mice"][group]), sum(longest_sessions))
-            for group in self.meta["groups"]
-        }
-        metrics = {key: nan_array(dims[key]) for key in self.meta["groups"]}
-
-        for group in self.meta["groups"]:
-            for row, mouse in enumerate(self.meta["grouped_mice"][group]):
-                for border, session in zip(borders, self.meta["session_types"]):
-                    metric_this_session = behavioral_performance.sel(
-                        metric=performance_metric, mouse=mouse, session=session
-                    ).values.tolist()
-                    length = len(metric_this_session)
-                    metrics[group][row, border : border + length] = metric_this_session
+        metrics = self.performance.padded(performance_metric, **kwargs)[0]
 
         if window is None:
-            mice_ = np.hstack(
-                [
-                    np.repeat(
-                        self.meta["grouped_mice"][group],
-                        len(self.meta["session_types"]),
-                    )
-                    for group in self.meta["groups"]
-                ]
-            )
-            groups_ = np.hstack(
-                [np.repeat(group, metrics[group].size) for group in self.meta["groups"]]
-            )
-            session_types_ = np.hstack(
-                [
-                    np.tile(
-                        self.meta["session_types"],
-                        len(self.meta["grouped_mice"][group]),
-                    )
-                    for group in self.meta["groups"]
-                ]
-            )
-            metric_ = np.hstack([metrics[inj].flatten() for inj in self.meta["groups"]])
-
-            df = pd.DataFrame(
-                {
-                    "metric": metric_,
-                    "session_types": session_types_,
-                    "mice": mice_,
-                    "group": groups_,
-                }
+            df = self.performance.whole_session_df(
+                performance_metric, trial_limit=trial_limit
             )
         else:
             df = None
@@ -531,24 +426,13 @@ class Chemogenetics:
         else:
             trial_limit = None
 
-        behavioral_performance = self.aggregate_behavior_over_trials(
+        best_performance = self.performance.peak(
+            session_type,
+            performance_metric=performance_metric,
             window=window,
             strides=strides,
-            performance_metric=performance_metric,
             trial_limit=trial_limit,
-        )[0]
-
-        best_performance = dict()
-        for group in self.meta["groups"]:
-            best_performance[group] = []
-            for mouse in self.meta["grouped_mice"][group]:
-                best_performance[group].append(
-                    np.nanmax(
-                        behavioral_performance.sel(
-                            mouse=mouse, metric=performance_metric, session=session_type
-                        ).values.tolist()
-                    )
-                )
+        )
 
         if show_plot:
             label_axes = True
@@ -0,0 +1,671 @@
+"""
+Headless batch runner for the RecentReversal figure panels.
+
+Each panel of RecentReversal.make_fig*/make_sfig* is rendered in a
+worker process with a non-interactive matplotlib backend. Expensive
+cohort-level results that several panels share (PV correlation
+matrices, ensemble trends) are computed once into a local cache and
+handed to the workers instead of being recomputed by every panel or
+read from hard-coded network paths.
+
+A manifest in the cache folder records a fingerprint of each panel's
+inputs: its source code and that of the RecentReversal methods it
+calls, the cached session files of the cohort, and the intermediates
+and panels it depends on. Only panels whose
+fingerprint changed are rendered again.
+
+Usage:
+    python -m CircleTrack.FigureRunner --figures fig1 fig3 --n-jobs 4
+    python -m CircleTrack.FigureRunner --panels fig1:N fig4:E --dry-run
+    python -m CircleTrack.FigureRunner --intermediates PV_corr_matrices
+"""
+import os
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+import re
+import json
+import time
+import inspect
+import hashlib
+import argparse
+import functools
+import traceback
+import pickle as pkl
+from datetime import datetime
+import matplotlib
+from joblib import Parallel, delayed
+from natsort import natsorted
+from CircleTrack.RecentReversal import RecentReversal, project_mice
+from CircleTrack.MiniscopeFunctions import CalciumSession
+from CircleTrack.SessionCollation import directory, db_fname
+from CircleTrack.sql import Database, artifact_files, hash_params
+from CircleTrack.utils import get_equivalent_local_path
+from util import write_atomic
+
+# Parameters of the ensemble trends used by the remodeling panels.
+trend_params = dict(
+    x="trial", x_bin_size=1, z_threshold=None, data_type="ensembles", alpha="sidak"
+)
+
+
+def compute_PV_corr_matrices(R, params):
+    return R.PV_corr_all_mice()
+
+
+def compute_assembly_trends(R, params):
+    return R.find_assembly_trends(session_types=R.meta["session_types"], **params)
+
+
+# Shared cohort-level results. methods are the RecentReversal methods
+# whose source code is part of the fingerprint.
+intermediates = {
+    "PV_corr_matrices": {
+        "compute": compute_PV_corr_matrices,
+        "params": None,
+        "methods": ["PV_corr_all_mice", "session_pairwise_PV_corr_efficient"],
+    },
+    "assembly_trends": {
+        "compute": compute_assembly_trends,
+        "params": trend_params,
+        "methods": ["find_assembly_trends", "find_activity_trends"],
+    },
+}
+
+# Intermediates and other panels ("figure", "panel") that a panel needs.
+panel_dependencies = {
+    ("fig1", "N"): ["PV_corr_matrices"],
+    ("fig3", "C"): ["assembly_trends"],
+    ("fig3", "D"): ["assembly_trends"],
+    ("fig4", "E"): [("sfig8", "A")],
+    ("fig5", "C"): ["assembly_trends"],
+    ("fig5", "D"): ["assembly_trends"],
+    ("sfig6", "A"): ["assembly_trends"],
+}
+
+
+def fingerprint(*parts):
+    return hashlib.sha1(
+        json.dumps(parts, sort_keys=True, default=str).encode()
+    ).hexdigest()[:16]
+
+
+@functools.lru_cache(maxsize=None)
+def method_source(name):
+    return inspect.getsource(inspect.unwrap(getattr(RecentReversal, name)))
+
+
+def called_methods(source):
+    """
+    RecentReversal methods that a piece of source code calls, directly
+    or through other RecentReversal methods.
+
+    """
+    pending, found = [source], set()
+    while pending:
+        for name in re.findall(r"self\.(\w+)\(", pending.pop()):
+            if name not in found and inspect.isfunction(
+                getattr(RecentReversal, name, None)
+            ):
+                found.add(name)
+                pending.append(method_source(name))
+
+    return sorted(found)
+
+
+def find_figures():
+    """
+    Names of the figures that RecentReversal can make, e.g. "fig1".
+
+    """
+    return natsorted(
+        name[len("make_") :]
+        for name in dir(RecentReversal)
+        if re.fullmatch(r"make_s?fig\d+", name)
+    )
+
+
+def find_panels(figure):
+    """
+    Split RecentReversal.make_<figure> into the panels it handles.
+
+    :return
+    ---
+    panels: dict
+        Source code of each panel block, keyed by panel letter. Figures
+        whose panels cannot be rendered one at a time are returned as a
+        single block keyed by None.
+    """
+    source = method_source(f"make_{figure}")
+    matches = list(re.finditer(r'^        if "([A-Z])" in panels:', source, re.M))
+    if not matches:
+        return {None: source}
+
+    ends = [match.start() for match in matches[1:]] + [len(source)]
+    return {
+        match.group(1): source[match.start() : end]
+        for match, end in zip(matches, ends)
+    }
+
+
+def panel_source(figure, panel):
+    """
+    Source code that renders a panel: the part of make_<figure> before
+    its first panel block (shared setup) and the panel's block.
+
+    """
+    panels = find_panels(figure)
+    if panel is None:
+        return panels[None]
+
+    source = method_source(f"make_{figure}")
+    preamble = source[: source.index(next(iter(panels.values())))]
+
+    return preamble + panels[panel]
+
+
+def unit_name(unit):
+    figure, panel = unit
+    return figure if panel is None else f"{figure}:{panel}"
+
+
+def render_panels(R, units, intermediate_paths):
+    """
+    Render panels in a worker process.
+
+    :parameters
+    ---
+    R: RecentReversal
+
+    units: list of (figure, panel) tuples
+        Panel None renders the whole figure.
+
+    intermediate_paths: dict
+        Cached intermediate pickles, keyed by (name, parameter hash).
+
+    :return
+    ---
+    results: list of dicts
+        Wall time and error for each panel.
+    """
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    for key, fpath in intermediate_paths.items():
+        if key not in R.intermediates:
+            with open(fpath, "rb") as file:
+                R.intermediates[key] = pkl.load(file)
+
+    results = []
+    for figure, panel in units:
+        start = time.perf_counter()
+        error = None
+        try:
+            getattr(R, f"make_{figure}")(panels=None if panel is None else [panel])
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            traceback.print_exc()
+        plt.close("all")
+
+        results.append(
+            {
+                "unit": unit_name((figure, panel)),
+                "wall_s": time.perf_counter() - start,
+                "error": error,
+            }
+        )
+
+    return results
+
+
+def compute_intermediate(R, name, fpath):
+    """
+    Compute an intermediate in a worker process and pickle it to fpath.
+
+    """
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    start = time.perf_counter()
+    info = intermediates[name]
+    result = info["compute"](R, info["params"])
+    plt.close("all")
+
+    def write(tmp_path):
+        with open(tmp_path, "wb") as file:
+            pkl.dump(result, file)
+
+    write_atomic(fpath, write)
+
+    return time.perf_counter() - start
+
+
+def load_intermediates(R, cache_folder):
+    """
+    Fill R.intermediates from a runner cache, e.g. to reuse cached
+    results in an interactive session.
+
+    """
+    manifest_path = os.path.join(cache_folder, "manifest.json")
+    with open(manifest_path, "r") as file:
+        manifest = json.load(file)
+
+    for name, entry in manifest["intermediates"].items():
+        key = (name, hash_params(intermediates[name]["params"]))
+        with open(entry["path"], "rb") as file:
+            R.intermediates[key] = pkl.load(file)
+
+    return R
+
+
+class FigureRunner:
+    def __init__(
+        self,
+        mice=None,
+        project_name="RemoteReversal",
+        save_path=None,
+        ext="pdf",
+        cache_folder=None,
+        n_jobs=1,
+        R=None,
+    ):
+        """
+        Render RecentReversal figure panels in parallel, rebuilding only
+        the panels whose inputs changed.
+
+        :parameters
+        ---
+        mice: list of str or None
+            Mice to include. Defaults to the whole cohort of the project.
+
+        project_name: str
+            Project in the session database.
+
+        save_path: str or None
+            Folder for the figures. Defaults to RecentReversal's.
+
+        ext: str
+            Figure file extension.
+
+        cache_folder: str or None
+            Folder for intermediates and the manifest. Defaults to a
+            .figure_cache folder inside save_path.
+
+        n_jobs: int
+            Number of worker processes.
+
+        R: RecentReversal or None
+            Already loaded data. If None, it is loaded only when
+            something needs to be rendered.
+        """
+        if save_path is None:
+            save_path = (
+                inspect.signature(RecentReversal).parameters["save_path"].default
+            )
+        if cache_folder is None:
+            cache_folder = os.path.join(save_path, ".figure_cache")
+        os.makedirs(cache_folder, exist_ok=True)
+
+        self.meta = {
+            "mice": project_mice[project_name] if mice is None else mice,
+            "project_name": project_name,
+            "save_path": save_path,
+            "ext": ext,
+            "cache_folder": cache_folder,
+            "n_jobs": n_jobs,
+            "manifest_path": os.path.join(cache_folder, "manifest.json"),
+        }
+        self.R = R
+        self.manifest = self.load_manifest()
+        self.fingerprints = dict()
+
+    def load_manifest(self):
+        try:
+            with open(self.meta["manifest_path"], "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {"intermediates": dict(), "panels": dict()}
+
+    def save_manifest(self):
+        def write(tmp_path):
+            with open(tmp_path, "w") as file:
+                json.dump(self.manifest, file, indent=2)
+
+        write_atomic(self.meta["manifest_path"], write)
+
+    def load(self):
+        if self.R is None:
+            self.R = RecentReversal(
+                self.meta["mice"],
+                project_name=self.meta["project_name"],
+                save_figs=True,
+                ext=self.meta["ext"],
+                save_path=self.meta["save_path"],
+            )
+
+        return self.R
+
+    def session_folders(self):
+        """
+        Session folders of the cohort and whether their pickles are kept
+        in the equivalent local folder (see CalciumSession.get_pkl_path()),
+        from the loaded data if available and otherwise from the session
+        database, where sessions load with CalciumSession's default.
+
+        :return
+        ---
+        folders: list of (str, bool) tuples
+        """
+        if self.R is not None:
+            return sorted(
+                (session.meta["folder"], session.meta["local"])
+                for mouse in self.meta["mice"]
+                for session_type, session in self.R.data[mouse].items()
+                if session_type != "CellReg"
+            )
+
+        local = inspect.signature(CalciumSession).parameters["local"].default
+        db = Database(directory, db_fname, read_only=True)
+        sql_str = """
+            SELECT session.path
+            FROM session
+            INNER JOIN mouse
+            ON mouse.id = session.mouse_id
+            INNER JOIN project
+            ON project.id = session.project_id
+            WHERE project_name = ? AND name IN ({})
+        """.format(
+            ", ".join("?" * len(self.meta["mice"]))
+        )
+        results = db.execute(
+            sql_str, (self.meta["project_name"], *self.meta["mice"])
+        )
+        db.connection.close()
+
+        return sorted((path, local) for (path,) in results)
+
+    def data_fingerprint(self):
+        """
+        Fingerprint of the cached session files (behavior, synced data,
+        place fields, assemblies) of the whole cohort, where the
+        sessions read them.
+
+        """
+        if "data" not in self.fingerprints:
+            stats = []
+            for session_folder, local in self.session_folders():
+                if local:
+                    pkl_folder = get_equivalent_local_path(session_folder)
+                else:
+                    pkl_folder = session_folder
+
+                for kind, fnames in artifact_files.items():
+                    # Behavior files stay in the session folder.
+                    folder = (
+                        session_folder if kind == "PreprocessedBehavior" else pkl_folder
+                    )
+                    for fname in fnames:
+                        fpath = os.path.join(folder, fname)
+                        if os.path.isfile(fpath):
+                            stat = os.stat(fpath)
+                            stats.append((fpath, stat.st_size, stat.st_mtime))
+
+            self.fingerprints["data"] = fingerprint(
+                self.meta["mice"], self.meta["project_name"], sorted(set(stats))
+            )
+
+        return self.fingerprints["data"]
+
+    def intermediate_fingerprint(self, name):
+        key = ("intermediate", name)
+        if key not in self.fingerprints:
+            info = intermediates[name]
+            self.fingerprints[key] = fingerprint(
+                self.data_fingerprint(),
+                hash_params(info["params"]),
+                [method_source(method) for method in info["methods"]],
+            )
+
+        return self.fingerprints[key]
+
+    def panel_fingerprint(self, unit):
+        key = ("panel", unit)
+        if key not in self.fingerprints:
+            figure, panel = unit
+            dependencies = [
+                self.intermediate_fingerprint(dependency)
+                if isinstance(dependency, str)
+                else self.panel_fingerprint(dependency)
+                for dependency in panel_dependencies.get(unit, [])
+            ]
+            source = panel_source(figure, panel)
+            self.fingerprints[key] = fingerprint(
+                source,
+                [method_source(method) for method in called_methods(source)],
+                self.data_fingerprint(),
+                self.meta["ext"],
+                dependencies,
+            )
+
+        return self.fingerprints[key]
+
+    def select(self, figures=None, panels=None):
+        """
+        Panels to consider, plus the panels they depend on.
+
+        :parameters
+        ---
+        figures: list of str or None
+            Figures to render, e.g. ["fig1", "sfig3"].
+
+        panels: list of str or None
+            Individual panels, e.g. ["fig1:N"]. If figures and panels
+            are both None, every panel of every figure is selected.
+
+        :return
+        ---
+        units: list of (figure, panel) tuples
+        """
+        if figures is None and panels is None:
+            figures = find_figures()
+
+        units = []
+        for figure in figures or []:
+            units.extend((figure, panel) for panel in find_panels(figure))
+        for name in panels or []:
+            figure, _, panel = name.partition(":")
+            if panel not in find_panels(figure):
+                raise KeyError(f"make_{figure} has no panel {panel}")
+            units.append((figure, panel))
+
+        # Add panels that selected panels depend on.
+        i = 0
+        while i < len(units):
+            for dependency in panel_dependencies.get(units[i], []):
+                if not isinstance(dependency, str) and dependency not in units:
+                    units.append(dependency)
+            i += 1
+
+        return list(dict.fromkeys(units))
+
+    def is_stale(self, unit):
+        entry = self.manifest["panels"].get(unit_name(unit))
+
+        return (
+            entry is None
+            or entry["error"] is not None
+            or entry["fingerprint"] != self.panel_fingerprint(unit)
+        )
+
+    def plan(self, units, force=False):
+        """
+        Panels that need to be rendered.
+
+        """
+        return [unit for unit in units if force or self.is_stale(unit)]
+
+    def build_intermediates(self, names, force=False):
+        """
+        Compute missing or outdated intermediates, in parallel.
+
+        :return
+        ---
+        paths: dict
+            Pickle of each intermediate, keyed by (name, parameter hash).
+        """
+        paths, to_build = dict(), []
+        for name in dict.fromkeys(names):
+            fpath = os.path.join(
+                self.meta["cache_folder"],
+                f"{name}_{self.intermediate_fingerprint(name)}.pkl",
+            )
+            paths[(name, hash_params(intermediates[name]["params"]))] = fpath
+            if force or not os.path.isfile(fpath):
+                to_build.append((name, fpath))
+
+        if to_build:
+            print(f"Computing {', '.join(name for name, _ in to_build)}")
+            R = self.load()
+            wall_times = Parallel(n_jobs=min(self.meta["n_jobs"], len(to_build)))(
+                delayed(compute_intermediate)(R, name, fpath)
+                for name, fpath in to_build
+            )
+
+            for (name, fpath), wall_s in zip(to_build, wall_times):
+                old_entry = self.manifest["intermediates"].get(name)
+                if old_entry is not None and old_entry["path"] != fpath:
+                    if os.path.isfile(old_entry["path"]):
+                        os.remove(old_entry["path"])
+
+                self.manifest["intermediates"][name] = {
+                    "fingerprint": self.intermediate_fingerprint(name),
+                    "path": fpath,
+                    "wall_s": wall_s,
+                    "datetime": datetime.now().isoformat(),
+                }
+            self.save_manifest()
+
+        return paths
+
+    def run(self, units, force=False):
+        """
+        Render the panels whose inputs changed. Panels that depend on
+        other panels are rendered after them.
+
+        :return
+        ---
+        results: list of dicts
+            Wall time and error for each rendered panel.
+        """
+        pending = self.plan(units, force=force)
+        if not pending:
+            print("All panels are up to date.")
+            return []
+
+        needed = [
+            dependency
+            for unit in pending
+            for dependency in panel_dependencies.get(unit, [])
+            if isinstance(dependency, str)
+        ]
+        intermediate_paths = self.build_intermediates(needed)
+        R = self.load()
+
+        results = []
+        while pending:
+            wave = [
+                unit
+                for unit in pending
+                if not any(
+                    dependency in pending
+                    for dependency in panel_dependencies.get(unit, [])
+                )
+            ]
+            if not wave:
+                raise ValueError("Circular panel dependencies.")
+
+            # One chunk per worker so that the data are only sent once
+            # to each process.
+            n_jobs = min(self.meta["n_jobs"], len(wave))
+            chunks = [wave[i::n_jobs] for i in range(n_jobs)]
+            print(f"Rendering {', '.join(unit_name(unit) for unit in wave)}")
+            if n_jobs == 1:
+                chunk_results = [render_panels(R, chunks[0], intermediate_paths)]
+            else:
+                chunk_results = Parallel(n_jobs=n_jobs)(
+                    delayed(render_panels)(R, chunk, intermediate_paths)
+                    for chunk in chunks
+                )
+
+            for chunk, chunk_result in zip(chunks, chunk_results):
+                for unit, result in zip(chunk, chunk_result):
+                    self.manifest["panels"][result["unit"]] = {
+                        "fingerprint": self.panel_fingerprint(unit),
+                        "wall_s": result["wall_s"],
+                        "datetime": datetime.now().isoformat(),
+                        "error": result["error"],
+                    }
+                    results.append(result)
+            self.save_manifest()
+
+            pending = [unit for unit in pending if unit not in wave]
+
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--figures", nargs="+", help="e.g. fig1 sfig3.")
+    parser.add_argument("--panels", nargs="+", help="e.g. fig1:N fig4:E.")
+    parser.add_argument("--intermediates", nargs="+", choices=list(intermediates),
+                        help="Also compute these intermediates into the cache.")
+    parser.add_argument("--mice", nargs="+")
+    parser.add_argument("--project", default="RemoteReversal")
+    parser.add_argument("--save-path", help="Figure folder.")
+    parser.add_argument("--ext", default="pdf")
+    parser.add_argument("--cache-folder")
+    parser.add_argument("--n-jobs", type=int, default=1)
+    parser.add_argument("--force", action="store_true", help="Render every selected panel.")
+    parser.add_argument("--dry-run", action="store_true", help="Only list outdated panels.")
+    parser.add_argument("--list", action="store_true", help="List available panels.")
+    args = parser.parse_args()
+
+    if args.list:
+        for figure in find_figures():
+            panels = [panel for panel in find_panels(figure) if panel is not None]
+            print(f"{figure}: {' '.join(panels) if panels else '(whole figure)'}")
+        return
+
+    runner = FigureRunner(
+        mice=args.mice,
+        project_name=args.project,
+        save_path=args.save_path,
+        ext=args.ext,
+        cache_folder=args.cache_folder,
+        n_jobs=args.n_jobs,
+    )
+    units = runner.select(figures=args.figures, panels=args.panels)
+    if args.intermediates and not args.dry_run:
+        runner.build_intermediates(args.intermediates, force=args.force)
+        if args.figures is None and args.panels is None:
+            return
+
+    if args.dry_run:
+        pending = runner.plan(units, force=args.force)
+        print(f"{len(pending)} of {len(units)} panels are outdated:")
+        for unit in pending:
+            print(f"    {unit_name(unit)}")
+        return
+
+    results = runner.run(units, force=args.force)
+    failed = [result for result in results if result["error"] is not None]
+    for result in results:
+        status = result["error"] or f"{result['wall_s']:.1f} s"
+        print(f"{result['unit']}: {status}")
+    if failed:
+        print(f"{len(failed)} panel(s) failed.")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
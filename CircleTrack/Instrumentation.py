@@ -0,0 +1,251 @@
+import os
+import sys
+import json
+import time
+import inspect
+import functools
+from contextlib import contextmanager
+import pandas as pd
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Instrumentation is off unless enabled here or through the
+# CIRCLETRACK_INSTRUMENT environment variable ("1" or a log path).
+settings = {"enabled": False, "log_path": None}
+records = []
+open_stages = []
+
+
+def enable(log_path=None):
+    """
+    Start recording stages.
+
+    :parameter
+    ---
+    log_path: str or None
+        If provided, each record is also appended to this file as a
+        line of JSON.
+    """
+    settings["enabled"] = True
+    settings["log_path"] = log_path
+
+
+def disable():
+    settings["enabled"] = False
+
+
+def clear():
+    """
+    Forget all recorded stages.
+
+    """
+    del records[:]
+
+
+def memory_usage():
+    """
+    Current and peak resident set size of this process (MB). Peak RSS
+    is None if it is not available on this platform.
+
+    """
+    current, peak = None, None
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        current = info.rss / 1e6
+        if hasattr(info, "peak_wset"):
+            peak = info.peak_wset / 1e6
+
+    if peak is None and resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Bytes on macOS, kilobytes on Linux.
+        peak = maxrss / 1e6 if sys.platform == "darwin" else maxrss / 1e3
+
+    return current, peak
+
+
+def difference(after, before):
+    return None if after is None or before is None else after - before
+
+
+class Stage:
+    def __init__(self, name, tags):
+        """
+        One timed stage. Set cache to "hit" or "miss" when the stage
+        loads or rebuilds a cached file.
+
+        """
+        self.name = name
+        self.tags = tags
+        self.cache = None
+
+
+@contextmanager
+def stage(name, **tags):
+    """
+    Record the wall time, CPU time, RSS change, and cache hit/miss of
+    a block of code. Tags (e.g., mouse and session) are inherited by
+    nested stages. Does nothing when instrumentation is disabled.
+
+    Usage:
+        with stage("Placefields", session=session_type) as s:
+            ...
+            s.cache = "hit"
+
+    :parameters
+    ---
+    name: str
+        Stage name.
+
+    tags: str
+        Tags such as mouse and session.
+    """
+    if not settings["enabled"]:
+        yield Stage(name, tags)
+        return
+
+    parent = open_stages[-1] if open_stages else None
+    if parent is not None:
+        tags = {**parent.tags, **tags}
+    this_stage = Stage(name, tags)
+    open_stages.append(this_stage)
+
+    rss, peak_rss = memory_usage()
+    start, wall, cpu = time.time(), time.perf_counter(), time.process_time()
+    error = None
+    try:
+        yield this_stage
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        rss_after, peak_rss_after = memory_usage()
+        open_stages.pop()
+
+        record = {
+            "stage": name,
+            **{key: str(value) for key, value in this_stage.tags.items()},
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "rss_delta_mb": difference(rss_after, rss),
+            "peak_rss_delta_mb": difference(peak_rss_after, peak_rss),
+            "cache": this_stage.cache,
+            "depth": len(open_stages),
+            "parent": parent.name if parent is not None else None,
+            "start": start,
+            "error": error,
+        }
+        records.append(record)
+
+        if settings["log_path"] is not None:
+            with open(settings["log_path"], "a") as file:
+                file.write(json.dumps(record) + "\n")
+
+
+def instrumented(func=None, name=None, tag_args=("mouse", "session_type")):
+    """
+    Decorator that records each call of a function as a stage. String
+    arguments named in tag_args become tags (session_type is tagged
+    as session).
+
+    """
+    if func is None:
+        return functools.partial(instrumented, name=name, tag_args=tag_args)
+
+    signature = inspect.signature(func)
+    stage_name = func.__qualname__ if name is None else name
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not settings["enabled"]:
+            return func(*args, **kwargs)
+
+        arguments = signature.bind_partial(*args, **kwargs).arguments
+        tags = {
+            ("session" if arg == "session_type" else arg): arguments[arg]
+            for arg in tag_args
+            if isinstance(arguments.get(arg), str)
+        }
+        with stage(stage_name, **tags):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def instrument_methods(cls, exclude=()):
+    """
+    Record every call to the public methods of a class.
+
+    """
+    for attr, value in list(vars(cls).items()):
+        if attr.startswith("_") or attr in exclude or not inspect.isfunction(value):
+            continue
+
+        setattr(cls, attr, instrumented(value))
+
+    return cls
+
+
+def load_log(log_path):
+    """
+    Read a structured log written with enable(log_path).
+
+    """
+    return pd.read_json(log_path, lines=True)
+
+
+def summary(df=None, by="stage"):
+    """
+    Summarize recorded stages.
+
+    :parameters
+    ---
+    df: DataFrame or None
+        Records, e.g. from load_log(). If None, uses the records of
+        this process.
+
+    by: str or list of str
+        Column(s) to group by, e.g. "stage" or ["stage", "mouse"].
+
+    :return
+    ---
+    table: DataFrame
+        Number of calls, total and mean wall time, total CPU time,
+        largest peak RSS increase and cache hits/misses, sorted by
+        total wall time.
+    """
+    if df is None:
+        df = pd.DataFrame(records)
+    if df.empty:
+        return df
+
+    table = df.groupby(by).agg(
+        calls=("wall_s", "size"),
+        wall_s=("wall_s", "sum"),
+        mean_wall_s=("wall_s", "mean"),
+        cpu_s=("cpu_s", "sum"),
+        max_peak_rss_delta_mb=("peak_rss_delta_mb", "max"),
+        hits=("cache", lambda cache: (cache == "hit").sum()),
+        misses=("cache", lambda cache: (cache == "miss").sum()),
+        errors=("error", lambda error: error.notna().sum()),
+    )
+
+    return table.sort_values("wall_s", ascending=False)
+
+
+def print_summary(df=None, by="stage"):
+    print(summary(df, by=by).to_string(float_format="%.2f"))
+
+
+if os.environ.get("CIRCLETRACK_INSTRUMENT"):
+    value = os.environ["CIRCLETRACK_INSTRUMENT"]
+    enable(None if value == "1" else value)
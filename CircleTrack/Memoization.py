@@ -0,0 +1,249 @@
+import sys
+import copy
+import inspect
+import hashlib
+import functools
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from CircleTrack.Instrumentation import open_stages
+
+
+class Uncacheable(Exception):
+    pass
+
+
+def normalize(value):
+    """
+    Convert an argument into a hashable value for a cache key.
+    Raises Uncacheable for arguments that cannot be compared safely
+    (e.g., classifier objects or large arrays).
+
+    """
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return tuple(normalize(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return ("set", tuple(sorted(normalize(item) for item in value)))
+    if isinstance(value, dict):
+        return (
+            "dict",
+            tuple(sorted((key, normalize(item)) for key, item in value.items())),
+        )
+    if isinstance(value, np.ndarray) and value.nbytes <= 1e6:
+        return (
+            "ndarray",
+            value.shape,
+            str(value.dtype),
+            hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest(),
+        )
+
+    raise Uncacheable
+
+
+def nbytes(obj, seen=None):
+    """
+    Approximate memory footprint of a cached result (bytes).
+
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if isinstance(obj, np.ndarray):
+        size = obj.nbytes
+        if obj.dtype == object:
+            size += sum(nbytes(item, seen) for item in obj.flat)
+        return size
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return int(np.sum(obj.memory_usage(deep=True)))
+    if hasattr(obj, "values") and isinstance(getattr(obj, "values"), np.ndarray):
+        # e.g., xarray.DataArray.
+        return nbytes(obj.values, seen)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(
+            nbytes(key, seen) + nbytes(value, seen) for key, value in obj.items()
+        )
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + sum(nbytes(item, seen) for item in obj)
+
+    return sys.getsizeof(obj)
+
+
+class MethodCache:
+    def __init__(self, max_mb=1024, copy_results=True):
+        """
+        Bounded least-recently-used cache for the results of analysis
+        methods, keyed on (method, arguments).
+
+        :parameters
+        ---
+        max_mb: float
+            Memory budget. The least recently used results are evicted
+            when it is exceeded. 0 disables the cache.
+
+        copy_results: boolean
+            Return copies of cached results so that callers that modify
+            them in place cannot change what later calls get.
+        """
+        self.meta = {"max_mb": max_mb, "copy_results": copy_results}
+        self.entries = OrderedDict()
+        self.sizes = dict()
+        self.counts = dict()
+
+    def __getstate__(self):
+        # Don't send cached results along with the object (e.g., to
+        # joblib workers).
+        state = self.__dict__.copy()
+        state["entries"], state["sizes"] = OrderedDict(), dict()
+
+        return state
+
+    @property
+    def size_mb(self):
+        return sum(self.sizes.values()) / 1e6
+
+    def count(self, method, event):
+        if method not in self.counts:
+            self.counts[method] = {"hits": 0, "misses": 0, "evictions": 0, "uncached": 0}
+        self.counts[method][event] += 1
+
+    def get(self, key):
+        """
+        Get a cached result and mark it as recently used.
+
+        :return
+        ---
+        found: boolean
+
+        result: object or None
+        """
+        if key not in self.entries:
+            self.count(key[0], "misses")
+            return False, None
+
+        self.entries.move_to_end(key)
+        self.count(key[0], "hits")
+        result = self.entries[key]
+
+        return True, copy.deepcopy(result) if self.meta["copy_results"] else result
+
+    def put(self, key, result):
+        """
+        Store a result, evicting the least recently used ones to stay
+        within budget. Results larger than the budget are not stored.
+
+        """
+        size = nbytes(result)
+        if size / 1e6 > self.meta["max_mb"]:
+            return
+
+        self.entries[key] = copy.deepcopy(result) if self.meta["copy_results"] else result
+        self.sizes[key] = size
+        while self.size_mb > self.meta["max_mb"]:
+            old_key, _ = self.entries.popitem(last=False)
+            del self.sizes[old_key]
+            self.count(old_key[0], "evictions")
+
+    def clear(self, method=None):
+        """
+        Forget cached results, either all or those of one method.
+
+        """
+        for key in [key for key in self.entries if method in (None, key[0])]:
+            del self.entries[key]
+            del self.sizes[key]
+
+    def stats(self):
+        """
+        Cache statistics per method.
+
+        :return
+        ---
+        df: DataFrame
+            Hits, misses, evictions, calls that could not be cached,
+            number of stored results and their size (MB).
+        """
+        rows = []
+        for method, counts in self.counts.items():
+            keys = [key for key in self.entries if key[0] == method]
+            rows.append(
+                {
+                    "method": method,
+                    **counts,
+                    "entries": len(keys),
+                    "mb": sum(self.sizes[key] for key in keys) / 1e6,
+                }
+            )
+
+        return pd.DataFrame(
+            rows,
+            columns=["method", "hits", "misses", "evictions", "uncached", "entries", "mb"],
+        ).set_index("method")
+
+
+def memoized(func=None, ignore=(), bypass=None):
+    """
+    Cache the results of a method in the instance's MethodCache
+    (self.memo). Methods of instances without one are called as usual.
+
+    :parameters
+    ---
+    ignore: tuple of str
+        Arguments that do not change the result.
+
+    bypass: dict or None
+        Argument values that make the call run uncached, e.g.
+        {"show_plot": True} for calls with plotting side effects.
+        Values are compared by equality, so 1 or np.True_ also match.
+    """
+    if func is None:
+        return functools.partial(memoized, ignore=ignore, bypass=bypass)
+
+    signature = inspect.signature(func)
+    bypass = bypass or dict()
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        memo = getattr(self, "memo", None)
+        if memo is None or memo.meta["max_mb"] <= 0:
+            return func(self, *args, **kwargs)
+
+        arguments = signature.bind(self, *args, **kwargs)
+        arguments.apply_defaults()
+        arguments = dict(list(arguments.arguments.items())[1:])
+        try:
+            if any(
+                normalize(arguments.get(arg)) == normalize(value)
+                for arg, value in bypass.items()
+            ):
+                raise Uncacheable
+            key = (
+                func.__name__,
+                tuple(
+                    (arg, normalize(value))
+                    for arg, value in arguments.items()
+                    if arg not in ignore
+                ),
+            )
+        except Uncacheable:
+            memo.count(func.__name__, "uncached")
+            return func(self, *args, **kwargs)
+
+        found, result = memo.get(key)
+        if open_stages:
+            open_stages[-1].cache = "hit" if found else "miss"
+        if found:
+            return result
+
+        result = func(self, *args, **kwargs)
+        memo.put(key, result)
+
+        return result
+
+    return wrapper
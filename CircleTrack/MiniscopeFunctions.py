@@ -1,37 +1,78 @@
 from CircleTrack.BehaviorFunctions import BehaviorSession
+from CircleTrack.Instrumentation import stage
+from CircleTrack.sql import log_artifact
 import matplotlib.pyplot as plt
 import numpy as np
 from CaImaging.util import nan_array, ScrollPlot, \
     sync_cameras_v4
 from CaImaging.Miniscope import get_transient_timestamps, \
     nan_corrupted_frames
-from util import Session_Metadata, find_timestamp_file
+from util import Session_Metadata, find_timestamp_file, load_holoviews
 from CircleTrack.BehaviorFunctions import linearize_trajectory, make_tracking_video
 from CircleTrack.plotting import plot_spiral, plot_raster, spiral_plot
 from CaImaging.PlaceFields import PlaceFields, define_field_bins
 from CaImaging.Behavior import spatial_bin
-import holoviews as hv
 import os
+import time
 import pickle as pkl
 from matplotlib import gridspec
 from CaImaging.Assemblies import (
-    find_assemblies,
     preprocess_multiple_sessions,
     membership_sort,
     plot_assemblies,
 )
-from CircleTrack.utils import sync, get_equivalent_local_path, find_reward_spatial_bins
+from CircleTrack.utils import (
+    sync,
+    get_equivalent_local_path,
+    find_reward_spatial_bins,
+    float_dtype,
+    cast_floats,
+    position_indicator,
+    bin_activity,
+)
 from CircleTrack.Assemblies import (
-    write_assembly_triggered_movie,
+    write_assembly_triggered_movies,
     plot_assembly,
     find_members,
+    detect_assemblies,
 )
-
-hv.extension("bokeh")
 from itertools import product
 from scipy.stats import spearmanr, zscore
 
 
+# CalciumSession arguments that force each artifact to be rebuilt.
+artifact_overwrite_flags = {
+    "SyncedData": "overwrite_synced_data",
+    "Placefields": "overwrite_placefields",
+    "PlacefieldTrials": "overwrite_placefield_trials",
+    "Assemblies": "overwrite_assemblies",
+}
+
+
+def artifact_params(spatial_bin_size_radians=0.05, velocity_threshold=7, **kwargs):
+    """
+    Parameters that each CalciumSession artifact is built with, as
+    recorded in the session database (see sql.log_artifact()). Takes
+    the same keyword arguments as CalciumSession.
+
+    :return
+    ---
+    params: dict
+        {artifact kind: parameters}
+    """
+    placefield_params = {
+        "bin_size": spatial_bin_size_radians,
+        "velocity_threshold": velocity_threshold,
+    }
+
+    return {
+        "SyncedData": {},
+        "Placefields": placefield_params,
+        "PlacefieldTrials": placefield_params,
+        "Assemblies": {"n_shuffles": 500, "smoothing": 5},
+    }
+
+
 class CalciumSession:
     def __init__(
         self,
@@ -46,6 +87,7 @@ class CalciumSession:
         overwrite_placefield_trials=False,
         overwrite_assemblies=False,
         local=True,
+        precision="float64",
     ):
         """
         Single session analyses and plots for miniscope data.
@@ -53,6 +95,12 @@ class CalciumSession:
         :parameter
         session_folder: str
             Session minian_folder.
+
+        precision: str
+            "float64" or "float32". In float32 mode, calcium traces,
+            place fields, rasters and assembly activations are kept as
+            float32 in memory. Saved files are built the same way in
+            both modes.
         """
         # Get the metadata.
         self.meta = {
@@ -61,43 +109,54 @@ class CalciumSession:
             "S_std_thresh": S_std_thresh,
             "threshold": velocity_threshold,
             "local": local,
+            "dtype": float_dtype(precision),
         }
+        params = artifact_params(spatial_bin_size_radians, velocity_threshold)
 
         #############################################
         # Get the synced behavior and calcium imaging data.
         fpath = self.get_pkl_path("SyncedData.pkl")
 
-        try:
-            if overwrite_synced_data:
-                print(f"Overwriting {fpath}.")
-                raise Exception
-            with open(fpath, "rb") as file:
-                (self.behavior, self.imaging) = pkl.load(file)
-
-            self.meta["paths"] = self.behavior.meta["paths"]
-        except:
-            self.behavior = BehaviorSession(self.meta["folder"])
-
-            # Get paths
-            self.meta["paths"] = self.behavior.meta["paths"]
-            if not self.meta["paths"]["minian"]:
-                meta = Session_Metadata(session_folder, overwrite=True)
-                self.meta["paths"]["minian"] = meta.meta_dict["minian"]
-            timestamp_paths = self.meta["paths"]["timestamps"]
-
-            # Combine behavioral and calcium imaging data.
-            self.behavior.data["df"], self.imaging = sync(
-                self.meta["paths"]["minian"], self.behavior.data["df"], timestamp_paths
-            )
+        with stage("SyncedData") as s:
+            try:
+                if overwrite_synced_data:
+                    print(f"Overwriting {fpath}.")
+                    raise Exception
+                with open(fpath, "rb") as file:
+                    (self.behavior, self.imaging) = pkl.load(file)
+
+                self.meta["paths"] = self.behavior.meta["paths"]
+                s.cache = "hit"
+            except:
+                s.cache = "miss"
+                start = time.perf_counter()
+                self.behavior = BehaviorSession(self.meta["folder"])
+
+                # Get paths
+                self.meta["paths"] = self.behavior.meta["paths"]
+                if not self.meta["paths"]["minian"]:
+                    meta = Session_Metadata(session_folder, overwrite=True)
+                    self.meta["paths"]["minian"] = meta.meta_dict["minian"]
+                timestamp_paths = self.meta["paths"]["timestamps"]
+
+                # Combine behavioral and calcium imaging data.
+                self.behavior.data["df"], self.imaging = sync(
+                    self.meta["paths"]["minian"], self.behavior.data["df"], timestamp_paths
+                )
 
-            self.imaging["C"], self.imaging["S"] = self.nan_bad_frames()
+                self.imaging["C"], self.imaging["S"] = self.nan_bad_frames()
 
-            # Redo trial counting to account in case some frames got cut
-            # from behavior (e.g. because a miniscope video got truncated).
-            self.behavior.data["ntrials"] = max(self.behavior.data["df"]["trials"] + 1)
+                # Redo trial counting to account in case some frames got cut
+                # from behavior (e.g. because a miniscope video got truncated).
+                self.behavior.data["ntrials"] = max(self.behavior.data["df"]["trials"] + 1)
 
-            with open(fpath, "wb") as file:
-                pkl.dump((self.behavior, self.imaging), file)
+                with open(fpath, "wb") as file:
+                    pkl.dump((self.behavior, self.imaging), file)
+                log_artifact(
+                    self.meta["folder"], "SyncedData", fpath,
+                    params=params["SyncedData"],
+                    duration=time.perf_counter() - start,
+                )
 
         (
             self.imaging["spike_times"],
@@ -112,89 +171,116 @@ class CalciumSession:
         # Get place fields.
         fpath = self.get_pkl_path("Placefields.pkl")
         rerun_placefield_trials = False
-        try:
-            if overwrite_placefields:
-                print(f"Overwriting {fpath}.")
-                raise Exception
-
-            with open(fpath, "rb") as file:
-                self.spatial = pkl.load(file)
-
-            parameters_match = [
-                self.spatial.meta["bin_size"] == spatial_bin_size_radians,
-                self.spatial.meta["velocity_threshold"] == velocity_threshold,
-            ]
-
-            if not all(parameters_match):
-                print("A placefield parameter does not match saved data, rerunning.")
-                rerun_placefield_trials = True
-                raise Exception
-
-        except:
-            self.spatial = PlaceFields(
-                np.asarray(self.behavior.data["df"]["t"]),
-                np.asarray(self.behavior.data["df"]["x"]),
-                np.asarray(self.behavior.data["df"]["y"]),
-                self.imaging["S"],
-                bin_size=self.meta["spatial_bin_size"],
-                circular=True,
-                fps=self.behavior.meta["fps"],
-                shuffle_test=True,
-                velocity_threshold=velocity_threshold,
-            )
-
-            with open(fpath, "wb") as file:
-                pkl.dump(self.spatial, file)
+        with stage("Placefields") as s:
+            try:
+                if overwrite_placefields:
+                    print(f"Overwriting {fpath}.")
+                    raise Exception
+
+                with open(fpath, "rb") as file:
+                    self.spatial = pkl.load(file)
+
+                parameters_match = [
+                    self.spatial.meta["bin_size"] == spatial_bin_size_radians,
+                    self.spatial.meta["velocity_threshold"] == velocity_threshold,
+                ]
+
+                if not all(parameters_match):
+                    print("A placefield parameter does not match saved data, rerunning.")
+                    rerun_placefield_trials = True
+                    raise Exception
+                s.cache = "hit"
+            except:
+                s.cache = "miss"
+                start = time.perf_counter()
+                self.spatial = PlaceFields(
+                    np.asarray(self.behavior.data["df"]["t"]),
+                    np.asarray(self.behavior.data["df"]["x"]),
+                    np.asarray(self.behavior.data["df"]["y"]),
+                    self.imaging["S"],
+                    bin_size=self.meta["spatial_bin_size"],
+                    circular=True,
+                    fps=self.behavior.meta["fps"],
+                    shuffle_test=True,
+                    velocity_threshold=velocity_threshold,
+                )
+
+                with open(fpath, "wb") as file:
+                    pkl.dump(self.spatial, file)
+                log_artifact(
+                    self.meta["folder"], "Placefields", fpath,
+                    params=params["Placefields"],
+                    duration=time.perf_counter() - start,
+                )
 
             #############################################
         # Get spatial activity by trial.
         fpath = self.get_pkl_path("PlacefieldTrials.pkl")
-        try:
-            if overwrite_placefield_trials or rerun_placefield_trials:
-                print(f"Overwriting {fpath}")
-                raise Exception
+        with stage("PlacefieldTrials") as s:
+            try:
+                if overwrite_placefield_trials or rerun_placefield_trials:
+                    print(f"Overwriting {fpath}")
+                    raise Exception
 
-            with open(fpath, "rb") as file:
-                (
-                    self.spatial.data["rasters"],
-                    self.spatial.data["trial_occupancy"],
-                ) = pkl.load(file)
-        except:
-            (
-                self.spatial.data["rasters"],
-                self.spatial.data["trial_occupancy"],
-            ) = self.spatial_activity_by_trial()
-
-            with open(fpath, "wb") as file:
-                pkl.dump(
+                with open(fpath, "rb") as file:
                     (
                         self.spatial.data["rasters"],
                         self.spatial.data["trial_occupancy"],
-                    ),
-                    file,
+                    ) = pkl.load(file)
+                s.cache = "hit"
+            except:
+                s.cache = "miss"
+                start = time.perf_counter()
+                (
+                    self.spatial.data["rasters"],
+                    self.spatial.data["trial_occupancy"],
+                ) = self.spatial_activity_by_trial()
+
+                with open(fpath, "wb") as file:
+                    pkl.dump(
+                        (
+                            self.spatial.data["rasters"],
+                            self.spatial.data["trial_occupancy"],
+                        ),
+                        file,
+                    )
+                log_artifact(
+                    self.meta["folder"], "PlacefieldTrials", fpath,
+                    params=params["PlacefieldTrials"],
+                    duration=time.perf_counter() - start,
                 )
 
             #############################################
         # Get assemblies.
         fpath = self.get_pkl_path("Assemblies.pkl")
-        try:
-            if overwrite_assemblies:
-                print(f"Overwriting {fpath}")
-                raise Exception
-            with open(fpath, "rb") as file:
-                self.assemblies = pkl.load(file)
-
-        except:
-            processed_for_assembly_detection = preprocess_multiple_sessions(
-                [self.imaging["S"]], smooth_factor=5, use_bool=True
-            )
-            data = processed_for_assembly_detection["processed"][0]
-            self.assemblies = find_assemblies(
-                data, nullhyp="circ", plot=False, n_shuffles=500
-            )
-
-            with open(fpath, "wb") as file:
-                pkl.dump(self.assemblies, file)
+        with stage("Assemblies") as s:
+            try:
+                if overwrite_assemblies:
+                    print(f"Overwriting {fpath}")
+                    raise Exception
+                with open(fpath, "rb") as file:
+                    self.assemblies = pkl.load(file)
+                s.cache = "hit"
+            except:
+                s.cache = "miss"
+                start = time.perf_counter()
+                processed_for_assembly_detection = preprocess_multiple_sessions(
+                    [self.imaging["S"]], smooth_factor=5, use_bool=True
+                )
+                data = processed_for_assembly_detection["processed"][0]
+                self.assemblies = detect_assemblies(
+                    data,
+                    **params["Assemblies"],
+                    cache_path=self.get_pkl_path("AssemblyNulls.pkl"),
+                )
+
+                with open(fpath, "wb") as file:
+                    pkl.dump(self.assemblies, file)
+                log_artifact(
+                    self.meta["folder"], "Assemblies", fpath,
+                    params=params["Assemblies"],
+                    duration=time.perf_counter() - start,
+                )
 
         if place_cell_transient_threshold == 'n_trials':
             place_cell_transient_threshold = self.behavior.data['ntrials']
@@ -203,6 +289,27 @@ class CalciumSession:
         self.spatial.meta['place_cell_pval'] = place_cell_alpha
         self.spatial.meta['place_cell_transient_threshold'] = place_cell_transient_threshold
 
+        self.set_precision(self.meta["dtype"])
+
+    def set_precision(self, dtype):
+        """
+        Cast calcium traces, place fields, rasters and assembly
+        activations to a floating point dtype, in memory only.
+
+        :parameter
+        ---
+        dtype: numpy dtype
+            e.g., np.float32.
+        """
+        self.meta["dtype"] = np.dtype(dtype)
+        cast_floats(self.imaging, dtype, keys=["C", "S", "S_binary"])
+        cast_floats(
+            self.spatial.data,
+            dtype,
+            keys=["placefields", "placefields_normalized", "rasters", "trial_occupancy"],
+        )
+        cast_floats(self.assemblies, dtype, keys=["activations", "patterns"])
+
     def get_pkl_path(self, fname):
         if self.meta["local"]:
             local_path = get_equivalent_local_path(self.meta["folder"])
@@ -386,40 +493,23 @@ class CalciumSession:
         # Threshold S matrix here.
         S = self.imaging["S_binary"]
 
-        # For each trial, spatial bin position weighted by S.
-        occ_map_by_trial = []
-        fields = nan_array(
-            (
-                self.imaging["n_neurons"],
-                self.behavior.data["ntrials"],
-                len(bin_edges) - 1,
-            )
+        # For each trial, spatial bin position weighted by S, using
+        # one (frame, trial x bin) indicator matrix for all neurons.
+        n_trials = self.behavior.data["ntrials"]
+        indicator = position_indicator(
+            lin_position,
+            bin_edges,
+            trials=np.asarray(behavior_df["trials"]),
+            n_trials=n_trials,
+            mask=running,
         )
-        for trial_number in range(self.behavior.data["ntrials"]):
-            time_bins = behavior_df["trials"] == trial_number
-            positions_this_trial = behavior_df.loc[time_bins, "lin_position"]
-            filler = np.zeros_like(positions_this_trial)
-            running_this_trial = running[time_bins]
-
-            # Get occupancy this trial.
-            occupancy = spatial_bin(
-                positions_this_trial, filler, bins=bin_edges, one_dim=True,
-                weights=running_this_trial.astype(int)
-            )[0]
-
-            # Weight position by activity of each neuron.
-            for n, neuron in enumerate(S):
-                spiking = (neuron[time_bins] * running_this_trial).astype(int)
-                fields[n, trial_number, :] = spatial_bin(
-                    positions_this_trial,
-                    filler,
-                    bins=bin_edges,
-                    one_dim=True,
-                    weights=spiking,
-                )[0]
-
-            occ_map_by_trial.append(occupancy)
-        occ_map_by_trial = np.vstack(occ_map_by_trial)
+        dtype = self.meta.get("dtype", np.float64)
+        fields = bin_activity(S, indicator, n_trials=n_trials, dtype=dtype)
+
+        # Get occupancy for each trial.
+        occ_map_by_trial = bin_activity(
+            np.ones(len(lin_position)), indicator, n_trials=n_trials
+        )[0]
 
         return fields, occ_map_by_trial
 
@@ -532,6 +622,7 @@ class CalciumSession:
             registered across days and serves as a global index for
             Holomap to access.
         """
+        hv = load_holoviews()
         fields = self.spatial_activity_by_trial()[0]
 
         if preserve_neuron_idx:
@@ -575,17 +666,37 @@ class CalciumSession:
         return corr_matrix
 
     def write_assembly_activation_movie(self, assembly_number, threshold=2):
-        assembly_activations = self.assemblies["activations"][assembly_number]
+        self.write_assembly_activation_movies([assembly_number], threshold=threshold)
+
+    def write_assembly_activation_movies(self, assembly_numbers=None, threshold=2):
+        """
+        Write one assembly-triggered movie per assembly, decoding the
+        behavior video once for all of them.
+
+        :parameters
+        ---
+        assembly_numbers: list of ints or None
+            Assemblies to write. If None, writes all of them.
+
+        threshold: float
+            z-scored activation above which frames are written.
+        """
+        if assembly_numbers is None:
+            assembly_numbers = range(len(self.assemblies["activations"]))
+        assembly_activations = self.assemblies["activations"][list(assembly_numbers)]
         behavior_frame_numbers = self.behavior.data["df"]["frame"].to_numpy()
         movie_fname = self.meta["paths"]["BehaviorVideo"]
         trials = self.behavior.data["df"]["trials"].to_numpy()
 
-        fpath = os.path.join(self.meta["folder"], f"Assembly #{assembly_number}.avi")
-        write_assembly_triggered_movie(
+        fpaths = [
+            os.path.join(self.meta["folder"], f"Assembly #{assembly_number}.avi")
+            for assembly_number in assembly_numbers
+        ]
+        write_assembly_triggered_movies(
             assembly_activations,
             behavior_frame_numbers,
             movie_fname,
-            fpath=fpath,
+            fpaths,
             threshold=threshold,
             trials=trials,
         )
@@ -699,7 +810,7 @@ class CalciumSession:
             self.assemblies["activations"], sorted_spiking, colors=sorted_colors
         )
 
-    def sync_behavior_movie(self, miniscope_vids=(40, 43)):
+    def sync_behavior_movie(self, miniscope_vids=(40, 43), n_jobs=1):
         """
         Concatenates frames in the behavior video to be synchronous with
         the specified miniscope videos.
@@ -710,6 +821,9 @@ class CalciumSession:
             The miniscope video numbers that the behavior movie will be
             synchronized with. Doesn't include the second value.
 
+        n_jobs: int
+            Number of worker processes for writing the video.
+
         """
         timestamp_fpath = self.meta['paths']['timestamps']
         miniscope_file = find_timestamp_file(timestamp_fpath, "Miniscope")
@@ -723,7 +837,8 @@ class CalciumSession:
         make_tracking_video(self.meta['folder'],
                             output_fname=f'{miniscope_vids[0]}_{miniscope_vids[1]}.avi',
                             frames=frames,
-                            fps=60)
+                            fps=60,
+                            n_jobs=n_jobs)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,9 @@
 import numpy as np
 from CircleTrack.SessionCollation import MultiAnimal
 from CircleTrack.BehaviorFunctions import BehaviorSession
+from CircleTrack.BehaviorPerformance import PerformanceStore
 import matplotlib.pyplot as plt
-import xarray as xr
-from CaImaging.util import nan_array, sem
-import pandas as pd
+from CaImaging.util import sem
 from CaImaging.plotting import errorfill, beautify_ax, jitter_x
 import matplotlib.patches as mpatches
 
@@ -75,6 +74,13 @@ class PSAM:
             "vehicle": [mouse for mouse in self.meta["mice"] if mouse not in PSEM_mice],
         }
 
+        # Behavioral performance of the whole cohort, computed on demand.
+        self.performance = PerformanceStore(
+            lambda mouse, session_type: self.data[mouse][session_type],
+            {inj: self.meta["grouped_mice"][inj] for inj in PSAM_groups},
+            self.meta["session_types"],
+        )
+
     def plot_all_behavior(
             self,
             window=6,
@@ -84,71 +90,14 @@ class PSAM:
             show_plot=True,
             trial_limit=None,
     ):
-        # Preallocate array.
-        behavioral_performance_arr = np.zeros(
-            (3, len(self.meta["mice"]), len(self.meta["session_types"])),
-            dtype=object,
+        kwargs = dict(window=window, strides=strides, trial_limit=trial_limit)
+        behavioral_performance = self.performance.to_xarray(
+            mice=self.meta["mice"], **kwargs
         )
-        categories = ["hits", "CRs", "d_prime"]
-
-        # Fill array with hits/CRs/d' x mouse x session data.
-        for j, mouse in enumerate(self.meta["mice"]):
-            for k, session_type in enumerate(self.meta["session_types"]):
-                session = self.data[mouse][session_type]
-                session.sdt_trials(
-                    rolling_window=window,
-                    trial_interval=strides,
-                    plot=False,
-                    trial_limit=trial_limit,
-                )
-
-                for i, key in enumerate(categories):
-                    behavioral_performance_arr[i, j, k] = session.sdt[key]
-
-        # Place into xarray.
-        behavioral_performance = xr.DataArray(
-            behavioral_performance_arr,
-            dims=("metric", "mouse", "session"),
-            coords={
-                "metric": categories,
-                "mouse": self.meta["mice"],
-                "session": self.meta["session_types"],
-            },
+        metrics, borders, longest_sessions = self.performance.padded(
+            performance_metric, **kwargs
         )
 
-        # Make awkward array of all mice and sessions. Begin by
-        # finding the longest session for each mouse and session.
-        longest_sessions = [
-            max(
-                [
-                    len(i)
-                    for i in behavioral_performance.sel(
-                    metric="d_prime", session=session
-                ).values.tolist()
-                ]
-            )
-            for session in self.meta["session_types"]
-        ]
-        # This will tell us where to draw session borders.
-        borders = np.cumsum(longest_sessions)
-        borders = np.insert(borders, 0, 0)
-
-        # Get dimensions of new arrays.
-        dims = {
-            inj: (len(self.meta["grouped_mice"][inj]), sum(longest_sessions))
-            for inj in PSAM_groups
-        }
-        metrics = {key: nan_array(dims[key]) for key in PSAM_groups}
-
-        for inj in PSAM_groups:
-            for row, mouse in enumerate(self.meta["grouped_mice"][inj]):
-                for border, session in zip(borders, self.meta["session_types"]):
-                    metric_this_session = behavioral_performance.sel(
-                        metric=performance_metric, mouse=mouse, session=session
-                    ).values.tolist()
-                    length = len(metric_this_session)
-                    metrics[inj][row, border : border + length] = metric_this_session
-
         if show_plot:
             ylabels = {
                 "d_prime": "d'",
@@ -194,21 +143,8 @@ class PSAM:
             fig.legend()
 
         if window is None:
-            mice_ = np.hstack([np.repeat(self.meta['grouped_mice'][inj],
-                                         len(self.meta['session_types']))
-                               for inj in PSAM_groups])
-            groups_ = np.hstack([np.repeat(inj, metrics[inj].size) for inj in PSAM_groups])
-            session_types_ = np.hstack([np.tile(self.meta['session_types'],
-                                                len(self.meta['grouped_mice'][inj]))
-                                        for inj in PSAM_groups])
-            metric_ = np.hstack([metrics[inj].flatten() for inj in PSAM_groups])
-
-            df = pd.DataFrame(
-                {'metric': metric_,
-                 'session_types': session_types_,
-                 'mice': mice_,
-                 'group': groups_,
-                 }
+            df = self.performance.whole_session_df(
+                performance_metric, trial_limit=trial_limit
             )
         else:
             df = None
@@ -234,24 +170,13 @@ class PSAM:
         else:
             trial_limit = None
 
-        behavioral_performance = self.plot_all_behavior(
-            show_plot=False,
-            window=window,
+        best_performance = self.performance.peak(
+            session_type,
             performance_metric=performance_metric,
+            window=window,
+            strides=2,
             trial_limit=trial_limit,
-        )[0]
-
-        best_performance = dict()
-        for inj in PSAM_groups:
-            best_performance[inj] = []
-            for mouse in self.meta["grouped_mice"][inj]:
-                best_performance[inj].append(
-                    np.nanmax(
-                        behavioral_performance.sel(
-                            mouse=mouse, metric=performance_metric, session=session_type
-                        ).values.tolist()
-                    )
-                )
+        )
 
         if show_plot:
             label_axes = True
@@ -14,12 +14,8 @@ from CaImaging.util import (
     open_minian,
     cluster_corr,
 )
-import seaborn as sns
 import math
 import random
-import ruptures as rpt
-import networkx as nx
-from networkx.algorithms.approximation.clustering_coefficient import average_clustering
 from CaImaging.plotting import (
     errorfill,
     beautify_ax,
@@ -46,17 +42,13 @@ from numpy.lib.stride_tricks import sliding_window_view
 from scipy.optimize import curve_fit
 from scipy.spatial import distance
 from joblib import Parallel, delayed
-from CircleTrack.SessionCollation import MultiAnimal
+from CircleTrack.SessionCollation import MultiAnimal, directory, db_fname
+from CircleTrack.Instrumentation import instrument_methods, stage
+from CircleTrack.Memoization import MethodCache, memoized
+from CircleTrack.sql import Database, hash_params, log_artifact
+from CircleTrack.BehaviorPerformance import PerformanceStore
 from CircleTrack.MiniscopeFunctions import CalciumSession
 from CaImaging.CellReg import rearrange_neurons, trim_map, scrollplot_footprints
-from sklearn.naive_bayes import BernoulliNB, GaussianNB
-from sklearn.model_selection import StratifiedKFold, KFold
-from statsmodels.stats.multitest import multipletests
-from statsmodels.tsa.stattools import adfuller, grangercausalitytests
-from sklearn.impute import SimpleImputer
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.feature_selection import RFECV
-from sklearn.linear_model import LinearRegression
 import numpy as np
 import os
 from CircleTrack.plotting import (
@@ -68,7 +60,6 @@ from CircleTrack.plotting import (
     plot_raster,
 )
 from CaImaging.Assemblies import (
-    find_assemblies,
     preprocess_multiple_sessions,
     lapsed_activation,
 )
@@ -77,10 +68,12 @@ from CircleTrack.Assemblies import (
     find_members,
     find_memberships,
     plot_pattern,
+    detect_assemblies,
+    try_make_assembly_fields,
+    assembly_fields_version,
+    zscore_active,
+    null_thresholds,
 )
-import xarray as xr
-import pymannkendall as mk
-from sklearn.metrics.pairwise import cosine_similarity
 from itertools import product, cycle, islice
 from CaImaging.PlaceFields import spatial_bin, PlaceFields, define_field_bins
 from tqdm import tqdm
@@ -93,9 +86,36 @@ from CircleTrack.utils import (
     format_spatial_location_for_decoder,
     get_equivalent_local_path,
     find_reward_spatial_bins,
+    float_dtype,
+    zscore_upcast,
+    position_indicator,
+    bin_activity,
 )
 import pandas as pd
-import pingouin as pg
+from util import lazy_import, write_atomic
+
+# Heavy optional dependencies are only imported when a method needs them.
+sns = lazy_import("seaborn")
+rpt = lazy_import("ruptures")
+nx = lazy_import("networkx")
+average_clustering = lazy_import(
+    "networkx.algorithms.approximation.clustering_coefficient", "average_clustering"
+)
+BernoulliNB = lazy_import("sklearn.naive_bayes", "BernoulliNB")
+GaussianNB = lazy_import("sklearn.naive_bayes", "GaussianNB")
+StratifiedKFold = lazy_import("sklearn.model_selection", "StratifiedKFold")
+KFold = lazy_import("sklearn.model_selection", "KFold")
+SimpleImputer = lazy_import("sklearn.impute", "SimpleImputer")
+RandomForestClassifier = lazy_import("sklearn.ensemble", "RandomForestClassifier")
+RFECV = lazy_import("sklearn.feature_selection", "RFECV")
+LinearRegression = lazy_import("sklearn.linear_model", "LinearRegression")
+cosine_similarity = lazy_import("sklearn.metrics.pairwise", "cosine_similarity")
+multipletests = lazy_import("statsmodels.stats.multitest", "multipletests")
+adfuller = lazy_import("statsmodels.tsa.stattools", "adfuller")
+grangercausalitytests = lazy_import("statsmodels.tsa.stattools", "grangercausalitytests")
+xr = lazy_import("xarray")
+mk = lazy_import("pymannkendall")
+pg = lazy_import("pingouin")
 
 plt.rcParams["pdf.fonttype"] = 42
 plt.rcParams["svg.fonttype"] = "none"
@@ -116,6 +136,25 @@ session_types = {
     "PSAMReversal": ["Goals1", "Goals2", "Goals3", "Goals4", "Reversal"],
 }
 
+project_mice = {
+    "RemoteReversal": [
+        "Fornax",
+        "Gemini",
+        "Janus",
+        "Lyra",
+        "Miranda",
+        "Naiad",
+        "Oberon",
+        "Puck",
+        "Sao",
+        "Titania",
+        "Umbriel",
+        "Virgo",
+        "Ymir",
+        "Atlas",
+    ],
+}
+
 aged_mice = [
     "Gemini",
     "Oberon",
@@ -141,13 +180,31 @@ class RecentReversal:
         save_figs=True,
         ext="pdf",
         save_path=r"C:\Users\wm228\Documents\GitHub\memory_flexibility\Figures",
+        data=None,
+        memo_mb=1024,
+        precision="float64",
     ):
-        # Collect data from all mice and sessions.
-        self.data = MultiAnimal(
-            mice,
-            project_name=project_name,
-            SessionFunction=CalciumSession,
-        )
+        # Collect data from all mice and sessions, unless they were
+        # already loaded (e.g., synthetic data from SyntheticData.load_cohort).
+        # In float32 mode, imaging data and the large intermediate
+        # arrays are kept as float32.
+        if data is None:
+            data = MultiAnimal(
+                mice,
+                project_name=project_name,
+                SessionFunction=CalciumSession,
+                precision=precision,
+            )
+        self.data = data
+
+        # Results of analysis primitives (e.g., find_activity_trends,
+        # match_ensembles) that are called repeatedly with the same
+        # arguments. See self.memo.stats() for hits and misses.
+        self.memo = MethodCache(max_mb=memo_mb)
+
+        # Cohort-level results computed ahead of time (e.g., by
+        # FigureRunner), keyed by (name, parameter hash).
+        self.intermediates = dict()
 
         self.save_configs = {
             "save_figs": save_figs,
@@ -160,6 +217,8 @@ class RecentReversal:
         self.meta = {
             "session_types": session_types[project_name],
             "mice": mice,
+            "project_name": project_name,
+            "dtype": float_dtype(precision),
         }
 
         self.meta["session_labels"] = [
@@ -176,8 +235,52 @@ class RecentReversal:
             mouse: True if mouse in aged_mice else False for mouse in self.meta["mice"]
         }
 
+        # Behavioral performance of the whole cohort, computed on demand.
+        self.performance = PerformanceStore(
+            lambda mouse, session_type: self.data[mouse][session_type].behavior,
+            {age: self.meta["grouped_mice"][age] for age in ages},
+            self.meta["session_types"],
+        )
+
         # Get spatial fields of the assemblies.
         if not behavior_only:
+            self.load_assembly_fields()
+
+    def load_assembly_fields(self, n_jobs=-1, n_shuffles=500):
+        """
+        Load the spatial fields of every session's assemblies from
+        AssemblyFields.pkl. Missing ones, and ones built by an older
+        version of the shuffle test, are built in parallel across
+        sessions (see make_assembly_fields()) and saved. Sessions that
+        fail are reported at the end instead of stopping the others.
+
+        :parameters
+        ---
+        n_jobs: int
+            Number of sessions to build at once.
+
+        n_shuffles: int
+            Number of circular shifts for the spatial information test.
+        """
+        params = {"n_shuffles": n_shuffles, "version": assembly_fields_version}
+        with stage("AssemblyFields") as s:
+            # Sessions whose fields the database knows were built with
+            # other parameters are rebuilt without being loaded first.
+            stale = set()
+            if os.path.isfile(os.path.join(directory, db_fname)):
+                db = Database(directory, db_fname, read_only=True)
+                if db.has_table("artifact"):
+                    stale = set(
+                        db.missing_artifacts(
+                            "AssemblyFields",
+                            params=params,
+                            project_name=self.meta["project_name"],
+                            recorded_only=True,
+                        )["path"]
+                    )
+                db.connection.close()
+
+            fpaths, missing = dict(), []
             for mouse in self.meta["mice"]:
                 for session_type in self.meta["session_types"]:
                     session = self.data[mouse][session_type]
@@ -186,26 +289,74 @@ class RecentReversal:
                     if session.meta["local"]:
                         folder = get_equivalent_local_path(folder)
                     fpath = os.path.join(folder, "AssemblyFields.pkl")
+                    fpaths[(mouse, session_type)] = fpath
+
+                    if session.meta["folder"] in stale:
+                        missing.append((mouse, session_type))
+                        continue
 
                     try:
                         with open(fpath, "rb") as file:
-                            session.assemblies["fields"] = pkl.load(file)
-                    except:
-                        behavior = session.behavior.data["df"]
-                        session.assemblies["fields"] = PlaceFields(
-                            np.asarray(behavior["t"]),
-                            np.asarray(behavior["x"]),
-                            np.asarray(behavior["y"]),
-                            session.assemblies["activations"],
-                            bin_size=session.spatial.meta["bin_size"],
-                            circular=True,
-                            shuffle_test=True,
-                            fps=session.spatial.meta["fps"],
-                            velocity_threshold=0,
-                        )
+                            fields = pkl.load(file)
+                    except Exception:
+                        missing.append((mouse, session_type))
+                        continue
 
-                        with open(fpath, "wb") as file:
-                            pkl.dump(session.assemblies["fields"], file)
+                    if fields.meta.get("version") != assembly_fields_version:
+                        missing.append((mouse, session_type))
+                    else:
+                        session.assemblies["fields"] = fields
+
+            s.cache = "miss" if missing else "hit"
+            if not missing:
+                return
+
+            print(f"Building assembly fields for {len(missing)} sessions.")
+            args = []
+            for mouse, session_type in missing:
+                session = self.data[mouse][session_type]
+                behavior = session.behavior.data["df"]
+                args.append(
+                    (
+                        np.asarray(behavior["t"]),
+                        np.asarray(behavior["x"]),
+                        np.asarray(behavior["y"]),
+                        session.assemblies["activations"],
+                        session.spatial.meta["bin_size"],
+                        session.spatial.meta["fps"],
+                    )
+                )
+            results = Parallel(n_jobs=n_jobs)(
+                delayed(try_make_assembly_fields)(*arg, n_shuffles=n_shuffles)
+                for arg in args
+            )
+
+            failures = dict()
+            for (mouse, session_type), (fields, error, duration) in zip(missing, results):
+                if error is not None:
+                    failures[(mouse, session_type)] = error
+                    continue
+
+                session = self.data[mouse][session_type]
+                session.assemblies["fields"] = fields
+
+                def write(tmp_path, fields=fields):
+                    with open(tmp_path, "wb") as file:
+                        pkl.dump(fields, file)
+
+                write_atomic(fpaths[(mouse, session_type)], write)
+                log_artifact(
+                    session.meta["folder"],
+                    "AssemblyFields",
+                    fpaths[(mouse, session_type)],
+                    params=params,
+                    duration=duration,
+                )
+
+        if failures:
+            print(f"Failed to build assembly fields for {len(failures)} sessions:")
+            for (mouse, session_type), error in failures.items():
+                print(f"    {mouse} {session_type}: {error}")
 
     ############################ HELPER FUNCIONS ############################
     def save_fig(self, fig, fname, folder):
@@ -214,8 +365,28 @@ class RecentReversal:
             str(folder),
             f'{fname}.{self.save_configs["ext"]}',
         )
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
         fig.savefig(fpath, bbox_inches="tight")
 
+    def get_intermediate(self, name, params=None):
+        """
+        Get a precomputed cohort-level result.
+
+        :parameters
+        ---
+        name: str
+            Name of the result, e.g. "PV_corr_matrices".
+
+        params: dict or None
+            Parameters the result was computed with.
+
+        :return
+        ---
+        result: object or None
+            None if it was not precomputed.
+        """
+        return self.intermediates.get((name, hash_params(params)))
+
     def ages_to_plot_parser(self, ages_to_plot):
         if ages_to_plot is None:
             ages_to_plot = ages
@@ -229,6 +400,7 @@ class RecentReversal:
 
         return ages_to_plot, plot_colors, n_ages_to_plot
 
+    @memoized
     def rearrange_neurons(
         self, mouse, selected_sessions, data_type, detected="everyday"
     ):
@@ -279,6 +451,7 @@ class RecentReversal:
             self.data[mouse]["CellReg"].path, session_list, neurons_from_session1
         )
 
+    @memoized
     def get_cellreg_mappings(
         self, mouse, session_types, detected="everyday", neurons_from_session1=None
     ):
@@ -409,38 +582,13 @@ class RecentReversal:
         performance_metric="CRs",
         trial_limit=None,
     ):
-        dv, mice, sessions, groups, trial_blocks = [], [], [], [], []
-        for age in ages:
-            for mouse in self.meta["grouped_mice"][age]:
-                session = self.data[mouse][session_type].behavior
-                session.sdt_trials(
-                    rolling_window=window,
-                    trial_interval=strides,
-                    plot=False,
-                    trial_limit=trial_limit,
-                )
-
-                n = range(len(session.sdt[performance_metric]))
-                dv.extend(session.sdt[performance_metric])
-                mice.extend([mouse for i in n])
-                sessions.extend([session_type for i in n])
-                groups.extend([age for i in n])
-                trial_blocks.extend([i for i in n])
-
-        df = pd.DataFrame(
-            {
-                "t": trial_blocks,
-                "dv": dv,
-                "mice": mice,
-                "session": sessions,
-                "age": groups,
-            }
-        )
-
-        # cols = ['mice', 'session', 'group']
-        # df[cols] = df[cols].mask(df[cols]=='nan', None).ffill(axis=0)
-        # df['t'] = df['t'].isna().cumsum() + df['t'].ffill()
-        # df = df.dropna(axis=0)
+        df = self.performance.session_df(
+            session_type,
+            performance_metric=performance_metric,
+            window=window,
+            strides=strides,
+            trial_limit=trial_limit,
+        ).rename(columns={"group": "age"})
 
         return df
 
@@ -767,99 +915,16 @@ class RecentReversal:
         Plot behavior metrics for all mice, separated by aged versus young.
 
         """
-        # Preallocate array.
-        behavioral_performance_arr = np.zeros(
-            (3, len(self.meta["mice"]), len(self.meta["session_types"])),
-            dtype=object,
+        kwargs = dict(window=window, strides=strides, trial_limit=trial_limit)
+        behavioral_performance = self.performance.to_xarray(
+            mice=self.meta["mice"], **kwargs
         )
-        categories = ["hits", "CRs", "d_prime"]
-
-        # Fill array with hits/CRs/d' x mouse x session data.
-        for j, mouse in enumerate(self.meta["mice"]):
-            for k, session_type in enumerate(self.meta["session_types"]):
-                session = self.data[mouse][session_type].behavior
-                session.sdt_trials(
-                    rolling_window=window,
-                    trial_interval=strides,
-                    plot=False,
-                    trial_limit=trial_limit,
-                )
-
-                for i, key in enumerate(categories):
-                    behavioral_performance_arr[i, j, k] = session.sdt[key]
-
-        # Place into xarray.
-        behavioral_performance = xr.DataArray(
-            behavioral_performance_arr,
-            dims=("metric", "mouse", "session"),
-            coords={
-                "metric": categories,
-                "mouse": self.meta["mice"],
-                "session": self.meta["session_types"],
-            },
-        )
-
-        # Make awkward array of all mice and sessions. Begin by
-        # finding the longest session for each mouse and session.
-        longest_sessions = [
-            max(
-                [
-                    len(i)
-                    for i in behavioral_performance.sel(
-                        metric="d_prime", session=session
-                    ).values.tolist()
-                ]
-            )
-            for session in self.meta["session_types"]
-        ]
-        # This will tell us where to draw session borders.
-        borders = np.cumsum(longest_sessions)
-        borders = np.insert(borders, 0, 0)
-
-        # Get dimensions of new arrays.
-        dims = {
-            age: (len(self.meta["grouped_mice"][age]), sum(longest_sessions))
-            for age in ages
-        }
-        metrics = {key: nan_array(dims[key]) for key in ages}
-
-        for age in ages:
-            for row, mouse in enumerate(self.meta["grouped_mice"][age]):
-                for border, session in zip(borders, self.meta["session_types"]):
-                    metric_this_session = behavioral_performance.sel(
-                        metric=performance_metric, mouse=mouse, session=session
-                    ).values.tolist()
-                    length = len(metric_this_session)
-                    metrics[age][row, border : border + length] = metric_this_session
+        metrics = self.performance.padded(performance_metric, **kwargs)[0]
 
         if window is None:
-            mice_ = np.hstack(
-                [
-                    np.repeat(
-                        self.meta["grouped_mice"][age], len(self.meta["session_types"])
-                    )
-                    for age in ages
-                ]
-            )
-            ages_ = np.hstack([np.repeat(age, metrics[age].size) for age in ages])
-            session_types_ = np.hstack(
-                [
-                    np.tile(
-                        self.meta["session_types"], len(self.meta["grouped_mice"][age])
-                    )
-                    for age in ages
-                ]
-            )
-            metric_ = np.hstack([metrics[age].flatten() for age in ages])
-
-            df = pd.DataFrame(
-                {
-                    "metric": metric_,
-                    "session_types": session_types_,
-                    "mice": mice_,
-                    "age": ages_,
-                }
-            )
+            df = self.performance.whole_session_df(
+                performance_metric, trial_limit=trial_limit
+            ).rename(columns={"group": "age"})
         else:
             df = None
 
@@ -918,24 +983,13 @@ class RecentReversal:
         else:
             trial_limit = None
 
-        behavioral_performance = self.aggregate_behavior_over_trials(
+        peak_performance = self.performance.peak(
+            session_type,
+            performance_metric=performance_metric,
             window=window,
             strides=strides,
-            performance_metric=performance_metric,
             trial_limit=trial_limit,
-        )[0]
-
-        peak_performance = dict()
-        for age in ages:
-            peak_performance[age] = []
-            for mouse in self.meta["grouped_mice"][age]:
-                peak_performance[age].append(
-                    np.nanmax(
-                        behavioral_performance.sel(
-                            mouse=mouse, metric=performance_metric, session=session_type
-                        ).values.tolist()
-                    )
-                )
+        )
 
         return peak_performance
 
@@ -1950,6 +2004,7 @@ class RecentReversal:
 
         return percent_pcs
 
+    @memoized
     def get_placefields(self, mouse, session_type, nbins=125, velocity_threshold=7):
         """
         Get place fields from one mouse for a session. If the specified parameters do not match the ones
@@ -2530,6 +2585,7 @@ class RecentReversal:
 
         return rhos, fig
 
+    @memoized(bypass={"show_plot": True})
     def get_split_trial_pfs(self, mouse, session_type, nbins=125, show_plot=False):
         """
         Make place fields separately for even and odd trials.
@@ -4025,7 +4081,7 @@ class RecentReversal:
         self,
         mouse,
         training_and_test_sessions,
-        classifier=BernoulliNB(),
+        classifier=None,
         n_spatial_bins=36,
         show_plot=True,
         predictors="cells",
@@ -4055,6 +4111,9 @@ class RecentReversal:
         show_plot: boolean
             Flag for showing plots.
         """
+        if classifier is None:
+            classifier = BernoulliNB()
+
         # Get sessions and neural activity.
         sessions = [self.data[mouse][session] for session in training_and_test_sessions]
         if predictors == "cells":
@@ -4125,7 +4184,7 @@ class RecentReversal:
     def plot_reversal_decoding_error(
         self,
         mouse,
-        classifier=BernoulliNB(),
+        classifier=None,
         session_pairs=(("Goals4", "Goals3"), ("Goals4", "Reversal")),
         n_spatial_bins=36,
         error_time_bin_size=300 * 15,
@@ -4143,6 +4202,8 @@ class RecentReversal:
             "Training" and "Reversal" correspond to the two session pairs listed above, respectively.
             Each entry is a list of errors (in spatial bins) across time bins.
         """
+        if classifier is None:
+            classifier = BernoulliNB()
 
         decoding_errors = dict()
         decoded_sessions = [s[1] for s in session_pairs]
@@ -4191,7 +4252,7 @@ class RecentReversal:
         if predictors == "cells":
             neural_data = session.imaging["S_binary"]
         elif predictors == "ensembles":
-            neural_data = zscore(session.assemblies["activations"], axis=0)
+            neural_data = zscore_upcast(session.assemblies["activations"], axis=0)
         else:
             raise NotImplementedError
 
@@ -4359,8 +4420,11 @@ class RecentReversal:
         return errors
 
     def test_classifier(
-        self, X, y, kfolds=5, classifier=GaussianNB(), n_spatial_bins=125, shuffle=False
+        self, X, y, kfolds=5, classifier=None, n_spatial_bins=125, shuffle=False
     ):
+        if classifier is None:
+            classifier = GaussianNB()
+
         skf = KFold(n_splits=kfolds)
 
         if shuffle:
@@ -4382,7 +4446,7 @@ class RecentReversal:
 
     def plot_spatial_decoder(
         self,
-        classifier=RandomForestClassifier(),
+        classifier=None,
         session_pairs=(("Goals4", "Goals3"), ("Goals4", "Reversal")),
         n_spatial_bins=125,
         error_time_bin_size=300 * 15,
@@ -4404,6 +4468,9 @@ class RecentReversal:
             Results from ANOVAs, calculated separately for each age.
 
         """
+        if classifier is None:
+            classifier = RandomForestClassifier()
+
         ages_to_plot, plot_colors, n_ages_to_plot = self.ages_to_plot_parser(
             ages_to_plot
         )
@@ -4475,12 +4542,15 @@ class RecentReversal:
 
     def spatial_decoder_anova(
         self,
-        classifier=RandomForestClassifier(),
+        classifier=None,
         session_pairs=(("Goals3", "Goals4"), ("Goals4", "Reversal")),
         n_spatial_bins=125,
         error_time_bin_size=300 * 15,
         predictors="cells",
     ):
+        if classifier is None:
+            classifier = RandomForestClassifier()
+
         decoding_errors, df = self.plot_spatial_decoder(
             classifier=classifier,
             session_pairs=session_pairs,
@@ -4521,7 +4591,7 @@ class RecentReversal:
         self,
         mouse,
         training_and_test_sessions,
-        classifier=BernoulliNB(),
+        classifier=None,
         n_spatial_bins=36,
         show_plot=True,
         error_time_bin_size=300,
@@ -4535,6 +4605,9 @@ class RecentReversal:
         ---
         See decode_place().
         """
+        if classifier is None:
+            classifier = BernoulliNB()
+
         (
             y_predicted,
             predictor_data,
@@ -4570,12 +4643,15 @@ class RecentReversal:
         return binned_d, d
 
     def all_session_pairs_decoding_error(
-        self, mouse, classifier=BernoulliNB(), n_spatial_bins=36
+        self, mouse, classifier=None, n_spatial_bins=36
     ):
         """
         For each session pair, compute the mean decoding error and plot it in a matrix.
 
         """
+        if classifier is None:
+            classifier = BernoulliNB()
+
         shape = (5, 5)
         decoding_error_matrix = nan_array(shape)
         for i, session_pair in enumerate(product(self.meta["session_types"], repeat=2)):
@@ -4594,12 +4670,15 @@ class RecentReversal:
 
     def spatial_decoding_error_matrix(
         self,
-        classifier=BernoulliNB(),
+        classifier=None,
         n_spatial_bins=36,
         overwrite=False,
         saved_data=r"Z:\Will\RemoteReversal\Data\cross_session_spatial_decoding_error.pkl",
         show_plot=True,
     ):
+        if classifier is None:
+            classifier = BernoulliNB()
+
         if overwrite:
             decoding_error_matrix = dict()
             for age in ages:
@@ -4694,12 +4773,15 @@ class RecentReversal:
 
     def spatial_decoding_anova(
         self,
-        classifier=BernoulliNB(),
+        classifier=None,
         n_spatial_bins=36,
         overwrite=False,
         saved_data=r"Z:\Will\RemoteReversal\Data\cross_session_spatial_decoding_error.pkl",
         show_plot=True,
     ):
+        if classifier is None:
+            classifier = BernoulliNB()
+
         decoding_error_matrix, errors_sorted = self.spatial_decoding_error_matrix(
             classifier=classifier,
             n_spatial_bins=n_spatial_bins,
@@ -4938,29 +5020,17 @@ class RecentReversal:
             lin_position, filler, bin_size_cm=bin_size, nbins=None, one_dim=True
         )[1]
 
-        rasters = nan_array(
-            (
-                session.assemblies["significance"].nassemblies,
-                session.behavior.data["ntrials"],
-                len(bin_edges) - 1,
-            )
+        n_trials = session.behavior.data["ntrials"]
+        indicator = position_indicator(
+            lin_position,
+            bin_edges,
+            trials=np.asarray(behavior_df["trials"]),
+            n_trials=n_trials,
+            mask=running,
+        )
+        rasters = bin_activity(
+            activations, indicator, n_trials=n_trials, dtype=self.meta["dtype"]
         )
-
-        for trial_number in range(session.behavior.data["ntrials"]):
-            time_bins = behavior_df["trials"] == trial_number
-            positions_this_trial = behavior_df.loc[time_bins, "lin_position"]
-            filler = np.zeros_like(positions_this_trial)
-            running_this_trial = running[time_bins]
-
-            for n, neuron in enumerate(activations):
-                activation = neuron[time_bins] * running_this_trial
-                rasters[n, trial_number, :] = spatial_bin(
-                    positions_this_trial,
-                    filler,
-                    bins=bin_edges,
-                    one_dim=True,
-                    weights=activation,
-                )[0]
 
         session.assemblies["fields"].data["rasters"] = rasters
         session.assemblies["fields"].data["tuning_curves"] = np.mean(rasters, axis=1)
@@ -5165,39 +5235,155 @@ class RecentReversal:
     #
     #     return p_promiscuous_neurons
 
-    def split_session_ensembles(self, mouse, session_type, overwrite_ensembles=False):
+    def split_session_ensembles(
+        self,
+        mouse,
+        session_type,
+        overwrite_ensembles=False,
+        n_splits=2,
+        n_shuffles=500,
+        smoothing=5,
+    ):
         """
-        Split a session in half then look for ensembles separately for each half.
+        Split a session into n_splits equal parts in time then look for ensembles separately in each part.
+        See get_split_session_ensembles().
 
+        :return
+        ---
+        split_ensembles: dict
+            Ensembles of each part, keyed by "first" and "second" for halves, otherwise by part number.
         """
-        session = self.data[mouse][session_type]
-        if session.meta["local"]:
-            folder = get_equivalent_local_path(session.meta["folder"])
-        else:
-            folder = session.meta["folder"]
-        fpath = os.path.join(folder, "SplitSessionEnsembles.pkl")
+        return self.get_split_session_ensembles(
+            [(mouse, session_type)],
+            overwrite_ensembles=overwrite_ensembles,
+            n_splits=n_splits,
+            n_shuffles=n_shuffles,
+            smoothing=smoothing,
+        )[(mouse, session_type)]
 
-        try:
-            if overwrite_ensembles:
-                print(f"Overwriting {fpath}")
-                raise Exception
-            with open(fpath, "rb") as file:
-                split_ensembles = pkl.load(file)
-        except:
+    def get_split_session_ensembles(
+        self,
+        requests,
+        overwrite_ensembles=False,
+        n_splits=2,
+        n_shuffles=500,
+        smoothing=5,
+        n_jobs=-1,
+    ):
+        """
+        Split-session ensembles for many sessions at once. Parts that are not saved yet are detected concurrently
+        across all requested sessions.
+
+        Results are saved in SplitSessionEnsembles.pkl in each session folder, keyed by (n_splits, n_shuffles,
+        smoothing).
+
+        :parameters
+        ---
+        requests: list of (mouse, session_type) tuples
+            Sessions to get split ensembles from.
+
+        n_splits: int
+            Number of parts to split each session into.
+
+        n_shuffles: int
+            Number of circular shifts for the assembly null.
+
+        smoothing: float
+            smooth_factor for preprocess_multiple_sessions().
+
+        n_jobs: int
+            Number of processes. The circular shift nulls of all parts
+            that are not cached are computed in one process pool.
+
+        :return
+        ---
+        split_ensembles: dict
+            {(mouse, session_type): split ensembles, see split_session_ensembles()}
+        """
+        key = (n_splits, n_shuffles, smoothing)
+        labels = ["first", "second"] if n_splits == 2 else list(range(n_splits))
+
+        artifacts, fpaths, split_ensembles, missing = dict(), dict(), dict(), []
+        for mouse, session_type in requests:
+            session = self.data[mouse][session_type]
+            if session.meta["local"]:
+                folder = get_equivalent_local_path(session.meta["folder"])
+            else:
+                folder = session.meta["folder"]
+            fpath = os.path.join(folder, "SplitSessionEnsembles.pkl")
+            fpaths[(mouse, session_type)] = fpath
+
+            artifact = dict()
+            if os.path.exists(fpath):
+                with open(fpath, "rb") as file:
+                    artifact = pkl.load(file)
+                # Older files only stored halves from the default parameters.
+                if "first" in artifact:
+                    artifact = {(2, 500, 5): artifact}
+            artifacts[(mouse, session_type)] = artifact
+
+            if key in artifact and not overwrite_ensembles:
+                split_ensembles[(mouse, session_type)] = artifact[key]
+            else:
+                if overwrite_ensembles:
+                    print(f"Overwriting {key} in {fpath}")
+                missing.append((mouse, session_type))
+
+        if not missing:
+            return split_ensembles
+
+        tasks = []
+        for mouse, session_type in missing:
             processed_for_assembly_detection = preprocess_multiple_sessions(
-                [session.imaging["S"]], smooth_factor=5, use_bool=True
+                [self.data[mouse][session_type].imaging["S"]],
+                smooth_factor=smoothing,
+                use_bool=True,
             )
             split_data = np.array_split(
-                processed_for_assembly_detection["processed"][0], 2, axis=1
+                processed_for_assembly_detection["processed"][0], n_splits, axis=1
+            )
+            folder = os.path.dirname(fpaths[(mouse, session_type)])
+            tasks.extend(
+                {
+                    "request": (mouse, session_type),
+                    "label": label,
+                    "data": data,
+                    "actmat": zscore_active(data)[0],
+                    "cache_path": os.path.join(folder, f"SplitSessionNulls_{label}.pkl"),
+                }
+                for label, data in zip(labels, split_data)
             )
 
-            split_ensembles = {
-                half: find_assemblies(data, nullhyp="circ", plot=False, n_shuffles=500)
-                for half, data in zip(["first", "second"], split_data)
-            }
+        # One process pool over the shuffle batches of every part whose
+        # null threshold is not cached yet.
+        thresholds = null_thresholds(
+            [task["actmat"] for task in tasks],
+            n_shuffles=n_shuffles,
+            smoothing=smoothing,
+            n_jobs=n_jobs,
+            cache_paths=[task["cache_path"] for task in tasks],
+        )
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(detect_assemblies)(
+                task["data"],
+                n_shuffles=n_shuffles,
+                smoothing=smoothing,
+                lambda_max=lambda_max,
+            )
+            for task, lambda_max in zip(tasks, thresholds)
+        )
+        for task, result in zip(tasks, results):
+            split_ensembles.setdefault(task["request"], dict())[task["label"]] = result
 
-            with open(fpath, "wb") as file:
-                pkl.dump(split_ensembles, file)
+        for request in missing:
+            artifact = artifacts[request]
+            artifact[key] = split_ensembles[request]
+
+            def write(tmp_path, artifact=artifact):
+                with open(tmp_path, "wb") as file:
+                    pkl.dump(artifact, file)
+
+            write_atomic(fpaths[request], write)
 
         return split_ensembles
 
@@ -5472,6 +5658,7 @@ class RecentReversal:
         exclude=None,
         do_zscore=True,
         shuffle=False,
+        cohort_split_ensembles=False,
         **classifier_kwargs,
     ):
         split_session = len(np.unique(session_pair)) == 1
@@ -5479,7 +5666,11 @@ class RecentReversal:
         # and train on the first half.
         if split_session:
             if data_type == "ensembles":
-                raise NotImplementedError(f"{data_type} not yet implemented.")
+                # Ensembles detected separately in each half, matched across halves.
+                registered_ensembles = self.match_ensembles(
+                    mouse, session_pair, cohort_split_ensembles=cohort_split_ensembles
+                )
+                registered_data = registered_ensembles["matched_activations"]
             elif data_type in ["S", "S_binary"]:
                 registered_data = np.array_split(
                     self.data[mouse][session_pair[0]].imaging[data_type], 2, axis=1
@@ -6366,6 +6557,7 @@ class RecentReversal:
             mouse, plot_session, inds=trimmed_map.iloc[:, 1].to_numpy(), data_type="S"
         )
 
+    @memoized
     def find_activity_trends(
         self,
         mouse,
@@ -6407,9 +6599,11 @@ class RecentReversal:
         session = self.data[mouse][session_type]
 
         if data_type == "ensembles":
-            data = zscore(session.assemblies["activations"], nan_policy="omit", axis=1)
+            data = zscore_upcast(
+                session.assemblies["activations"], nan_policy="omit", axis=1
+            )
         elif data_type in ["S", "C"]:
-            data = zscore(session.imaging[data_type], nan_policy="omit", axis=1)
+            data = zscore_upcast(session.imaging[data_type], nan_policy="omit", axis=1)
         elif data_type == "S_binary":
             data = session.imaging[data_type]
         else:
@@ -6448,7 +6642,11 @@ class RecentReversal:
             trial_bins = np.arange(0, session.behavior.data["ntrials"], x_bin_size)
             df = session.behavior.data["df"]
 
-            binned_activations = nan_array((activations.shape[0], len(trial_bins) - 1))
+            binned_activations = np.full(
+                (activations.shape[0], len(trial_bins) - 1),
+                np.nan,
+                dtype=self.meta["dtype"],
+            )
             for i, (lower, upper) in enumerate(zip(trial_bins, trial_bins[1:])):
                 in_trial = (df["trials"] >= lower) & (df["trials"] < upper)
                 binned_activations[:, i] = np.nanmax(activations[:, in_trial], axis=1)
@@ -6675,20 +6873,31 @@ class RecentReversal:
 
         return prop_fading_cells
 
-    def plot_assembly_trends(
+    @memoized
+    def find_assembly_trends(
         self,
         session_types=None,
         x="trial",
         x_bin_size=1,
         z_threshold=None,
         data_type="ensembles",
-        show_plot=True,
         alpha=0.01,
     ):
+        """
+        Categorize the activity of every ensemble in every mouse and
+        session as decreasing, increasing or no trend.
+
+        :return
+        ---
+        assembly_trends: xarray.DataArray
+            (trend, mouse, session) array of ensemble indices.
+
+        assembly_counts: xarray.DataArray
+            (trend, mouse, session) array of ensemble counts.
+        """
         if session_types is None:
             session_types = self.meta["session_types"]
 
-        session_labels = [label.replace("Goals", "Training") for label in session_types]
         assembly_trend_arr = np.zeros(
             (
                 3,
@@ -6737,6 +6946,41 @@ class RecentReversal:
             },
         )
 
+        return assembly_trends, assembly_counts
+
+    def plot_assembly_trends(
+        self,
+        session_types=None,
+        x="trial",
+        x_bin_size=1,
+        z_threshold=None,
+        data_type="ensembles",
+        show_plot=True,
+        alpha=0.01,
+    ):
+        if session_types is None:
+            session_types = self.meta["session_types"]
+
+        session_labels = [label.replace("Goals", "Training") for label in session_types]
+        params = dict(
+            x=x,
+            x_bin_size=x_bin_size,
+            z_threshold=z_threshold,
+            data_type=data_type,
+            alpha=alpha,
+        )
+        precomputed = self.get_intermediate("assembly_trends", params)
+        if precomputed is not None and set(session_types) <= set(
+            precomputed[0].session.values
+        ):
+            assembly_trends, assembly_counts = [
+                arr.sel(session=list(session_types)) for arr in precomputed
+            ]
+        else:
+            assembly_trends, assembly_counts = self.find_assembly_trends(
+                session_types=session_types, **params
+            )
+
         if show_plot:
             fig, ax = plt.subplots()
             p_decreasing = assembly_counts.sel(
@@ -7001,7 +7245,8 @@ class RecentReversal:
 
         return df
 
-    def match_ensembles(self, mouse, session_pair):
+    @memoized(ignore=("cohort_split_ensembles",))
+    def match_ensembles(self, mouse, session_pair, cohort_split_ensembles=False):
         """
         Match assemblies across two sessions. For each assembly in the first session of the session_types tuple,
         find the corresponding assembly in the second session by taking the highest cosine similarity between two
@@ -7016,6 +7261,10 @@ class RecentReversal:
             Two session names (e.g. (Goals1, Goals2)) OR one session name twice ('Reversal','Reversal') in which case
             split_session must be True. Order matters.
 
+        cohort_split_ensembles: boolean
+            For a split session, detect the split-session ensembles of every mouse at once (see
+            get_split_session_ensembles()) and keep them in self.intermediates for the calls for other mice.
+
         absolute_value: boolean
             Whether to take the absolute value of the pattern similarity matrix. Otherwise, try negating the pattern
             and take the larger value of the two resulting cosine similarities.
@@ -7037,7 +7286,19 @@ class RecentReversal:
         """
         split_session = True if len(np.unique(session_pair)) == 1 else False
         if split_session:
-            split_ensembles = self.split_session_ensembles(mouse, session_pair[0])
+            if cohort_split_ensembles:
+                params = {"session_type": session_pair[0]}
+                cohort_ensembles = self.get_intermediate("split_session_ensembles", params)
+                if cohort_ensembles is None:
+                    cohort_ensembles = self.get_split_session_ensembles(
+                        [(mouse_, session_pair[0]) for mouse_ in self.meta["mice"]]
+                    )
+                    self.intermediates[
+                        ("split_session_ensembles", hash_params(params))
+                    ] = cohort_ensembles
+                split_ensembles = cohort_ensembles[(mouse, session_pair[0])]
+            else:
+                split_ensembles = self.split_session_ensembles(mouse, session_pair[0])
             rearranged_patterns = [
                 split_ensembles[half]["patterns"] for half in ["first", "second"]
             ]
@@ -8635,7 +8896,7 @@ class RecentReversal:
 
         corr_mats, pval_mats = [], []
         for t in traces:
-            R = nan_array((n_neurons, n_neurons))
+            R = np.full((n_neurons, n_neurons), np.nan, dtype=self.meta["dtype"])
             pval_mat = nan_array((n_neurons, n_neurons))
             for combination in product(range(n_neurons), repeat=2):
                 if combination[0] != combination[1]:
@@ -8832,6 +9093,7 @@ class RecentReversal:
 
         return fig
 
+    @memoized
     def xcorr_fading_ensembles(
         self, mouse, session_type, n_splits=6, trend="decreasing"
     ):
@@ -10411,9 +10673,6 @@ class RecentReversal:
 
     def make_fig1(self, panels=None):
         folder = 1
-        with open(r"Z:\Will\RemoteReversal\Data\PV_corr_matrices.pkl", "rb") as file:
-            corr_matrices = pkl.load(file)
-
         if panels is None:
             panels = ["A", "C", "D", "E", "F", "G", "H"]
 
@@ -10522,6 +10781,13 @@ class RecentReversal:
             return anova_df, pairwise_df, errors_df
 
         if "N" in panels:
+            corr_matrices = self.get_intermediate("PV_corr_matrices")
+            if corr_matrices is None:
+                with open(
+                    r"Z:\Will\RemoteReversal\Data\PV_corr_matrices.pkl", "rb"
+                ) as file:
+                    corr_matrices = pkl.load(file)
+
             data, df, fig = self.plot_session_PV_corr_comparisons(
                 corr_matrices, ages_to_plot="young"
             )
@@ -10873,7 +11139,7 @@ class RecentReversal:
         if "E" in panels:
             act_rate_df = pd.read_csv(
                 os.path.join(
-                    self.save_configs["path"], "S7", "all_sessions_activity_rate.csv"
+                    self.save_configs["path"], "S8", "all_sessions_activity_rate.csv"
                 )
             )
             session_ids = act_rate_df["session_id"].unique()
@@ -11598,24 +11864,12 @@ class RecentReversal:
     #     return median_r, criterion
 
 
+# Record calls to public analysis methods when instrumentation is enabled.
+instrument_methods(RecentReversal)
+
 if __name__ == "__main__":
     RR = RecentReversal(
-        [
-            "Fornax",
-            "Gemini",
-            "Janus",
-            "Lyra",
-            "Miranda",
-            "Naiad",
-            "Oberon",
-            "Puck",
-            "Sao",
-            "Titania",
-            "Umbriel",
-            "Virgo",
-            "Ymir",
-            "Atlas",
-        ],
+        project_mice["RemoteReversal"],
         project_name="RemoteReversal",
         behavior_only=False,
     )
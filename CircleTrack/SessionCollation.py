@@ -1,8 +1,13 @@
 from CircleTrack.BehaviorFunctions import BehaviorSession
-from CircleTrack.MiniscopeFunctions import CalciumSession
+from CircleTrack.MiniscopeFunctions import (
+    CalciumSession,
+    artifact_params,
+    artifact_overwrite_flags,
+)
 from LinearTrack.BehaviorFunctions import BehaviorSession as LTBehaviorSession
 from CaImaging.CellReg import CellRegObj
 from CircleTrack.sql import Database
+from CircleTrack.Instrumentation import stage
 import os
 
 directory = r'D:'
@@ -12,9 +17,11 @@ def MultiSession(mouse, project_name='Drift',
                  directory=directory, db_fname=db_fname,
                  SessionFunction=CalciumSession,
                  session_types=None,
+                 db=None,
                  **kwargs):
 
-    db = Database(directory, db_fname)
+    if db is None:
+        db = Database(directory, db_fname, read_only=True)
     sql_str = """
         SELECT session.session_name, session.path
         FROM session
@@ -29,10 +36,32 @@ def MultiSession(mouse, project_name='Drift',
     if session_types is None:
         session_types = [r[0] for r in results]
 
+    # Artifacts that the database knows were built with other parameters
+    # are rebuilt directly instead of being loaded and then discarded.
+    stale = dict()
+    if SessionFunction is CalciumSession and db.has_table("artifact"):
+        for kind, params in artifact_params(**kwargs).items():
+            stale[kind] = set(
+                db.missing_artifacts(
+                    kind,
+                    params=params,
+                    project_name=project_name,
+                    mouse=mouse,
+                    recorded_only=True,
+                )["path"]
+            )
+
     S = dict()
     for session_type, folder in results:
         if session_type in session_types:
-            S[session_type] = SessionFunction(folder, **kwargs)
+            session_kwargs = dict(kwargs)
+            for kind, paths in stale.items():
+                if folder in paths:
+                    print(f"{kind} of {mouse} {session_type} was built with other parameters.")
+                    session_kwargs[artifact_overwrite_flags[kind]] = True
+
+            with stage(SessionFunction.__name__, mouse=mouse, session=session_type):
+                S[session_type] = SessionFunction(folder, **session_kwargs)
 
     sql_str = """
         SELECT project.path
@@ -47,7 +76,8 @@ def MultiSession(mouse, project_name='Drift',
     if SessionFunction not in [BehaviorSession, LTBehaviorSession]:
         cellreg_path = os.path.join(results[0][0], mouse, 'SpatialFootprints', 'CellRegResults')
         try:
-            S["CellReg"] = CellRegObj(cellreg_path)
+            with stage("CellReg", mouse=mouse):
+                S["CellReg"] = CellRegObj(cellreg_path)
         except:
             print(f"CellReg for {mouse} failed to load.")
 
@@ -56,16 +86,23 @@ def MultiSession(mouse, project_name='Drift',
 
 def MultiAnimal(mice, project_name='Drift',
                 SessionFunction=CalciumSession,
-                session_types=None):
+                session_types=None,
+                **kwargs):
     sessions_by_mouse = dict()
 
+    # One read-only connection for all mice.
+    db = Database(directory, db_fname, read_only=True)
     for mouse in mice:
         print(f"Loading data from {mouse}")
-        sessions_by_mouse[mouse] = MultiSession(
-            mouse, project_name=project_name,
-            SessionFunction=SessionFunction,
-            session_types=session_types,
-        )
+        with stage("MultiSession", mouse=mouse):
+            sessions_by_mouse[mouse] = MultiSession(
+                mouse, project_name=project_name,
+                SessionFunction=SessionFunction,
+                session_types=session_types,
+                db=db,
+                **kwargs,
+            )
+    db.connection.close()
 
     return sessions_by_mouse
 
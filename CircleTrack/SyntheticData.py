@@ -0,0 +1,613 @@
+import os
+import pickle as pkl
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+from CircleTrack.BehaviorFunctions import (
+    BehaviorSession,
+    behavior_metadata,
+    get_trials,
+    linearize_trajectory,
+)
+from CircleTrack.BehaviorStore import get_store_path, write_behavior
+
+# Linearized position (radians) of each water port.
+port_locations = (np.arange(8) + 0.5) * np.pi / 4
+
+# Session types and their rewarded ports for a RemoteReversal-style cohort.
+default_sessions = {
+    "Goals1": (1, 5),
+    "Goals2": (1, 5),
+    "Goals3": (1, 5),
+    "Goals4": (1, 5),
+    "Reversal": (3, 7),
+}
+
+
+class SyntheticCellReg:
+    def __init__(self, cell_map, path=None):
+        """
+        Stand-in for CaImaging.CellReg.CellRegObj with the attributes
+        RecentReversal uses.
+
+        :parameters
+        ---
+        cell_map: DataFrame
+            (neuron, session) map of neuron indices. -1 means the neuron
+            was not detected in that session.
+
+        path: str or None
+            Folder the map belongs to.
+        """
+        self.map = cell_map
+        self.sessions = list(cell_map.columns)
+        self.path = path
+
+
+def simulate_behavior(
+    n_frames=18000,
+    fps=15,
+    rewarded_ports=(1, 5),
+    lap_duration=30,
+    radius=240,
+    center=(320, 240),
+    seed=None,
+):
+    """
+    Simulate a mouse running clockwise around the circle track,
+    slowing down and licking at the ports. Licks at unrewarded ports
+    become less frequent over the session, and water is delivered on
+    the first lick at a rewarded port on every lap.
+
+    :parameters
+    ---
+    n_frames: int
+        Number of frames.
+
+    fps: int
+        Sampling rate.
+
+    rewarded_ports: tuple of ints
+        Ports that deliver water.
+
+    lap_duration: float
+        Average number of seconds per lap.
+
+    radius: float
+        Radius of the track in pixels.
+
+    center: (x, y) tuple
+        Center of the track in pixels.
+
+    seed: int or None
+        Random seed.
+
+    :return
+    ---
+    behavior_df: DataFrame
+        Same columns as Preprocess output (in pixels): frame, x, y,
+        distance, water, lick_port, lin_position, trials, t.
+    """
+    rng = np.random.default_rng(seed)
+    rewarded = np.zeros(8, dtype=bool)
+    rewarded[list(rewarded_ports)] = True
+
+    # Ports sit in the middle of each eighth of the track.
+    def nearest_port(position):
+        port = np.floor(position / (np.pi / 4)).astype(int) % 8
+
+        return port, np.abs(position - port_locations[port])
+
+    # Angular speed with slow fluctuations. The mouse slows down at
+    # rewarded ports, which depends on where it is, so step through frames.
+    base_speed = 2 * np.pi / (lap_duration * fps)
+    fluctuations = lfilter([0.02], [1, -0.98], rng.normal(size=n_frames))
+    speed = base_speed * np.clip(1 + 3 * fluctuations, 0.1, None)
+    slow_ports = np.where(rewarded, 0.15, 1)
+
+    lin_position = np.zeros(n_frames)
+    position = 0.0
+    for frame in range(n_frames):
+        port = int(position // (np.pi / 4)) % 8
+        near = abs(position - port_locations[port]) < np.pi / 32
+        position = (position + speed[frame] * (slow_ports[port] if near else 1)) % (
+            2 * np.pi
+        )
+        lin_position[frame] = position
+
+    # Image coordinates. linearize_trajectory() puts 12 o'clock at 0.
+    angle = lin_position - np.pi / 2
+    x = center[0] + radius * np.cos(angle) + rng.normal(0, 2, n_frames)
+    y = center[1] + radius * np.sin(angle) + rng.normal(0, 2, n_frames)
+
+    # Licks near ports. Discrimination improves over the session.
+    port, offset = nearest_port(lin_position)
+    near_port = offset < np.pi / 32
+    learning = np.linspace(0, 1, n_frames)
+    lick_prob = np.where(rewarded[port], 0.5, 0.2 * (1 - learning) + 0.02)
+    licking = near_port & (rng.random(n_frames) < lick_prob)
+    lick_port = np.where(licking, port, -1)
+
+    behavior_df = pd.DataFrame(
+        {
+            "frame": np.arange(n_frames),
+            "x": x,
+            "y": y,
+            "water": False,
+            "lick_port": lick_port,
+        }
+    )
+    behavior_df["lin_position"] = linearize_trajectory(behavior_df)[0]
+    behavior_df["trials"] = get_trials(behavior_df)
+    behavior_df["distance"] = np.insert(np.hypot(np.diff(x), np.diff(y)), 0, 0)
+
+    # Water on the frame after the first lick at each rewarded port per lap.
+    first_licks = (
+        behavior_df.loc[licking & rewarded[port]]
+        .groupby(["trials", "lick_port"])["frame"]
+        .min()
+        .to_numpy()
+    )
+    water_frames = first_licks[first_licks + 1 < n_frames] + 1
+    behavior_df.loc[water_frames, "water"] = True
+
+    # Timestamps (ms) with a little jitter, like the v4 software.
+    t = np.arange(n_frames) * 1000 / fps + rng.normal(0, 1, n_frames)
+    t[0] = 0
+    behavior_df["t"] = np.round(np.maximum.accumulate(t))
+
+    return behavior_df
+
+
+def simulate_activity(
+    lin_position,
+    preferred_locations,
+    is_place_cell,
+    ensemble_members,
+    ensemble_locations=None,
+    ensemble_trends=None,
+    fps=15,
+    peak_rate=2.0,
+    baseline_rate=0.02,
+    tuning_width=0.3,
+    ensemble_rate=0.05,
+    tau=0.5,
+    noise=0.05,
+    seed=None,
+):
+    """
+    Simulate calcium activity for a population of place-tuned neurons
+    with embedded co-active ensembles.
+
+    :parameters
+    ---
+    lin_position: (frame,) array
+        Linearized position in radians.
+
+    preferred_locations: (neuron,) array
+        Place field center of each neuron (radians).
+
+    is_place_cell: (neuron,) boolean array
+        Which neurons are spatially tuned.
+
+    ensemble_members: list of arrays
+        Neuron indices belonging to each ensemble.
+
+    ensemble_locations: (ensemble,) array or None
+        Location where each ensemble preferentially activates. NaN for
+        ensembles without spatial preference.
+
+    ensemble_trends: (ensemble,) array or None
+        -1, 0, or 1 for ensembles whose activation rate decreases, stays
+        the same, or increases over the session.
+
+    fps: int
+        Sampling rate.
+
+    peak_rate, baseline_rate: float
+        In-field and out-of-field firing rates (Hz).
+
+    tuning_width: float
+        Width of the place fields (radians).
+
+    ensemble_rate: float
+        Average ensemble activation rate (Hz).
+
+    tau: float
+        Calcium decay time constant (s).
+
+    noise: float
+        Standard deviation of the noise added to C.
+
+    seed: int or None
+        Random seed.
+
+    :returns
+    ---
+    C: (neuron, frame) array
+        Denoised calcium traces.
+
+    S: (neuron, frame) array
+        Deconvolved spikes.
+    """
+    rng = np.random.default_rng(seed)
+    n_neurons = len(preferred_locations)
+    n_frames = len(lin_position)
+    n_ensembles = len(ensemble_members)
+
+    if ensemble_locations is None:
+        ensemble_locations = np.full(n_ensembles, np.nan)
+    if ensemble_trends is None:
+        ensemble_trends = np.zeros(n_ensembles)
+
+    # Von Mises place tuning.
+    offsets = np.cos(lin_position[None, :] - np.asarray(preferred_locations)[:, None])
+    rates = np.full((n_neurons, n_frames), baseline_rate)
+    rates[is_place_cell] += peak_rate * np.exp(
+        (offsets[is_place_cell] - 1) / tuning_width ** 2
+    )
+    spikes = rng.random((n_neurons, n_frames)) < rates / fps
+
+    # Ensemble activations.
+    ramp = np.linspace(-1, 1, n_frames)
+    for members, location, trend in zip(
+        ensemble_members, ensemble_locations, ensemble_trends
+    ):
+        rate = ensemble_rate * np.clip(1 + 0.8 * trend * ramp, 0.05, None)
+        if not np.isnan(location):
+            rate = rate * 4 * np.exp((np.cos(lin_position - location) - 1) / 0.1)
+        events = np.where(rng.random(n_frames) < rate / fps)[0]
+
+        participating = rng.random((len(members), len(events))) < 0.7
+        jitter = rng.integers(0, 3, size=participating.shape)
+        rows = np.repeat(members[:, None], len(events), axis=1)[participating]
+        cols = np.minimum(events[None, :] + jitter, n_frames - 1)[participating]
+        spikes[rows, cols] = True
+
+    S = spikes * rng.lognormal(0, 0.5, size=spikes.shape)
+    decay = np.exp(-1 / (tau * fps))
+    C = lfilter([1], [1, -decay], S, axis=1)
+    C += rng.normal(0, noise, size=C.shape)
+
+    return C, S
+
+
+def write_timestamps(session_folder, t):
+    """
+    Write v4-style timeStamps.csv files for the behavior camera and the
+    miniscope.
+
+    :parameters
+    ---
+    session_folder: str
+        Session folder.
+
+    t: (frame,) array
+        Timestamps in ms.
+
+    :return
+    ---
+    paths: list of str
+        [Miniscope, BehavCam] timestamp paths.
+    """
+    paths = []
+    for camera in ["Miniscope", "BehavCam_0"]:
+        folder = os.path.join(session_folder, camera)
+        os.makedirs(folder, exist_ok=True)
+
+        fpath = os.path.join(folder, "timeStamps.csv")
+        pd.DataFrame(
+            {
+                "Frame Number": np.arange(len(t)),
+                "Time Stamp (ms)": np.asarray(t, dtype=int),
+                "Buffer Index": 0,
+            }
+        ).to_csv(fpath, index=False)
+        paths.append(fpath)
+
+    return paths
+
+
+def write_eztrack(session_folder, behavior_df, fps=15):
+    """
+    Write the position in ezTrack's LocationOutput.csv layout.
+
+    """
+    fpath = os.path.join(session_folder, "Merged_LocationOutput.csv")
+    pd.DataFrame(
+        {
+            "File": "Merged.avi",
+            "FPS": fps,
+            "Location_Thresh": 99,
+            "Use_Window": True,
+            "Window_Weight": 0.9,
+            "Window_Size": 100,
+            "Start_Frame": 0,
+            "Frame": behavior_df["frame"],
+            "X": behavior_df["x"],
+            "Y": behavior_df["y"],
+            "Distance_px": behavior_df["distance"],
+        }
+    ).to_csv(fpath)
+
+    return fpath
+
+
+def write_dlc(session_folder, behavior_df, scorer="DLC_resnet50_synthetic"):
+    """
+    Write the position in DeepLabCut's .h5 layout (requires pytables).
+
+    """
+    columns = pd.MultiIndex.from_product(
+        [[scorer], ["mouse"], ["x", "y", "likelihood"]],
+        names=["scorer", "bodyparts", "coords"],
+    )
+    df = pd.DataFrame(
+        np.column_stack(
+            (behavior_df["x"], behavior_df["y"], np.ones(len(behavior_df)))
+        ),
+        columns=columns,
+    )
+    fpath = os.path.join(session_folder, f"Merged{scorer}.h5")
+    df.to_hdf(fpath, key="df_with_missing", mode="w")
+
+    return fpath
+
+
+def write_lick_log(session_folder, behavior_df):
+    """
+    Write licks and water deliveries as the (Timestamp, Data, Frame)
+    table that sync_Arduino_outputs() works with after
+    clean_Arduino_output(). Data is the port number for licks and -1
+    for water.
+
+    """
+    licks = behavior_df.loc[behavior_df["lick_port"] > -1]
+    water = behavior_df.loc[behavior_df["water"]]
+    log = pd.concat(
+        (
+            pd.DataFrame(
+                {"Timestamp": licks["t"], "Data": licks["lick_port"], "Frame": licks["frame"]}
+            ),
+            pd.DataFrame({"Timestamp": water["t"], "Data": -1, "Frame": water["frame"]}),
+        )
+    ).sort_values("Frame")
+
+    fpath = os.path.join(session_folder, "ArduinoLicks.csv")
+    log.to_csv(fpath, index=False)
+
+    return fpath
+
+
+def write_session(session_folder, behavior_df, C, S, fps=15, dlc=False):
+    """
+    Write one synthetic session: raw-style position, lick and timestamp
+    files, metadata.pkl, the binary preprocessed behavior file and
+    SyncedData.pkl, so that BehaviorSession and CalciumSession load it
+    like a real session that went through Preprocess and sync.
+
+    :parameters
+    ---
+    session_folder: str
+        Timestamp folder of the session (created if needed).
+
+    behavior_df: DataFrame
+        From simulate_behavior().
+
+    C, S: (neuron, frame) arrays
+        From simulate_activity().
+
+    fps: int
+        Sampling rate.
+
+    dlc: bool
+        Also write a DeepLabCut .h5 file.
+    """
+    os.makedirs(session_folder, exist_ok=True)
+
+    timestamp_paths = write_timestamps(session_folder, behavior_df["t"])
+    paths = {
+        "Arduino": [],
+        "BehaviorVideo": [],
+        "DLC": write_dlc(session_folder, behavior_df) if dlc else [],
+        "BehaviorData": write_eztrack(session_folder, behavior_df, fps=fps),
+        "timestamps": timestamp_paths,
+        "PreprocessedBehavior": os.path.join(session_folder, "PreprocessedBehavior.csv"),
+        "minian": [],
+    }
+    write_lick_log(session_folder, behavior_df)
+    with open(os.path.join(session_folder, "metadata.pkl"), "wb") as file:
+        pkl.dump(paths, file)
+
+    meta = behavior_metadata(behavior_df, timestamp_paths, fps=fps)
+    write_behavior(get_store_path(session_folder), behavior_df, meta)
+
+    behavior = BehaviorSession(session_folder)
+    imaging = {"C": C, "S": S, "frames": behavior_df["frame"].to_numpy()}
+    with open(os.path.join(session_folder, "SyncedData.pkl"), "wb") as file:
+        pkl.dump((behavior, imaging), file)
+
+
+def make_mouse(
+    folder,
+    mouse,
+    sessions=None,
+    n_neurons=200,
+    n_frames=18000,
+    fps=15,
+    detection_rate=0.8,
+    place_fraction=0.5,
+    drift=0.3,
+    remap_fraction=0.1,
+    n_ensembles=10,
+    ensemble_size=15,
+    dlc=False,
+    seed=None,
+):
+    """
+    Write every session of one synthetic mouse. Neurons come from a
+    shared pool so they can be registered across sessions. Each session
+    detects a random subset. Place fields drift between sessions and a
+    fraction of neurons remap. Ensembles keep their members across
+    sessions, and each one is spatial or has a rising, falling or flat
+    activation rate.
+
+    :parameters
+    ---
+    folder: str
+        Project folder. Sessions go in folder/mouse/MM_DD_YYYY_SessionType/HH_MM_SS.
+
+    mouse: str
+        Mouse name.
+
+    sessions: dict or None
+        {session type: rewarded ports}, in order. Defaults to default_sessions.
+
+    n_neurons: int
+        Number of neurons detected per session.
+
+    n_frames: int
+        Number of frames per session.
+
+    detection_rate: float
+        Fraction of the neuron pool detected in each session.
+
+    place_fraction: float
+        Fraction of neurons that are spatially tuned.
+
+    drift: float
+        Standard deviation (radians) of place field drift between sessions.
+
+    remap_fraction: float
+        Fraction of neurons whose place field moves to a random location
+        between sessions.
+
+    n_ensembles, ensemble_size: int
+        Number and size of ensembles.
+
+    dlc: bool
+        Also write DeepLabCut .h5 files.
+
+    seed: int or None
+        Random seed.
+
+    :returns
+    ---
+    session_folders: dict
+        {session type: session folder}.
+
+    cellreg: SyntheticCellReg
+        Cross-session neuron registration.
+    """
+    if sessions is None:
+        sessions = default_sessions
+    rng = np.random.default_rng(seed)
+
+    n_pool = int(np.ceil(n_neurons / detection_rate))
+    preferred = rng.uniform(0, 2 * np.pi, n_pool)
+    is_place_cell = rng.random(n_pool) < place_fraction
+    members = [
+        rng.choice(n_pool, ensemble_size, replace=False) for _ in range(n_ensembles)
+    ]
+    spatial = rng.random(n_ensembles) < 0.5
+    ensemble_locations = np.where(spatial, rng.uniform(0, 2 * np.pi, n_ensembles), np.nan)
+    ensemble_trends = np.where(spatial, 0, rng.integers(-1, 2, n_ensembles))
+
+    session_folders = dict()
+    cell_map = dict()
+    for day, (session_type, rewarded_ports) in enumerate(sessions.items()):
+        session_folder = os.path.join(
+            folder, mouse, f"01_{day + 1:02d}_2021_{session_type}", "12_00_00"
+        )
+        session_seed = rng.integers(2 ** 31)
+
+        behavior_df = simulate_behavior(
+            n_frames, fps=fps, rewarded_ports=rewarded_ports, seed=session_seed
+        )
+        detected = np.sort(rng.choice(n_pool, n_neurons, replace=False))
+        index_in_session = np.full(n_pool, -1)
+        index_in_session[detected] = np.arange(n_neurons)
+
+        C, S = simulate_activity(
+            behavior_df["lin_position"].to_numpy(),
+            preferred[detected],
+            is_place_cell[detected],
+            [
+                index_in_session[m][index_in_session[m] > -1] for m in members
+            ],
+            ensemble_locations=ensemble_locations,
+            ensemble_trends=ensemble_trends,
+            fps=fps,
+            seed=session_seed,
+        )
+        write_session(session_folder, behavior_df, C, S, fps=fps, dlc=dlc)
+
+        session_folders[session_type] = session_folder
+        cell_map[f"{mouse}_{session_type}"] = index_in_session
+
+        # Place fields drift and some remap before the next session.
+        preferred = np.mod(preferred + rng.normal(0, drift, n_pool), 2 * np.pi)
+        remapped = rng.random(n_pool) < remap_fraction
+        preferred[remapped] = rng.uniform(0, 2 * np.pi, np.sum(remapped))
+
+    cell_map = pd.DataFrame(cell_map)
+    cell_map = cell_map.loc[(cell_map > -1).any(axis=1)].reset_index(drop=True)
+    cellreg = SyntheticCellReg(cell_map, os.path.join(folder, mouse, "SpatialFootprints"))
+
+    return session_folders, cellreg
+
+
+def make_cohort(folder, mice, seed=0, **kwargs):
+    """
+    Write synthetic sessions for several mice. See make_mouse().
+
+    :return
+    ---
+    cohort: dict
+        {mouse: (session_folders, cellreg)}.
+    """
+    rng = np.random.default_rng(seed)
+
+    return {
+        mouse: make_mouse(folder, mouse, seed=rng.integers(2 ** 31), **kwargs)
+        for mouse in mice
+    }
+
+
+def load_cohort(cohort, SessionFunction=None, **kwargs):
+    """
+    Load a synthetic cohort in the format returned by
+    SessionCollation.MultiAnimal, e.g. to pass to RecentReversal(data=...).
+
+    :parameters
+    ---
+    cohort: dict
+        From make_cohort().
+
+    SessionFunction: class or None
+        Session class. Defaults to CalciumSession.
+
+    kwargs:
+        Passed to SessionFunction.
+
+    :return
+    ---
+    data: dict
+        {mouse: {session type: session, "CellReg": SyntheticCellReg}}.
+    """
+    if SessionFunction is None:
+        from CircleTrack.MiniscopeFunctions import CalciumSession
+
+        SessionFunction = CalciumSession
+        kwargs.setdefault("local", False)
+
+    data = dict()
+    for mouse, (session_folders, cellreg) in cohort.items():
+        data[mouse] = {
+            session_type: SessionFunction(folder, **kwargs)
+            for session_type, folder in session_folders.items()
+        }
+        data[mouse]["CellReg"] = cellreg
+
+    return data
@@ -1,21 +1,45 @@
 import sqlite3
 import os
+import time
+import json
+import hashlib
 from pathlib import Path
 from datetime import datetime
 from CaImaging.util import search_for_folders
+from util import folder_mtime
 import regex
 import numpy as np
 import pandas as pd
 
 mouse_csv = r"Z:\Will\mouse_info.csv"
 
+# Derived products of a session, keyed by artifact kind.
+artifact_files = {
+    "PreprocessedBehavior": ["PreprocessedBehavior.npz", "PreprocessedBehavior.csv"],
+    "SyncedData": ["SyncedData.pkl"],
+    "Placefields": ["Placefields.pkl"],
+    "PlacefieldTrials": ["PlacefieldTrials.pkl"],
+    "Assemblies": ["Assemblies.pkl"],
+    "AssemblyFields": ["AssemblyFields.pkl"],
+}
+
 
 class Database:
-    def __init__(self, directory=r"D:", db_name="database.sqlite", from_scratch=False):
+    def __init__(
+        self,
+        directory=r"D:",
+        db_name="database.sqlite",
+        from_scratch=False,
+        read_only=False,
+    ):
         """
         Save a SQL database containing metadata for every mouse recorded, including mouse ID/name, datetime, and file paths
         to important data.
 
+        Opening the database does not touch the data folders. They are
+        only walked when the database is built (create()) or updated
+        (update()).
+
         :parameters
         ---
         directory: str
@@ -26,25 +50,44 @@ class Database:
 
         from_scratch: bool
             Whether to recompile the database from scratch or not.
+
+        read_only: bool
+            Open an existing database for queries only.
         """
         self.directory = directory
         self.db_path = os.path.join(self.directory, db_name)
+        self.read_only = read_only
 
-        if from_scratch:
+        if from_scratch and not read_only:
             if os.path.exists(self.db_path):
                 os.remove(self.db_path)
 
-        self.connection = sqlite3.connect(self.db_path)
+        if read_only:
+            uri = Path(os.path.abspath(self.db_path)).as_uri() + "?mode=ro"
+            self.connection = sqlite3.connect(uri, uri=True)
+        else:
+            self.connection = sqlite3.connect(self.db_path)
         self.cursor = self.connection.cursor()
 
-        # Find all folders named 'Data'. The next folders inside should be mice.
-        self.project_folders = search_for_folders(self.directory, "Data")
+        self._project_folders = None
         self.path_levels = {
             "mouse": -3,
             "date": -2,
             "session": -1,
         }
 
+    @property
+    def project_folders(self):
+        """
+        All folders named 'Data'. The next folders inside should be mice.
+        Found by walking the whole directory, so only done on demand.
+
+        """
+        if self._project_folders is None:
+            self._project_folders = search_for_folders(self.directory, "Data")
+
+        return self._project_folders
+
     def __enter__(self):
         return self
 
@@ -61,10 +104,12 @@ class Database:
         self.connection.close()
 
     def create(self):
+        start = time.time()
         self.make_db()
         self.populate_mice()
         self.populate_projects()
         self.populate_sessions()
+        self.log_scan(start, len(self.project_folders), "full")
 
     def execute(self, sql_str, tuple):
         output = self.cursor.execute(sql_str, tuple)
@@ -104,79 +149,447 @@ class Database:
             """
         )
 
+        # Modification times of mouse folders as of the last scan.
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS mouse_folder
+            (path TEXT PRIMARY KEY,
+            project_id INTEGER,
+            mtime REAL)
+            """
+        )
+
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS scan
+            (id INTEGER PRIMARY KEY,
+            kind TEXT,
+            datetime DATETIME,
+            duration REAL,
+            n_folders INTEGER,
+            n_sessions INTEGER)
+            """
+        )
+
+        # Derived products (pickles, preprocessed behavior) of each session.
+        # param_hash is NULL when the parameters are unknown.
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS artifact
+            (id INTEGER PRIMARY KEY,
+            session_id INTEGER,
+            kind TEXT,
+            param_hash TEXT,
+            path TEXT,
+            size INTEGER,
+            duration REAL,
+            datetime DATETIME,
+            UNIQUE(session_id, kind, param_hash))
+            """
+        )
+
+        # mouse.name is already indexed through its UNIQUE constraint.
+        for index, table, columns in [
+            ("artifact_session_idx", "artifact", "session_id, kind"),
+            ("project_name_idx", "project", "project_name"),
+            ("session_mouse_idx", "session", "mouse_id, project_id"),
+            ("session_project_idx", "session", "project_id"),
+        ]:
+            self.cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {index} ON {table} ({columns})"
+            )
+
     def populate_projects(self):
         projects = [
-            (i + 1, os.path.split(os.path.split(folder)[0])[-1], folder)
-            for i, folder in enumerate(self.project_folders)
+            (os.path.split(os.path.split(folder)[0])[-1], folder)
+            for folder in self.project_folders
         ]
 
         self.cursor.executemany(
             """
-            INSERT OR IGNORE INTO project (id, project_name, path)
-            VALUES (?,?,?)""",
+            INSERT OR IGNORE INTO project (project_name, path)
+            VALUES (?,?)""",
             (projects),
         )
 
-    def populate_mice(self):
-        mouse_info = pd.read_csv(mouse_csv)
-        for project in self.project_folders:
-            mice_ = [
-                (os.path.split(f.path)[-1],) for f in os.scandir(project) if f.is_dir()
+    def populate_mice(self, mouse_names=None):
+        """
+        Add mice from mouse_info.csv.
+
+        :parameter
+        ---
+        mouse_names: list of str or None
+            Mice to add. If None, adds every mouse folder in every project.
+        """
+        if mouse_names is None:
+            mouse_names = [
+                os.path.split(f.path)[-1]
+                for project in self.project_folders
+                for f in os.scandir(project)
+                if f.is_dir()
             ]
+        if not mouse_names:
+            return
 
-            mice = []
-            for mouse in mice_:
-                try:
-                    mice.append((tuple(mouse_info[mouse_info["Name"] == mouse[0]].values[0])))
-                except:
-                    raise ValueError(f"{mouse[0]} not in mouse_info.csv")
+        mouse_info = pd.read_csv(mouse_csv)
+        mice = []
+        for mouse in mouse_names:
+            try:
+                mice.append((tuple(mouse_info[mouse_info["Name"] == mouse].values[0])))
+            except:
+                raise ValueError(f"{mouse} not in mouse_info.csv")
 
-            self.cursor.executemany(
-                """
-                INSERT OR IGNORE INTO mouse (name, sex, dob)
-                VALUES (?, ?, ?)""",
-                (mice),
-            )
+        self.cursor.executemany(
+            """
+            INSERT OR IGNORE INTO mouse (name, sex, dob)
+            VALUES (?, ?, ?)""",
+            (mice),
+        )
 
     def populate_sessions(self):
+        for project in self.project_folders:
+            project_id = self.get_project_id(project)
+            mouse_folders = [f.path for f in os.scandir(project) if f.is_dir()]
+
+            for mouse_folder in mouse_folders:
+                self.populate_mouse_sessions(project_id, mouse_folder)
+
+    def populate_mouse_sessions(self, project_id, mouse_folder):
+        """
+        Add all the sessions inside one mouse folder and remember the
+        folder's modification time for incremental updates.
+
+        :return
+        ---
+        n_sessions: int
+            Number of session folders found.
+        """
         # Turn datetime string into a datetime variable.
         format_datetime = lambda folder: datetime.strptime(
             self.extract_folder_info(folder)[0], "%m_%d_%Y %H_%M_%S"
         )
 
-        for project_id, project in enumerate(self.project_folders):
-            mouse_folders = [f.path for f in os.scandir(project) if f.is_dir()]
+        mouse_name = os.path.split(mouse_folder)[-1]
+        mouse_id = self.cursor.execute(
+            """
+            SELECT id
+            FROM mouse
+            WHERE name = ?""",
+            (mouse_name,),
+        ).fetchone()[0]
+
+        data = [
+            (
+                mouse_id,
+                project_id,
+                format_datetime(folder),
+                self.extract_folder_info(folder)[1],
+                folder,
+            )
+            for folder in search_for_folders(
+                mouse_folder, "^H?[0-9]+_M?[0-9]+_S?[0-9]+$"
+            )
+        ]
 
-            for mouse_folder in mouse_folders:
-                mouse_name = os.path.split(mouse_folder)[-1]
-                mouse_id = self.cursor.execute(
-                    """
-                    SELECT id
-                    FROM mouse
-                    WHERE name = ?""",
-                    (mouse_name,),
-                ).fetchone()[0]
-
-                data = [
-                    (
-                        mouse_id,
-                        project_id + 1,
-                        format_datetime(folder),
-                        self.extract_folder_info(folder)[1],
-                        folder,
-                    )
-                    for folder in search_for_folders(
-                        mouse_folder, "^H?[0-9]+_M?[0-9]+_S?[0-9]+$"
+        self.cursor.executemany(
+            """
+            INSERT OR IGNORE INTO session
+            (mouse_id, project_id, datetime, session_name, path)
+            VALUES (?,?,?,?,?)""",
+            data,
+        )
+
+        self.cursor.execute(
+            """
+            INSERT OR REPLACE INTO mouse_folder (path, project_id, mtime)
+            VALUES (?,?,?)""",
+            (mouse_folder, project_id, folder_mtime(mouse_folder)),
+        )
+
+        return len(data)
+
+    def get_project_id(self, project_folder):
+        return self.cursor.execute(
+            """
+            SELECT id
+            FROM project
+            WHERE path = ?""",
+            (project_folder,),
+        ).fetchone()[0]
+
+    def update(self, find_projects=False):
+        """
+        Incrementally rescan the data folders. Only mouse folders whose
+        modification time (or that of their date folders) changed since
+        the last scan are walked. The duration of the scan is recorded
+        in the scan table.
+
+        :parameter
+        ---
+        find_projects: bool
+            Whether to walk the whole directory for new 'Data' folders.
+            Otherwise, only projects already in the database are checked.
+        """
+        start = time.time()
+        self.make_db()
+
+        if find_projects:
+            self.populate_projects()
+        projects = self.cursor.execute("SELECT id, path FROM project").fetchall()
+        last_mtimes = dict(
+            self.cursor.execute("SELECT path, mtime FROM mouse_folder").fetchall()
+        )
+
+        changed = []
+        n_folders = 0
+        for project_id, project in projects:
+            if not os.path.isdir(project):
+                continue
+
+            for f in os.scandir(project):
+                if not f.is_dir():
+                    continue
+                n_folders += 1
+
+                if last_mtimes.get(f.path) != folder_mtime(f.path):
+                    changed.append((project_id, f.path))
+
+        self.populate_mice([os.path.split(folder)[-1] for _, folder in changed])
+        n_sessions = sum(
+            self.populate_mouse_sessions(project_id, mouse_folder)
+            for project_id, mouse_folder in changed
+        )
+        self.log_scan(start, n_folders, "incremental", n_sessions)
+        self.connection.commit()
+        print(
+            f"Rescanned {len(changed)} of {n_folders} mouse folders "
+            f"in {time.time() - start:.1f} s"
+        )
+
+    def get_session_id(self, session_path):
+        """
+        Find a session from its folder. Sessions are stored as timestamp
+        folders, so the session folder above one also works if it only
+        holds one session.
+
+        """
+        session_path = str(session_path)
+        result = self.cursor.execute(
+            """
+            SELECT id
+            FROM session
+            WHERE path = ?""",
+            (session_path,),
+        ).fetchall()
+
+        if not result:
+            folder = os.path.join(session_path, "")
+            result = self.cursor.execute(
+                """
+                SELECT id, path
+                FROM session
+                WHERE substr(path, 1, ?) = ?""",
+                (len(folder), folder),
+            ).fetchall()
+            result = [
+                (session_id,)
+                for session_id, path in result
+                if os.path.dirname(path.rstrip("\\/")) == session_path.rstrip("\\/")
+            ]
+
+        if len(result) != 1:
+            raise ValueError(f"{session_path} is not a session in the database")
+
+        return result[0][0]
+
+    def has_table(self, table):
+        result = self.cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()
+
+        return result is not None
+
+    def record_artifact(
+        self, session_path, kind, fpath, params=None, duration=None, modified=None
+    ):
+        """
+        Record that a derived product of a session was built.
+
+        :parameters
+        ---
+        session_path: str
+            Session folder, as stored in the session table.
+
+        kind: str
+            Artifact kind, e.g. a key of artifact_files.
+
+        fpath: str
+            Path to the file that was written.
+
+        params: dict or None
+            Parameters the artifact was built with. None if unknown.
+
+        duration: float or None
+            Seconds it took to build the artifact.
+
+        modified: datetime or None
+            When the artifact was built. Defaults to now.
+        """
+        session_id = self.get_session_id(session_path)
+        if modified is None:
+            modified = datetime.now()
+
+        # NULLs are never equal in UNIQUE constraints, so replace by hand.
+        self.cursor.execute(
+            """
+            DELETE FROM artifact
+            WHERE session_id = ? AND kind = ? AND param_hash IS ?""",
+            (session_id, kind, hash_params(params)),
+        )
+        self.cursor.execute(
+            """
+            INSERT INTO artifact
+            (session_id, kind, param_hash, path, size, duration, datetime)
+            VALUES (?,?,?,?,?,?,?)""",
+            (
+                session_id,
+                kind,
+                hash_params(params),
+                str(fpath),
+                os.path.getsize(fpath),
+                duration,
+                modified,
+            ),
+        )
+
+    def scan_artifacts(self, project_name=None):
+        """
+        Record the artifacts that already exist in every session folder.
+        Their parameters are unknown, so they are stored with a NULL
+        parameter hash. Sessions are stored as timestamp folders, but
+        preprocessed behavior and pickles are in the session folder
+        above.
+
+        :parameter
+        ---
+        project_name: str or None
+            Only scan this project. If None, scans all projects.
+        """
+        self.make_db()
+        sql_str = """
+            SELECT session.path
+            FROM session
+            INNER JOIN project
+            ON project.id = session.project_id
+        """
+        if project_name is None:
+            sessions = self.execute(sql_str, ())
+        else:
+            sessions = self.execute(sql_str + "WHERE project_name = ?", (project_name,))
+
+        n_found = 0
+        for (session_path,) in sessions:
+            candidates = {session_path, os.path.split(session_path)[0]}
+            for kind, fnames in artifact_files.items():
+                for folder in candidates:
+                    found = [
+                        os.path.join(folder, fname)
+                        for fname in fnames
+                        if os.path.isfile(os.path.join(folder, fname))
+                    ]
+                    if found:
+                        break
+
+                if found:
+                    modified = datetime.fromtimestamp(os.path.getmtime(found[0]))
+                    self.record_artifact(
+                        session_path, kind, found[0], modified=modified
                     )
-                ]
+                    n_found += 1
+        self.connection.commit()
+
+        print(f"Found {n_found} artifacts in {len(sessions)} sessions")
+
+    def missing_artifacts(
+        self, kind, params=None, project_name=None, mouse=None, recorded_only=False
+    ):
+        """
+        Find sessions that do not have an artifact yet.
+
+        :parameters
+        ---
+        kind: str
+            Artifact kind, e.g. a key of artifact_files.
+
+        params: dict or None
+            Parameters the artifact needs to have been built with. If None,
+            an artifact of that kind built with any parameters counts.
+
+        project_name: str or None
+            Only consider this project.
+
+        mouse: str or None
+            Only consider this mouse.
 
-                self.cursor.executemany(
-                    """
-                    INSERT OR IGNORE INTO session
-                    (mouse_id, project_id, datetime, session_name, path)
-                    VALUES (?,?,?,?,?)""",
-                    data,
-                )
+        recorded_only: bool
+            Only report sessions where an artifact of this kind is
+            recorded, but none with these parameters or with unknown
+            ones. Those certainly need to be rebuilt, even if the
+            database was never scanned for artifacts.
+
+        :return
+        ---
+        sessions: DataFrame
+            Columns are mouse, project, session_type, path.
+        """
+        sql_str = """
+            SELECT mouse.name, project.project_name, session.session_name, session.path
+            FROM session
+            INNER JOIN mouse
+            ON mouse.id = session.mouse_id
+            INNER JOIN project
+            ON project.id = session.project_id
+            WHERE NOT EXISTS (
+                SELECT 1
+                FROM artifact
+                WHERE artifact.session_id = session.id
+                AND artifact.kind = ?
+                AND (? IS NULL OR artifact.param_hash = ?
+                     OR (? AND artifact.param_hash IS NULL)))
+        """
+        param_hash = hash_params(params)
+        args = [kind, param_hash, param_hash, recorded_only]
+        if recorded_only:
+            sql_str += """
+            AND EXISTS (
+                SELECT 1
+                FROM artifact
+                WHERE artifact.session_id = session.id
+                AND artifact.kind = ?)
+            """
+            args.append(kind)
+        if project_name is not None:
+            sql_str += " AND project.project_name = ?"
+            args.append(project_name)
+        if mouse is not None:
+            sql_str += " AND mouse.name = ?"
+            args.append(mouse)
+
+        return pd.DataFrame(
+            self.execute(sql_str, tuple(args)),
+            columns=["mouse", "project", "session_type", "path"],
+        )
+
+    def log_scan(self, start, n_folders, kind, n_sessions=None):
+        if n_sessions is None:
+            n_sessions = self.cursor.execute("SELECT COUNT(*) FROM session").fetchone()[0]
+
+        self.cursor.execute(
+            """
+            INSERT INTO scan (kind, datetime, duration, n_folders, n_sessions)
+            VALUES (?,?,?,?,?)""",
+            (kind, datetime.now(), time.time() - start, n_folders, n_sessions),
+        )
 
     def extract_folder_info(self, folder):
         """
@@ -220,6 +633,54 @@ class Database:
         return datetime_str, session_type
 
 
+def log_artifact(
+    session_path, kind, fpath, params=None, duration=None, directory=r"D:",
+    db_name="database.sqlite",
+):
+    """
+    Record an artifact that was just built in the session database, so
+    that missing_artifacts() knows what it was built with. Nothing is
+    recorded if the database doesn't exist or doesn't have the session;
+    building never fails because of it.
+
+    :parameters
+    ---
+    session_path: str
+        Session folder.
+
+    kind, fpath, params, duration:
+        See Database.record_artifact().
+
+    directory, db_name: str
+        Location of the database.
+    """
+    if not os.path.isfile(os.path.join(directory, db_name)):
+        return
+
+    try:
+        with Database(directory, db_name) as db:
+            db.make_db()
+            db.record_artifact(
+                session_path, kind, fpath, params=params, duration=duration
+            )
+    except (sqlite3.Error, ValueError) as e:
+        print(f"{fpath} was not recorded in the database: {e}")
+
+
+def hash_params(params):
+    """
+    Short, order-independent hash of the parameters used to build an
+    artifact. Returns None when params is None (unknown parameters).
+
+    """
+    if params is None:
+        return None
+
+    params_str = json.dumps(params, sort_keys=True, default=str)
+
+    return hashlib.sha1(params_str.encode()).hexdigest()[:16]
+
+
 if __name__ == "__main__":
     # Make the database on csstorage then move it to a local drive.
     with Database(directory=r"Z:\Will", from_scratch=True) as db:
@@ -1,8 +1,9 @@
 import os
+import subprocess
+import tempfile
+from functools import lru_cache
 
 from scipy.stats import circmean, mode
-from sklearn.linear_model import LinearRegression
-from sklearn.naive_bayes import BernoulliNB
 import shutil
 from tqdm import tqdm
 
@@ -15,19 +16,19 @@ from CaImaging.util import (
     make_bins,
 )
 import numpy as np
-import tkinter as tk
 
 from CaImaging.PlaceFields import spatial_bin
-
-tkroot = tk.Tk()
-tkroot.withdraw()
 from pathlib import Path
 import pandas as pd
 from natsort import natsorted
 from shutil import copyfile
 import cv2
 import re
+import time
+from joblib import Parallel, delayed
+from scipy.sparse import csr_matrix, diags
 from skimage.feature import register_translation
+from util import write_atomic
 
 
 def circle_sizes(x, y):
@@ -55,34 +56,417 @@ def circle_sizes(x, y):
     return (width, height, radius, center)
 
 
-def batch_concat_avis(mouse_folder):
+def batch_concat_avis(
+    mouse_folder, pattern="behavCam*.avi", fname="Merged.avi", fps=30, n_jobs=-1
+):
     """
-    Batch concatenates the avi chunks in a mouse folder.
+    Batch concatenates the avi chunks in a mouse folder, one session
+    per worker. See concat_session_avis().
 
     :parameter
     ---
     mouse_folder: str
         Directory containing session folders. The session folders
         must have the format H??_M??_S??.
+
+    n_jobs: int
+        Number of sessions to concatenate in parallel.
     """
     # Recursively search for the session folders.
     folders = [folder for folder in Path(mouse_folder).rglob("H??_M*_S??")]
 
     # For each folder, check that Merged.avi doesn't already exist.
+    sessions = []
     for session in folders:
-        merged_file = os.path.join(session, "Merged.avi")
+        merged_file = os.path.join(session, fname)
 
         if os.path.exists(merged_file):
             print(f"{merged_file} already exists")
+        else:
+            sessions.append(session)
 
-        # If not, concatenate the avis.
+    # If not, concatenate the avis.
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(try_concat_session_avis)(session, pattern, fname, fps)
+        for session in sessions
+    )
+    for session, (result, error) in zip(sessions, results):
+        merged_file = os.path.join(session, fname)
+        if error is not None:
+            print(f"Failed to create {merged_file}: {error}")
         else:
-            try:
-                concat_avis(
-                    session, pattern="behavCam*.avi", fname="Merged.avi", fps=30
-                )
-            except:
-                print(f"Failed to create {merged_file}")
+            method, seconds = result
+            print(f"Created {merged_file} ({method}, {seconds:.1f} s)")
+
+
+def try_concat_session_avis(session, pattern, fname, fps):
+    try:
+        return concat_session_avis(session, pattern=pattern, fname=fname, fps=fps), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def video_properties(video_path):
+    """
+    Codec, frame size, frame rate and frame count of a video.
+
+    :return
+    ---
+    properties: dict
+        With keys "fourcc" (str), "size" ((w, h) tuple), "fps" and
+        "n_frames".
+    """
+    cap = cv2.VideoCapture(str(video_path))
+    fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+    properties = {
+        "fourcc": "".join(chr((fourcc >> 8 * i) & 0xFF) for i in range(4)),
+        "size": (int(cap.get(3)), int(cap.get(4))),
+        "fps": cap.get(cv2.CAP_PROP_FPS),
+        "n_frames": int(cap.get(7)),
+    }
+    cap.release()
+
+    return properties
+
+
+def concat_session_avis(
+    session, pattern="behavCam*.avi", fname="Merged.avi", fps=30, ffmpeg_path="ffmpeg"
+):
+    """
+    Concatenate the avi chunks of a session without decoding them when
+    possible. Chunks whose codec or frame rate differ from the first
+    chunk are re-encoded to match it, then all chunks are joined at the
+    container level (see concat_videos()). If the frame sizes differ,
+    ffmpeg is not available, or the joined video is missing frames, the
+    whole session is decoded and re-encoded with concat_avis() instead.
+
+    The output is written to a temporary file and only renamed to
+    fname once its frame count matches the sum of the chunks'.
+
+    :parameters
+    ---
+    session: str
+        Session folder.
+
+    pattern: str
+        Pattern matching the chunks.
+
+    fname: str
+        Output file name.
+
+    fps: float
+        Frame rate of the output if the session has to be decoded.
+
+    ffmpeg_path: str
+        ffmpeg executable.
+
+    :return
+    ---
+    mode: str
+        "copy", "copy (n re-encoded)" or "decode".
+
+    seconds: float
+        Time taken.
+    """
+    start = time.perf_counter()
+    session = str(session)
+    merged_file = os.path.join(session, fname)
+    tmp_fname = f"partial_{fname}"
+    tmp_path = os.path.join(session, tmp_fname)
+
+    chunks = [str(path) for path in natsorted(Path(session).glob(pattern))]
+    if not chunks:
+        raise FileNotFoundError(f"No files matching {pattern} in {session}")
+    properties = [video_properties(chunk) for chunk in chunks]
+    n_frames = sum(chunk["n_frames"] for chunk in properties)
+    reference = properties[0]
+
+    mode = None
+    if all(chunk["size"] == reference["size"] for chunk in properties) and shutil.which(
+        ffmpeg_path
+    ):
+        # Re-encode only the chunks that don't match the first one.
+        matched_chunks, reencoded = [], []
+        for chunk, chunk_properties in zip(chunks, properties):
+            if (chunk_properties["fourcc"], chunk_properties["fps"]) == (
+                reference["fourcc"],
+                reference["fps"],
+            ):
+                matched_chunks.append(chunk)
+                continue
+
+            folder, chunk_fname = os.path.split(chunk)
+            matched_chunk = os.path.join(folder, f"matched_{chunk_fname}")
+            transcode_video(
+                chunk,
+                matched_chunk,
+                (slice(None), slice(None)),
+                (0, 0),
+                reference["fps"],
+                reference["size"],
+                fourcc=reference["fourcc"],
+            )
+            matched_chunks.append(matched_chunk)
+            reencoded.append(matched_chunk)
+
+        try:
+            concat_videos(matched_chunks, tmp_path, ffmpeg_path=ffmpeg_path)
+            if video_properties(tmp_path)["n_frames"] == n_frames:
+                mode = f"copy ({len(reencoded)} re-encoded)" if reencoded else "copy"
+            else:
+                print(f"Frame count mismatch in {merged_file}, decoding instead")
+        except subprocess.CalledProcessError:
+            print(f"ffmpeg failed on {merged_file}, decoding instead")
+        finally:
+            for matched_chunk in reencoded:
+                os.remove(matched_chunk)
+
+    if mode is None:
+        concat_avis(session, pattern=pattern, fname=tmp_fname, fps=fps)
+        written = video_properties(tmp_path)["n_frames"]
+        if written != n_frames:
+            os.remove(tmp_path)
+            raise ValueError(
+                f"{merged_file} would have {written} frames, chunks have {n_frames}."
+            )
+        mode = "decode"
+
+    os.replace(tmp_path, merged_file)
+
+    return mode, time.perf_counter() - start
+
+
+def iter_video_frames(cap, frames, max_skip=30):
+    """
+    Decode the requested frames of a video in the order given, reading
+    sequentially and only seeking where the frame list has a gap larger
+    than max_skip (small gaps are skipped by grabbing frames, which is
+    cheaper and more reliable than seeking). Repeated frame numbers
+    reuse the last decoded frame.
+
+    :parameters
+    ---
+    cap: cv2.VideoCapture
+        Opened video.
+
+    frames: array-like of ints
+        Frame numbers to read.
+
+    max_skip: int
+        Largest forward gap to cover by grabbing instead of seeking.
+
+    :yields
+    ---
+    frame_number: int
+
+    frame: (h, w, 3) array or None
+        None if the frame could not be read.
+    """
+    next_frame = None
+    last_number, last_frame = None, None
+    for frame_number in frames:
+        frame_number = int(frame_number)
+        if frame_number == last_number:
+            yield frame_number, last_frame
+            continue
+
+        gap = None if next_frame is None else frame_number - next_frame
+        if gap is None or gap < 0 or gap > max_skip:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+        else:
+            for _ in range(gap):
+                cap.grab()
+
+        ret, frame = cap.read()
+        next_frame = frame_number + 1
+        last_number, last_frame = frame_number, frame if ret else None
+
+        yield frame_number, last_frame
+
+
+def iter_frame_batches(video_path, frames, batch_size=256, gray=False, crop=None):
+    """
+    Read arbitrary frames of a video in batches. Frame numbers are
+    sorted and deduplicated first so the video is decoded in one forward
+    pass when they are dense, seeking only across large gaps.
+
+    :parameters
+    ---
+    video_path: str
+        Path to the video.
+
+    frames: array-like of ints
+        Frame numbers to read, in any order.
+
+    batch_size: int
+        Number of frames per batch.
+
+    gray: bool
+        Whether to convert frames to grayscale.
+
+    crop: (rows, cols) tuple or None
+        If provided, only keep frame[:rows, :cols].
+
+    :yields
+    ---
+    frame_numbers: (batch,) array
+        Frame numbers that were read successfully, sorted.
+
+    stack: (batch, h, w) or (batch, h, w, 3) array
+        The frames.
+    """
+    frames = np.unique(np.asarray(frames, dtype=int))
+    cap = cv2.VideoCapture(video_path)
+
+    frame_numbers, stack = [], []
+    for frame_number, frame in iter_video_frames(cap, frames):
+        if frame is None:
+            continue
+
+        if gray:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if crop is not None:
+            frame = frame[: crop[0], : crop[1]]
+
+        frame_numbers.append(frame_number)
+        stack.append(frame)
+
+        if len(stack) == batch_size:
+            yield np.asarray(frame_numbers), np.stack(stack)
+            frame_numbers, stack = [], []
+
+    if stack:
+        yield np.asarray(frame_numbers), np.stack(stack)
+
+    cap.release()
+
+
+def read_frames(video_path, frames, gray=False, crop=None):
+    """
+    Read arbitrary frames of a video into one array. See iter_frame_batches().
+
+    :returns
+    ---
+    frame_numbers: array
+        Frame numbers that were read successfully, sorted.
+
+    stack: array
+        The frames.
+    """
+    batches = list(iter_frame_batches(video_path, frames, gray=gray, crop=crop))
+    if not batches:
+        return np.array([], dtype=int), np.array([])
+
+    frame_numbers = np.concatenate([batch[0] for batch in batches])
+    stack = np.concatenate([batch[1] for batch in batches])
+
+    return frame_numbers, stack
+
+
+def background_image(video_path, nframes=100, crop=None, seed=0):
+    """
+    Median projection of randomly sampled grayscale frames, used as the
+    background of a behavior video. Cached per video (and per file
+    modification time) so it is only computed once per process.
+
+    :parameters
+    ---
+    video_path: str
+        Path to the video.
+
+    nframes: int
+        Number of frames to sample.
+
+    crop: (rows, cols) tuple or None
+        If provided, only keep frame[:rows, :cols].
+
+    seed: int
+        Seed for sampling frames.
+
+    :return
+    ---
+    proj: (h, w) array
+        Read-only median projection.
+    """
+    video_path = os.path.abspath(str(video_path))
+    crop = None if crop is None else tuple(int(i) for i in crop)
+
+    return cached_background_image(
+        video_path, os.path.getmtime(video_path), nframes, crop, seed
+    )
+
+
+@lru_cache(maxsize=32)
+def cached_background_image(video_path, mtime, nframes, crop, seed):
+    cap = cv2.VideoCapture(video_path)
+    total_nframes = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+
+    samples = np.random.RandomState(seed).randint(0, total_nframes, nframes)
+    frame_numbers, stack = read_frames(video_path, samples, gray=True, crop=crop)
+
+    # Sampling is with replacement, so weight repeated frames accordingly.
+    counts = np.asarray([np.sum(samples == n) for n in frame_numbers])
+    proj = np.median(np.repeat(stack, counts, axis=0), axis=0)
+    proj.setflags(write=False)
+
+    return proj
+
+
+def concat_videos(video_paths, output_path, ffmpeg_path="ffmpeg", inpoints=None):
+    """
+    Concatenate videos that share codec, frame size, and fps at the
+    container level (no decoding) with ffmpeg's concat demuxer.
+
+    :parameters
+    ---
+    video_paths: list of strs
+        Videos to concatenate, in order.
+
+    output_path: str
+        Output video.
+
+    ffmpeg_path: str
+        ffmpeg executable.
+
+    inpoints: list of floats/Nones or None
+        Time (s) to start each video from. Streams are cut at the
+        last keyframe at or before it.
+    """
+    if inpoints is None:
+        inpoints = [None] * len(video_paths)
+
+    with tempfile.NamedTemporaryFile(
+        "w", suffix=".txt", delete=False, dir=os.path.split(output_path)[0] or None
+    ) as file:
+        for path, inpoint in zip(video_paths, inpoints):
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            file.write(f"file '{escaped}'\n")
+            if inpoint is not None:
+                file.write(f"inpoint {inpoint}\n")
+        list_path = file.name
+
+    try:
+        subprocess.run(
+            [
+                ffmpeg_path,
+                "-y",
+                "-loglevel",
+                "error",
+                "-f",
+                "concat",
+                "-safe",
+                "0",
+                "-i",
+                list_path,
+                "-c",
+                "copy",
+                output_path,
+            ],
+            check=True,
+        )
+    finally:
+        os.remove(list_path)
 
 
 def get_session_folders(mouse_folder: str):
@@ -169,6 +553,145 @@ def sync(
     return corrected, minian
 
 
+def frame_slice_plan(dims, shifts, do_shift=True):
+    """
+    Express SessionStitcher.correct_frame (np.roll by shifts, then
+    trim) as slices of the original frame, so that most frames can be
+    cropped and aligned without copying.
+
+    :parameters
+    ---
+    dims: (h, w) tuple
+        Frame size before alignment.
+
+    shifts: (row, col) tuple of ints
+        Shifts from SessionStitcher.align_projections().
+
+    do_shift: boolean
+        Whether to align (session half #2) or only trim.
+
+    :return
+    ---
+    slices: (row, col) tuple of slices
+        Region of the frame to keep.
+
+    rolls: (row, col) tuple of ints
+        Left rotation of the sliced region along each axis. Only
+        nonzero for negative shifts, where np.roll wraps around and
+        trim() keeps the wrapped strip.
+    """
+    slices, rolls = [], []
+    for n, shift in zip(dims, shifts):
+        shift = int(shift)
+        if shift > 0:
+            # trim() deletes rows 0 to shift (inclusive) after rolling,
+            # leaving original rows 1 to n - shift.
+            slices.append(slice(1, n - shift) if do_shift else slice(shift + 1, n))
+            rolls.append(0)
+        else:
+            slices.append(slice(0, n))
+            rolls.append(-shift if do_shift else 0)
+
+    return tuple(slices), tuple(rolls)
+
+
+def apply_slice_plan(frame, slices, rolls, out=None):
+    """
+    Crop and align a frame with a plan from frame_slice_plan().
+
+    :parameters
+    ---
+    frame: (h, w, ...) array
+
+    slices, rolls: from frame_slice_plan()
+
+    out: array or None
+        Buffer to write rotated frames into. Only used when rolls
+        are nonzero.
+
+    :return
+    ---
+    frame: array
+        A view of frame if no rotation is needed.
+    """
+    view = frame[slices]
+    if not any(rolls):
+        return view
+
+    if out is None:
+        out = np.empty_like(view)
+    h, w = view.shape[:2]
+    r, c = rolls
+    out[: h - r, : w - c] = view[r:, c:]
+    out[: h - r, w - c :] = view[r:, :c]
+    out[h - r :, : w - c] = view[:r, c:]
+    out[h - r :, w - c :] = view[:r, :c]
+
+    return out
+
+
+def transcode_video(
+    source, destination, slices, rolls, fps, size, fourcc="MJPG"
+):
+    """
+    Crop and align every frame of a video with a slice plan and write
+    it to a new file. The video is written to a temporary file first
+    and renamed when finished.
+
+    :parameters
+    ---
+    source: str
+        Input video.
+
+    destination: str
+        Output video.
+
+    slices, rolls: from frame_slice_plan(), including the crop.
+
+    fps: float
+        Output frame rate.
+
+    size: (w, h) tuple
+        Output frame size.
+
+    fourcc: str
+        Output codec.
+
+    :return
+    ---
+    n_frames: int
+        Number of frames written.
+
+    seconds: float
+        Time taken.
+    """
+    start = time.perf_counter()
+    folder, fname = os.path.split(destination)
+    tmp_path = os.path.join(folder, f"partial_{fname}")
+
+    writer = cv2.VideoWriter(tmp_path, cv2.VideoWriter_fourcc(*fourcc), float(fps), size)
+    cap = cv2.VideoCapture(source)
+    max_frames = int(cap.get(7))
+
+    buffer = None
+    n_frames = 0
+    for _ in range(max_frames):
+        ret, frame = cap.read()
+        if not ret:
+            break
+
+        if buffer is None and any(rolls):
+            buffer = np.empty_like(frame[slices])
+        writer.write(apply_slice_plan(frame, slices, rolls, out=buffer))
+        n_frames += 1
+
+    writer.release()
+    cap.release()
+    os.replace(tmp_path, destination)
+
+    return n_frames, time.perf_counter() - start
+
+
 class SessionStitcher:
     def __init__(
         self,
@@ -179,6 +702,7 @@ class SessionStitcher:
         fps=30,
         miniscope_pattern="msCam*.avi",
         behavior_pattern="behavCam*.avi",
+        n_jobs=-1,
     ):
         """
         Combine recording folders that were split as a result of
@@ -189,6 +713,8 @@ class SessionStitcher:
         For the behavior, do the same thing but merge them into one
         file.
 
+        n_jobs is the number of behavior videos that are cropped and
+        aligned in parallel.
         """
 
         self.folder_list = folder_list
@@ -196,6 +722,7 @@ class SessionStitcher:
 
         self.recording_duration = recording_duration
         self.fps = fps
+        self.n_jobs = n_jobs
         self.interval = int(np.round((1 / self.fps) * 1000))
         self.camNum = {"miniscope": miniscope_cam, "behavior": behav_cam}
         self.file_patterns = {
@@ -480,10 +1007,7 @@ class SessionStitcher:
         files = self.get_files(source, pattern)
         do_shift = True if second else False
 
-        if camera == "behavior":
-            fourcc = cv2.VideoWriter_fourcc(*"MJPG")
-            size = self.behav_dims[::-1]
-
+        to_transcode = []
         for file in files:
             fname = os.path.split(file)[-1]
 
@@ -496,29 +1020,31 @@ class SessionStitcher:
 
             if os.path.isfile(destination):
                 print(f"{destination} already exists. Skipping.")
-            else:
-                if camera == "miniscope":
-                    print(f"Copying to {destination}.")
-                    copyfile(file, destination)
-                elif camera == "behavior":
-                    print(f"Copying and cropping to {destination}.")
-                    writer = cv2.VideoWriter(destination, fourcc, float(self.fps), size)
-                    cap = cv2.VideoCapture(file)
-                    cap.set(1, 0)  # First frame.
-                    max_frames = int(cap.get(7))
-
-                    for _ in range(max_frames):
-                        ret, frame = cap.read()
-
-                        if ret:
-                            frame = frame[: self.common_dims[0], : self.common_dims[1]]
-                            final_frame = self.correct_frame(frame, do_shift=do_shift)
-
-                            writer.write(final_frame)
-                        else:
-                            break
+            elif camera == "miniscope":
+                print(f"Copying to {destination}.")
+                copyfile(file, destination)
+            elif camera == "behavior":
+                to_transcode.append((file, destination))
+
+        if not to_transcode:
+            return
+
+        # The crop to the common dimensions and the alignment are the
+        # same for every frame, so compute them once as slices.
+        slices, rolls = frame_slice_plan(self.common_dims, self.shifts, do_shift)
+        size = tuple(self.behav_dims[::-1])
+        print(f"Copying and cropping {len(to_transcode)} videos.")
+        start = time.perf_counter()
+        results = Parallel(n_jobs=self.n_jobs)(
+            delayed(transcode_video)(file, destination, slices, rolls, self.fps, size)
+            for file, destination in to_transcode
+        )
+        elapsed = time.perf_counter() - start
 
-                    writer.release()
+        for (_, destination), (n_frames, seconds) in zip(to_transcode, results):
+            print(f"{destination}: {n_frames} frames, {n_frames / seconds:.0f} fps.")
+        n_frames = sum(n for n, _ in results)
+        print(f"Total: {n_frames} frames in {elapsed:.1f} s ({n_frames / elapsed:.0f} fps).")
 
     def make_missing_video(self, camera):
         """
@@ -622,33 +1148,7 @@ class SessionStitcher:
         proj: (h,w) array
             Median projection.
         """
-        cap = cv2.VideoCapture(video_path)
-        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-
-        if crop is not None:
-            h, w = crop
-        else:
-            ret, frame = cap.read()
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            h, w = frame.shape
-        last_frame = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-
-        collection = np.zeros((nframes, h, w))
-        samples = np.random.randint(0, last_frame, nframes)
-        for i, frame in enumerate(samples):
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame)
-            ret, frame = cap.read()
-
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-            if crop is not None:
-                collection[i] = gray[: crop[0], : crop[1]]
-            else:
-                collection[i] = gray
-
-        cap.release()
-
-        proj = np.median(collection, axis=0)
+        proj = background_image(video_path, nframes=nframes, crop=crop)
 
         return proj
 
@@ -708,13 +1208,9 @@ class SessionStitcher:
             Whether to do the alignment. Only do this for session
             half #2.
         """
-        if do_shift:
-            shifted = np.roll(img, self.shifts, (0, 1))
-        else:
-            shifted = img
-        final = self.trim(shifted)
+        slices, rolls = frame_slice_plan(img.shape[:2], self.shifts, do_shift)
 
-        return final
+        return apply_slice_plan(img, slices, rolls)
 
     def trim(self, img):
         """
@@ -739,6 +1235,45 @@ class SessionStitcher:
         return img
 
 
+def read_lick_file(fpath):
+    """
+    Read a lick file written by the Arduino (port, frame, timestamp).
+
+    """
+    lick_df = pd.read_csv(fpath, header=None)
+    lick_df.columns = ["Port", "Frame Number", "Time Stamp (ms)"]
+
+    return lick_df
+
+
+def check_monotonic(df, fname, strict_frames=True):
+    """
+    Raise a ValueError if frame numbers or timestamps go backwards.
+
+    :parameters
+    ---
+    df: DataFrame
+        With "Frame Number" and "Time Stamp (ms)" columns.
+
+    fname: str
+        File name, for the error message.
+
+    strict_frames: boolean
+        Whether frame numbers must strictly increase (timestamp files)
+        or may repeat (lick files).
+    """
+    frame_steps = np.diff(np.asarray(df["Frame Number"]))
+    timestamp_steps = np.diff(np.asarray(df["Time Stamp (ms)"]))
+    bad_frames = frame_steps <= 0 if strict_frames else frame_steps < 0
+
+    for bad, column in zip(
+        [bad_frames, timestamp_steps < 0], ["Frame Number", "Time Stamp (ms)"]
+    ):
+        if np.any(bad):
+            row = np.flatnonzero(bad)[0] + 1
+            raise ValueError(f"{column} is not monotonic at row {row} of merged {fname}.")
+
+
 class SessionStitcherV4:
     def __init__(self, session_folder):
         self.paths = dict()
@@ -815,81 +1350,66 @@ class SessionStitcherV4:
         return n
 
     def combine_files(self):
-        lick_files_concatenated = False
+        """
+        Append the timestamps of every later segment to the first
+        segment's timeStamps.csv (miniscope and behavior) and the
+        later lick files to the first lick file. Frame numbers and
+        timestamps of each segment are offset to follow the previous
+        one. Licks use the miniscope offsets.
+
+        Each file is read once. Every merged file is checked for
+        monotonic frame numbers and timestamps before anything is
+        written, and then written once, atomically.
+        """
+        n_segments = len(self.paths["lick_files"][1:])
+        merged, offsets = dict(), dict()
         for data_stream in ["miniscope", "behavior"]:
-            # Get the base timestamp file, where we'll be appending to.
             original_fname = os.path.join(self.paths[data_stream][0], "timeStamps.csv")
+            segments = [pd.read_csv(original_fname)]
+            offsets[data_stream] = []
 
-            original_lick_file = self.paths["lick_files"][0]
+            for folder in self.paths[data_stream][1 : n_segments + 1]:
+                # Offsets follow the last values of everything merged so far.
+                last_frame = segments[-1]["Frame Number"].iloc[-1]
+                last_timestamp = segments[-1]["Time Stamp (ms)"].iloc[-1]
+                offsets[data_stream].append((last_frame + 1, last_timestamp + 33))
 
-            for folder, lick_file in zip(
-                self.paths[data_stream][1:], self.paths["lick_files"][1:]
-            ):
-                # Get the last values from the base file.
-                original_df = pd.read_csv(original_fname)
-                last_frame = original_df["Frame Number"].iloc[-1]
-                last_timestamp = original_df["Time Stamp (ms)"].iloc[-1]
-
-                if not lick_files_concatenated:
-                    # Read original lick file.
-                    original_lick_df = pd.read_csv(original_lick_file, header=None)
-                    original_lick_df.columns = [
-                        "Port",
-                        "Frame Number",
-                        "Time Stamp (ms)",
-                    ]
-
-                    # Read lick file to append.
-                    lick_df_to_append = pd.read_csv(lick_file, header=None)
-                    lick_df_to_append.columns = [
-                        "Port",
-                        "Frame Number",
-                        "Time Stamp (ms)",
-                    ]
-
-                    # Add values to frame and timestamps.
-                    lick_df_to_append["Frame Number"] += last_frame + 1
-                    lick_df_to_append["Time Stamp (ms)"] += last_timestamp + 33
-
-                    # Concatenate.
-                    lick_df = pd.concat((original_lick_df, lick_df_to_append))
-                    lick_df = lick_df.astype(
-                        {
-                            "Port": int,
-                            "Frame Number": int,
-                            "Time Stamp (ms)": int,
-                        }
-                    )
-
-                    # Save and replace.
-                    lick_df.to_csv(original_lick_file, header=False, index=False)
-                    print(
-                        f"{lick_file} successfully combined with {original_lick_file}"
-                    )
-
-                # Get the file to append to.
-                append_fname = os.path.join(folder, "timeStamps.csv")
-                df_to_append = pd.read_csv(append_fname)
-
-                # Modify the values to add onto the base file.
-                df_to_append["Time Stamp (ms)"].iloc[0] = 0
+                df_to_append = pd.read_csv(os.path.join(folder, "timeStamps.csv"))
+                df_to_append.loc[df_to_append.index[0], "Time Stamp (ms)"] = 0
                 df_to_append["Time Stamp (ms)"] += last_timestamp + 33
                 df_to_append["Frame Number"] += last_frame + 1
+                segments.append(df_to_append)
 
-                # Concatenate.
-                new_df = pd.concat((original_df, df_to_append))
-                new_df = new_df.astype(
-                    {
-                        "Frame Number": int,
-                        "Time Stamp (ms)": int,
-                    }
-                )
+            df = pd.concat(segments).astype({"Frame Number": int, "Time Stamp (ms)": int})
+            check_monotonic(df, original_fname, strict_frames=True)
+            merged[original_fname] = df
+
+        if n_segments:
+            original_lick_file = self.paths["lick_files"][0]
+            segments = [read_lick_file(original_lick_file)]
+            for lick_file, (frame_offset, timestamp_offset) in zip(
+                self.paths["lick_files"][1:], offsets["miniscope"]
+            ):
+                lick_df_to_append = read_lick_file(lick_file)
+                lick_df_to_append["Frame Number"] += frame_offset
+                lick_df_to_append["Time Stamp (ms)"] += timestamp_offset
+                segments.append(lick_df_to_append)
+
+            lick_df = pd.concat(segments).astype(
+                {"Port": int, "Frame Number": int, "Time Stamp (ms)": int}
+            )
+            check_monotonic(lick_df, original_lick_file, strict_frames=False)
 
-                # Save the new timestamp file.
-                new_df.to_csv(original_fname, index=False)
-                print(f"{append_fname} successfully combined with {original_fname}.")
+        for fname, df in merged.items():
+            write_atomic(fname, lambda tmp_path: df.to_csv(tmp_path, index=False))
+            print(f"Combined {n_segments + 1} segments into {fname}.")
 
-            lick_files_concatenated = True
+        if n_segments:
+            write_atomic(
+                original_lick_file,
+                lambda tmp_path: lick_df.to_csv(tmp_path, header=False, index=False),
+            )
+            print(f"Combined {n_segments + 1} lick files into {original_lick_file}.")
 
 
 def get_equivalent_local_path(folder, local_base=r"D:\Projects", depth=2):
@@ -899,6 +1419,70 @@ def get_equivalent_local_path(folder, local_base=r"D:\Projects", depth=2):
     return os.path.join(local_base, *split_tree[depth:])
 
 
+def float_dtype(precision):
+    """
+    Numpy dtype for a precision mode.
+
+    :parameter
+    ---
+    precision: str
+        "float64" or "float32".
+    """
+    if precision not in ["float64", "float32"]:
+        raise ValueError(f"precision must be float64 or float32, not {precision}")
+
+    return np.dtype(precision)
+
+
+def cast_floats(data, dtype, keys=None):
+    """
+    Cast the floating point arrays of a dict to another dtype, in
+    place. Integer and boolean arrays are left alone.
+
+    :parameters
+    ---
+    data: dict
+        e.g., CalciumSession.imaging.
+
+    dtype: numpy dtype
+
+    keys: list of str or None
+        Only cast these keys. If None, tries every key.
+    """
+    for key in data.keys() if keys is None else keys:
+        value = data.get(key)
+        if (
+            isinstance(value, np.ndarray)
+            and np.issubdtype(value.dtype, np.floating)
+            and value.dtype != dtype
+        ):
+            data[key] = value.astype(dtype)
+
+    return data
+
+
+def zscore_upcast(data, axis=0, nan_policy="propagate"):
+    """
+    Z-score like scipy.stats.zscore, but accumulate the means and
+    standard deviations in float64 and return an array with the dtype
+    of data. Keeps float32 data float32 without losing precision in
+    long sums.
+
+    """
+    data = np.asarray(data)
+    mean_fun, std_fun = (
+        (np.nanmean, np.nanstd) if nan_policy == "omit" else (np.mean, np.std)
+    )
+    mean = mean_fun(data, axis=axis, dtype=np.float64, keepdims=True)
+    std = std_fun(data, axis=axis, dtype=np.float64, keepdims=True)
+    dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.float64
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return ((data - mean.astype(dtype)) / std.astype(dtype)).astype(
+            dtype, copy=False
+        )
+
+
 def get_circular_error(y_predicted, y_real, n_spatial_bins):
     """
     Error is not linear here, it's circular because for example,
@@ -929,7 +1513,7 @@ def format_spatial_location_for_decoder(
         n_spatial_bins=36,
         time_bin_size=1,
         fps=15,
-        classifier=BernoulliNB(),
+        classifier=None,
 ):
     """
     Naive Bayes classifiers only take integers as outcomes.
@@ -948,7 +1532,13 @@ def format_spatial_location_for_decoder(
 
     fps: int
         Frames per second of the acquired data.
+
+    classifier: sklearn estimator or None
+        Positions are only binned spatially if this is not a
+        LinearRegression. None behaves like a Naive Bayes classifier.
     """
+    from sklearn.linear_model import LinearRegression
+
     # Find the appropriate bin edges given number of spatial bins.
     # Then do spatial bin.
     dont_bin_space = True if isinstance(classifier, (LinearRegression)) else False
@@ -982,55 +1572,425 @@ def find_reward_spatial_bins(lin_position, port_locations, spatial_bin_size_radi
 
     return reward_locations_bins, bins
 
-def replace_LEDoff_frames(fpath, replacement_frame_number=4):
-    folder = os.path.join(os.path.split(fpath)[0], 'originals')
-    if not os.path.exists(folder):
-        os.mkdir(folder)
 
-    fname = os.path.split(fpath)[1]
-    move_fpath = os.path.join(folder, fname)
+def spatial_bin_index(position, bin_edges):
+    """
+    Spatial bin of each frame, following np.histogram's edge rules.
 
-    # Move the original file.
-    if not os.path.exists(move_fpath):
-        shutil.move(fpath, move_fpath)
-        print(f'Moved {fpath} to {move_fpath}')
+    :return
+    ---
+    bins: (frame,) array of ints
+        -1 for positions outside the edges (or NaN).
+    """
+    position = np.asarray(position, dtype=float)
+    bin_edges = np.asarray(bin_edges, dtype=float)
+
+    bins = np.searchsorted(bin_edges, position, side="right") - 1
+    bins[position == bin_edges[-1]] = len(bin_edges) - 2
+    bins[~((position >= bin_edges[0]) & (position <= bin_edges[-1]))] = -1
+
+    return bins
+
+
+def position_indicator(position, bin_edges, trials=None, n_trials=None, mask=None):
+    """
+    Sparse one-hot (frame, bin) matrix of which spatial bin the animal
+    is in on each frame. Multiplying activity by it bins all units at
+    once, like spatial_bin() with bins=bin_edges and weights=activity,
+    but without building a histogram per unit.
+
+    :parameters
+    ---
+    position: (frame,) array
+        e.g., linearized position.
+
+    bin_edges: array
+        Bin edges. As in np.histogram, the last bin includes its
+        right edge and positions outside the edges are dropped.
+
+    trials: (frame,) array or None
+        Trial number of each frame. If provided, columns are
+        (trial, bin) pairs, trial-major.
+
+    n_trials: int or None
+        Number of trials. Frames from other trials are dropped.
+        Defaults to max(trials) + 1.
+
+    mask: (frame,) boolean array or None
+        Frames to include, e.g., running epochs.
+
+    :return
+    ---
+    indicator: (frame, bin) or (frame, trial * bin) csr_matrix
+    """
+    n_bins = len(bin_edges) - 1
+    bins = spatial_bin_index(position, bin_edges)
+    keep = bins >= 0
+    if mask is not None:
+        keep &= np.asarray(mask, dtype=bool)
+
+    n_columns = n_bins
+    if trials is not None:
+        trials = np.asarray(trials)
+        if n_trials is None:
+            n_trials = int(np.max(trials)) + 1
+        keep &= (trials >= 0) & (trials < n_trials)
+        bins = np.where(keep, trials * n_bins + bins, 0)
+        n_columns = n_trials * n_bins
+
+    frames = np.flatnonzero(keep)
+
+    return csr_matrix(
+        (np.ones(len(frames)), (frames, bins[frames])),
+        shape=(len(position), n_columns),
+    )
+
+
+def bin_activity(activity, indicator, n_trials=None, dtype=None, nan_as_zero=False):
+    """
+    Spatially bin the activity of many units with one sparse matrix
+    product. See position_indicator().
+
+    :parameters
+    ---
+    activity: (unit, frame) array
+
+    indicator: csr_matrix
+        From position_indicator().
+
+    n_trials: int or None
+        If the indicator was built with trials, the number of trials.
+
+    dtype: dtype or None
+        Output dtype. Defaults to float64.
+
+    nan_as_zero: boolean
+        Count NaNs as zero activity instead of letting them propagate
+        into their bin. Only the frames that contain NaNs are copied.
+
+    :return
+    ---
+    fields: (unit, bin) or (unit, trial, bin) array
+        Summed activity in each bin.
+    """
+    activity = np.atleast_2d(activity).astype(np.float64, copy=False)
+
+    nan_frames = np.zeros(0, dtype=int)
+    if nan_as_zero:
+        nan_frames = np.flatnonzero(np.isnan(activity).any(axis=0))
+    if len(nan_frames):
+        # Drop the frames with NaNs from the product (NaN * 0 is still
+        # NaN, so the zeros can't be left stored), then add them back
+        # with the NaNs zeroed.
+        keep = np.ones(indicator.shape[0])
+        keep[nan_frames] = 0
+        clean = diags(keep).dot(indicator).tocsr()
+        clean.eliminate_zeros()
+        fields = clean.T.dot(activity.T).T
+        fields += indicator[nan_frames].T.dot(np.nan_to_num(activity[:, nan_frames]).T).T
+        fields = np.asarray(fields, dtype=dtype or np.float64)
     else:
-        raise FileExistsError('The folder is already storing an original 0.avi. Aborting to prevent overwrite.')
+        fields = np.asarray(indicator.T.dot(activity.T).T, dtype=dtype or np.float64)
+
+    if n_trials is not None:
+        fields = fields.reshape(activity.shape[0], n_trials, -1)
+
+    return fields
 
-    compressionCodec = "FFV1"
-    codec = cv2.VideoWriter.fourcc(*compressionCodec)
+def replace_LEDoff_frames(
+    fpath, replacement_frame_number=4, mode="prefix", ffmpeg_path="ffmpeg"
+):
+    """
+    Replace the frames at the start of a miniscope video that were
+    recorded before the LED turned on with a later frame. The original
+    video is moved to an "originals" folder next to it.
+
+    :parameters
+    ---
+    fpath: str
+        Path to the video.
+
+    replacement_frame_number: int
+        Frames before this one are replaced with it.
 
-    cap = cv2.VideoCapture(move_fpath)
-    rows, cols = int(cap.get(4)), int(cap.get(3))
+    mode: str
+        "prefix" to only re-encode the frames up to the first keyframe
+        after the replaced ones and copy the rest of the video without
+        decoding it. Falls back to "full" if there is no such keyframe,
+        ffmpeg is not available, or the spliced video doesn't match
+        the original.
+        "full" to decode and re-encode every frame.
+
+    ffmpeg_path: str
+        ffmpeg executable.
+
+    :return
+    ---
+    mode: str
+        The mode that was used.
+    """
+    fpath = str(fpath)
+    folder, fname = os.path.split(fpath)
+    originals_folder = os.path.join(folder, "originals")
+    move_fpath = os.path.join(originals_folder, fname)
+    tmp_path = os.path.join(folder, f"partial_{fname}")
+
+    if os.path.exists(move_fpath):
+        raise FileExistsError(
+            f"The folder is already storing an original {fname}. "
+            "Aborting to prevent overwrite."
+        )
+
+    properties = video_properties(fpath)
+    cap = cv2.VideoCapture(fpath)
 
     # Get replacement frame.
     cap.set(cv2.CAP_PROP_POS_FRAMES, replacement_frame_number)
-    _, replacement_frame = cap.read()
-    replacement_frame = replacement_frame[:,:,1]
+    ret, replacement_frame = cap.read()
+    cap.release()
+    if not ret:
+        raise ValueError(f"{fpath} has no frame {replacement_frame_number}.")
+
+    # Miniscope videos are grayscale, decoded as three identical
+    # channels. Only write one channel in that case.
+    is_color = not (
+        np.array_equal(replacement_frame[:, :, 0], replacement_frame[:, :, 1])
+        and np.array_equal(replacement_frame[:, :, 0], replacement_frame[:, :, 2])
+    )
+    if not is_color:
+        replacement_frame = replacement_frame[:, :, 1]
+    cut = None
+    if mode == "prefix" and shutil.which(ffmpeg_path):
+        keyframes = find_keyframes(fpath, ffmpeg_path=ffmpeg_path)
+        keyframes = keyframes[keyframes >= replacement_frame_number]
+        if len(keyframes):
+            cut = int(keyframes[0])
+    if cut is None:
+        mode = "full"
+
+    if mode == "prefix":
+        # Re-encode everything before the cut, then copy the rest.
+        prefix_path = os.path.join(folder, f"prefix_{fname}")
+        writer = cv2.VideoWriter(
+            prefix_path,
+            cv2.VideoWriter_fourcc(*properties["fourcc"].upper()),
+            properties["fps"],
+            properties["size"],
+            isColor=is_color,
+        )
+        for _ in range(replacement_frame_number):
+            writer.write(replacement_frame)
+        for frame in read_frames(fpath, range(replacement_frame_number, cut))[1]:
+            writer.write(frame if is_color else frame[:, :, 1])
+        writer.release()
 
-    #Return to the first frame.
-    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        try:
+            concat_videos(
+                [prefix_path, fpath],
+                tmp_path,
+                ffmpeg_path=ffmpeg_path,
+                inpoints=[None, cut / properties["fps"]],
+            )
+        except subprocess.CalledProcessError:
+            mode = "full"
+        finally:
+            os.remove(prefix_path)
 
-    writeFile = cv2.VideoWriter(fpath, codec, 60, (cols, rows), isColor=False)
-    # Rewrite video file.
-    print(f'Writing new {fpath}')
-    for frame_number in tqdm(range(int(cap.get(7)))):
-        ret, frame = cap.read()
+        if mode == "prefix" and not video_matches(
+            tmp_path, fpath, properties["n_frames"], cut, copied=True
+        ):
+            mode = "full"
+
+    if mode == "full":
+        rewrite_video(
+            fpath,
+            tmp_path,
+            properties,
+            replacement_frame,
+            replacement_frame_number,
+            is_color,
+        )
+        if not video_matches(
+            tmp_path, fpath, properties["n_frames"], replacement_frame_number
+        ):
+            os.remove(tmp_path)
+            raise ValueError(f"Rewritten {fpath} does not match the original.")
 
-        if ret:
-            if frame_number < replacement_frame_number:
-                writeFile.write(np.uint8(replacement_frame))
-            else:
-                writeFile.write(np.uint8(frame[:,:,1]))
+    # Move the original file.
+    if not os.path.exists(originals_folder):
+        os.mkdir(originals_folder)
+    shutil.move(fpath, move_fpath)
+    print(f"Moved {fpath} to {move_fpath}")
+    os.replace(tmp_path, fpath)
 
-        else:
+    return mode
+
+
+def rewrite_video(
+    source, destination, properties, replacement_frame, replacement_frame_number, is_color
+):
+    """
+    Decode and re-encode a whole video, replacing its first frames.
+    Frames are read into a preallocated buffer.
+
+    """
+    cap = cv2.VideoCapture(source)
+    writer = cv2.VideoWriter(
+        destination,
+        cv2.VideoWriter_fourcc(*properties["fourcc"].upper()),
+        properties["fps"],
+        properties["size"],
+        isColor=is_color,
+    )
+    w, h = properties["size"]
+    buffer = np.empty((h, w, 3), dtype=np.uint8)
+
+    # Rewrite video file.
+    print(f"Writing new {source}")
+    for frame_number in tqdm(range(properties["n_frames"])):
+        ret, frame = cap.read(buffer)
+        if not ret:
             break
 
-    writeFile.release()
+        if frame_number < replacement_frame_number:
+            writer.write(replacement_frame)
+        else:
+            writer.write(frame if is_color else frame[:, :, 1])
+
+    writer.release()
     cap.release()
-    cv2.destroyAllWindows()
 
 
+def video_matches(
+    new_path, original_path, n_frames, frame_number, copied=False, tolerance=2
+):
+    """
+    Check that a rewritten video has the same frame count as the
+    original, that its first frame is the original's frame_number (the
+    replacement frame), and that its frame_number and last frame decode
+    to the same content as the original's.
+
+    :parameters
+    ---
+    copied: boolean
+        Whether frame_number onwards was copied without re-encoding, in
+        which case those frames must be identical to the original.
+
+    tolerance: float
+        Largest mean absolute difference (in gray levels) allowed
+        between re-encoded frames and the original's.
+    """
+    if video_properties(new_path)["n_frames"] != n_frames:
+        return False
+
+    frame_numbers = sorted({frame_number, n_frames - 1})
+    new = dict(zip(*read_frames(new_path, [0] + frame_numbers)))
+    original = dict(zip(*read_frames(original_path, frame_numbers)))
+    pairs = [(new.get(0), original.get(frame_number), tolerance)] + [
+        (new.get(i), original.get(i), 0 if copied else tolerance)
+        for i in frame_numbers
+    ]
+    for new_frame, original_frame, limit in pairs:
+        if new_frame is None or original_frame is None:
+            return False
+        if (
+            new_frame.shape != original_frame.shape
+            or new_frame.dtype != original_frame.dtype
+        ):
+            return False
+        if np.abs(new_frame.astype(float) - original_frame).mean() > limit:
+            return False
+
+    return True
+
+
+def find_keyframes(video_path, ffmpeg_path="ffmpeg"):
+    """
+    Frame numbers of the keyframes of a video, from its packet flags
+    (no decoding).
+
+    :return
+    ---
+    keyframes: array of ints
+    """
+    output = subprocess.run(
+        [
+            ffmpeg_path,
+            "-loglevel",
+            "error",
+            "-i",
+            str(video_path),
+            "-map",
+            "0:v:0",
+            "-c",
+            "copy",
+            "-f",
+            "framecrc",
+            "-",
+        ],
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout
+
+    # One line per packet. Packets other than keyframes have F=<flags>
+    # with the keyframe bit unset.
+    packets = [line for line in output.splitlines() if line and not line.startswith("#")]
+    keyframes = [
+        i
+        for i, packet in enumerate(packets)
+        if "F=" not in packet or int(packet.split("F=")[1], 16) & 1
+    ]
+
+    return np.asarray(keyframes, dtype=int)
+
+
+def batch_replace_LEDoff_frames(
+    folder, pattern="0.avi", replacement_frame_number=4, mode="prefix", n_jobs=-1
+):
+    """
+    Run replace_LEDoff_frames() in parallel on every video under a
+    folder that matches a pattern and has not been processed yet.
+
+    :parameters
+    ---
+    folder: str
+        Directory to search recursively.
+
+    pattern: str
+        Pattern matching the affected videos.
+
+    n_jobs: int
+        Number of videos to process in parallel.
+    """
+    fpaths = [
+        str(fpath)
+        for fpath in natsorted(Path(folder).rglob(pattern))
+        if fpath.parent.name != "originals"
+        and not (fpath.parent / "originals" / fpath.name).exists()
+    ]
+
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(try_replace_LEDoff_frames)(fpath, replacement_frame_number, mode)
+        for fpath in fpaths
+    )
+    failed = []
+    for fpath, (mode_used, error) in zip(fpaths, results):
+        if error is not None:
+            failed.append((fpath, error))
+        else:
+            print(f"Replaced LED-off frames in {fpath} ({mode_used})")
+
+    for fpath, error in failed:
+        print(f"Failed to replace LED-off frames in {fpath}: {error}")
+
+
+def try_replace_LEDoff_frames(fpath, replacement_frame_number, mode):
+    try:
+        return replace_LEDoff_frames(fpath, replacement_frame_number, mode), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
 
 if __name__ == "__main__":
     dpath = r'Z:\Will\RemoteReversal\Data\Ron\2021_12_13_Goals1\16_04_26\Miniscope'
@@ -1,5 +1,4 @@
-from tkinter import filedialog
-from util import Session_Metadata
+from util import Session_Metadata, ask_directory
 from CaImaging.Behavior import convert_dlc_to_eztrack
 import pandas as pd
 import os
@@ -34,7 +33,7 @@ class Preprocess:
             Folder path to session.
         """
         if folder is None:
-            self.folder = filedialog.askdirectory()
+            self.folder = ask_directory()
         else:
             self.folder = folder
 
@@ -374,7 +373,7 @@ class BehaviorSession:
         # If folder is not specified, open a dialog box.
         self.meta = dict()
         if folder is None:
-            self.meta["folder"] = filedialog.askdirectory()
+            self.meta["folder"] = ask_directory()
         else:
             self.meta["folder"] = folder
 
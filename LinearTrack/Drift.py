@@ -5,7 +5,6 @@ from CircleTrack.SessionCollation import MultiAnimal
 from CircleTrack.BehaviorFunctions import BehaviorSession
 from LinearTrack.MiniscopeFunctions import CalciumSession
 from CaImaging.Behavior import spatial_bin
-from sklearn.impute import SimpleImputer
 from CaImaging.CellReg import rearrange_neurons, trim_map
 from scipy.stats import spearmanr, pearsonr
 from CaImaging.util import nan_array, sem
@@ -15,6 +14,8 @@ import matplotlib.patches as mpatches
 import xarray as xr
 import pandas as pd
 from CaImaging.plotting import errorfill, beautify_ax
+from CircleTrack.Memoization import MethodCache, memoized
+from CircleTrack.utils import position_indicator, bin_activity
 
 plt.rcParams["pdf.fonttype"] = 42
 plt.rcParams["svg.fonttype"] = "none"
@@ -42,8 +43,52 @@ aged_mice = [
     "PSAM_3",
 ]
 
+def condition_pfs(neural_data, x, mask, nbins=51, normalize_by_occ=True):
+    """
+    Place fields of all neurons over the frames in mask, binned with
+    one sparse matrix product instead of one histogram per neuron.
+    Bins span the positions in mask, as in spatial_bin(). NaNs count
+    as zero activity.
+
+    :parameters
+    ---
+    neural_data: (neuron, frame) array
+
+    x: (frame,) array
+        Position.
+
+    mask: (frame,) boolean array
+        Frames to include (e.g., running in one direction).
+
+    nbins: int
+        Number of spatial bins.
+
+    normalize_by_occ: bool
+        Normalize by occupancy.
+
+    :return
+    ---
+    pfs: (neuron, bin) array
+    """
+    position = x[mask]
+    occupancy_map, bin_edges = spatial_bin(
+        position,
+        position,
+        nbins=nbins,
+        one_dim=True,
+    )[:2]
+
+    pfs = bin_activity(
+        neural_data, position_indicator(x, bin_edges, mask=mask), nan_as_zero=True
+    )
+    if normalize_by_occ:
+        pfs = pfs / occupancy_map
+
+    return pfs
+
+
 class Drift:
-    def __init__(self, mice):
+    def __init__(self, mice, memo_mb=1024):
         self.lt_data = MultiAnimal(mice, project_name='LinearTrack',
                                    SessionFunction=CalciumSession,
                                    session_types=session_types['lineartrack'])
@@ -71,6 +116,10 @@ class Drift:
             'lineartrack': self.meta['session_types']['lineartrack']
     }
 
+        # Place fields of all neurons, keyed on (mouse, session, nbins,
+        # normalize_by_occ), shared by the PV correlation methods.
+        self.memo = MethodCache(max_mb=memo_mb)
+
     def scatter_box(self, data, ylabel='', ax=None, fig=None,
                     categories=ages, colors=age_colors):
         if ax is None:
@@ -639,77 +688,81 @@ class Drift:
 
         return pfs, orders
 
-    def get_split_trial_pfs(self, mouse, session_type, nbins=51, neurons=None,
-                            normalize_by_occ=True, show_plot=False):
+    @memoized
+    def session_pfs(self, mouse, session_type, nbins=51, normalize_by_occ=True,
+                    split_trials=False):
         """
-        Split the session in half by taking every other trial and computing
-        place fields. Note that one trial is in one direction (trial 0 = left,
-        trial 1 = right, trial 2 = left), so we taking every 4 trials by
-        that definition.
+        Place fields of all neurons in a session for left and right
+        directions, either over all trials or split into even and odd
+        trials (see get_split_trial_pfs). Cached, so that the PV
+        correlation methods bin each session once per setting.
+
+        :return
+        ---
+        pfs: dict
+            {direction: (neuron, bin) array}, or
+            {'even'/'odd': {direction: (neuron, bin) array}} if
+            split_trials.
         """
         session = self.lt_data[mouse][session_type]
 
-        # Get relevant behavioral data.
-        x = session.behavior.data['df']['x']
-        running = session.spatial.data['running']
-        session_directions = session.behavior.data['df']['direction']
-        trials = session.behavior.data['df']['trials']
-
-        # Get imaging data.
+        # Get x position and running timestamps.
+        x = np.asarray(session.behavior.data['df']['x'])
+        running = np.asarray(session.spatial.data['running'], dtype=bool)
+        session_directions = np.asarray(session.behavior.data['df']['direction'])
         neural_data = session.imaging['S']
-        imp = SimpleImputer(missing_values=np.nan, strategy='constant',
-                            fill_value=0)
-        neural_data = imp.fit_transform(neural_data.T).T
 
-        # Only analyze selected neurons, unless unspecified.
-        if neurons is None:
-            neurons = [n for n in range(neural_data.shape[0])]
-        neural_data = neural_data[neurons]
+        if not split_trials:
+            return {
+                direction: condition_pfs(neural_data, x,
+                                         running & (session_directions==direction),
+                                         nbins=nbins, normalize_by_occ=normalize_by_occ)
+                for direction in directions
+            }
 
-        pfs = {
-            trial: {direction: [] for direction in directions}
-            for trial in ['even', 'odd']
-        }
+        trials = np.asarray(session.behavior.data['df']['trials'])
         # Figure out which trial to start on for left and right directions.
         start_trial = {
             direction: min(trials[session_directions==direction])
             for direction in directions
         }
 
+        pfs = {trial_type: {} for trial_type in ['even', 'odd']}
         for trial_offset, trial_type in zip([0, 2], ['even', 'odd']):
             for direction in directions:
                 trials_to_include = range(start_trial[direction] + trial_offset,
                                           session.behavior.data['ntrials'], 4)
 
                 # Only take running in one direction and in the list of trials.
-                mask = np.logical_and(running, session_directions==direction)
-                mask = np.logical_and(mask, np.in1d(trials, trials_to_include))
-                position = x[mask]
-
-                if normalize_by_occ:
-                    occupancy_map = spatial_bin(
-                        position,
-                        position,
-                        nbins=nbins,
-                        one_dim=True,
-                    )[0]
-
-                for neuron in neural_data:
-                    pf = spatial_bin(
-                        position,
-                        position,
-                        nbins=nbins,
-                        show_plot=False,
-                        weights=neuron[mask],
-                        one_dim=True
-                    )[0]
-
-                    if normalize_by_occ:
-                        pf = pf / occupancy_map
-
-                    pfs[trial_type][direction].append(pf)
-
-                pfs[trial_type][direction] = np.vstack(pfs[trial_type][direction])
+                mask = running & (session_directions==direction)
+                mask &= np.isin(trials, trials_to_include)
+
+                pfs[trial_type][direction] = condition_pfs(
+                    neural_data, x, mask, nbins=nbins,
+                    normalize_by_occ=normalize_by_occ
+                )
+
+        return pfs
+
+    def get_split_trial_pfs(self, mouse, session_type, nbins=51, neurons=None,
+                            normalize_by_occ=True, show_plot=False):
+        """
+        Split the session in half by taking every other trial and computing
+        place fields. Note that one trial is in one direction (trial 0 = left,
+        trial 1 = right, trial 2 = left), so we taking every 4 trials by
+        that definition.
+        """
+        pfs = self.session_pfs(mouse, session_type, nbins=nbins,
+                               normalize_by_occ=normalize_by_occ,
+                               split_trials=True)
+
+        # Only analyze selected neurons, unless unspecified.
+        if neurons is not None:
+            pfs = {
+                trial_type: {direction: pfs[trial_type][direction][neurons]
+                             for direction in directions}
+                for trial_type in ['even', 'odd']
+            }
 
         if show_plot:
             orders = {direction: np.argsort(np.argmax(pfs['even'][direction], axis=1))
@@ -746,55 +799,12 @@ class Drift:
         normalize_by_occ: bool
             Normalize by occupancy.
         """
-        session = self.lt_data[mouse][session_type]
-
-        # Get x position and running timestamps.
-        x = session.behavior.data['df']['x']
-        running = session.spatial.data['running']
-        session_directions = session.behavior.data['df']['direction']
-
-        # Get imaging data.
-        neural_data = session.imaging['S']
-        imp = SimpleImputer(missing_values=np.nan, strategy='constant',
-                            fill_value=0)
-        neural_data = imp.fit_transform(neural_data.T).T
+        pfs = self.session_pfs(mouse, session_type, nbins=nbins,
+                               normalize_by_occ=normalize_by_occ)
 
         # Only analyze selected neurons, unless unspecified.
-        if neurons is None:
-            neurons = [n for n in range(neural_data.shape[0])]
-        neural_data = neural_data[neurons]
-
-        pfs = {direction: [] for direction in directions}
-        for direction in directions:
-            # Only get running epochs and when moving in one of the two directions.
-            mask = np.logical_and(running, session_directions==direction)
-            position = x[mask]
-
-            # Get occupancy map.
-            if normalize_by_occ:
-                occupancy_map = spatial_bin(
-                    position,
-                    position,
-                    nbins=nbins,
-                    one_dim=True,
-                )[0]
-
-            for neuron in neural_data:
-                pf = spatial_bin(
-                    position,
-                    position,
-                    nbins=nbins,
-                    show_plot=False,
-                    weights=neuron[mask],
-                    one_dim=True
-                )[0]
-
-                if normalize_by_occ:
-                    pf = pf / occupancy_map
-
-                pfs[direction].append(pf)
-
-            pfs[direction] = np.vstack(pfs[direction])
+        if neurons is not None:
+            pfs = {direction: pfs[direction][neurons] for direction in directions}
 
         return pfs
 
@@ -0,0 +1,274 @@
+"""
+Hot-path benchmarks on synthetic circle track data.
+
+Generates synthetic cohorts (see CircleTrack.SyntheticData) at several
+scales, then times and memory-profiles preprocessing, session
+construction and the main RecentReversal analyses. Results go to a
+JSON report that can be compared against an earlier one.
+
+Usage:
+    python benchmarks/hot_paths.py --scales small --output report.json
+    python benchmarks/hot_paths.py --scales small medium --compare baseline.json
+"""
+import os
+import sys
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import json
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+from CircleTrack.SyntheticData import make_cohort, load_cohort, default_sessions
+
+# Number of mice, neurons per session and frames per session (15 fps).
+scales = {
+    "small": {"mice": 2, "neurons": 60, "frames": 4500},
+    "medium": {"mice": 4, "neurons": 200, "frames": 18000},
+    "large": {"mice": 8, "neurons": 500, "frames": 27000},
+}
+
+
+def measure(func, memory=True):
+    """
+    Time a function call and record its peak traced memory.
+
+    :return
+    ---
+    result: dict
+        wall_s, cpu_s, peak_mb, error, and the function's output under "output".
+    """
+    if memory:
+        tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+
+    output, error = None, None
+    try:
+        output = func()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+
+    result = {
+        "wall_s": time.perf_counter() - wall,
+        "cpu_s": time.process_time() - cpu,
+        "peak_mb": None,
+        "error": error,
+    }
+    if memory:
+        result["peak_mb"] = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    plt.close("all")
+    result["output"] = output
+
+    return result
+
+
+def run_scale(scale, config, folder, memory=True):
+    """
+    Run every benchmark on one synthetic cohort.
+
+    :return
+    ---
+    records: list of dicts
+        One per benchmark.
+    """
+    from CircleTrack.BehaviorFunctions import Preprocess, BehaviorSession
+    from CircleTrack.MiniscopeFunctions import CalciumSession
+    from CircleTrack.RecentReversal import RecentReversal
+
+    mice = [f"Synthetic{i}" for i in range(config["mice"])]
+    session_types = list(default_sessions)
+    records = []
+
+    def bench(name, func):
+        result = measure(func, memory=memory)
+        output = result.pop("output")
+        records.append(
+            dict(
+                scale=scale,
+                benchmark=name,
+                sessions=len(session_types),
+                **config,
+                **result,
+            )
+        )
+        status = result["error"] or f"{result['wall_s']:.2f} s"
+        print(f"[{scale}] {name}: {status}")
+
+        return output
+
+    cohort = bench(
+        "make_cohort",
+        lambda: make_cohort(
+            folder, mice, n_neurons=config["neurons"], n_frames=config["frames"]
+        ),
+    )
+    if cohort is None:
+        return records
+    mouse = mice[0]
+    session_folder = cohort[mouse][0][session_types[0]]
+
+    def preprocess():
+        P = Preprocess(session_folder)
+        P.preprocess()
+        P.interp_mistracks()
+        P.save()
+
+    bench("Preprocess", preprocess)
+    bench("BehaviorSession", lambda: BehaviorSession(session_folder))
+    session = bench(
+        "CalciumSession",
+        lambda: CalciumSession(
+            session_folder,
+            local=False,
+            overwrite_placefields=True,
+            overwrite_placefield_trials=True,
+            overwrite_assemblies=True,
+        ),
+    )
+    if session is not None:
+        bench("spatial_activity_by_trial", session.spatial_activity_by_trial)
+
+    data = bench("load_cohort", lambda: load_cohort(cohort))
+    if data is None:
+        return records
+
+    R = bench(
+        "RecentReversal",
+        lambda: RecentReversal(mice, save_figs=False, data=data),
+    )
+    if R is None:
+        return records
+
+    pair = ("Goals4", "Reversal")
+    bench("match_ensembles", lambda: R.match_ensembles(mouse, pair))
+    bench(
+        "xcorr_ensemble_cells",
+        lambda: R.xcorr_ensemble_cells(mouse, "Goals4", 0, show_plot=False),
+    )
+    bench("find_activity_trends", lambda: R.find_activity_trends(mouse, "Goals4"))
+    bench("PV_corr_pair", lambda: R.PV_corr_pair(mouse, pair))
+    bench(
+        "session_pairwise_PV_corr_efficient",
+        lambda: R.session_pairwise_PV_corr_efficient(mouse),
+    )
+    bench(
+        "decode_place",
+        lambda: R.decode_place(mouse, ("Goals3", "Goals4"), show_plot=False),
+    )
+    bench(
+        "find_decoding_error",
+        lambda: R.find_decoding_error(mouse, ("Goals3", "Goals4"), show_plot=False),
+    )
+
+    return records
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        ).stdout.strip()
+    except OSError:
+        commit = None
+
+    return {
+        "datetime": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "commit": commit,
+        "argv": sys.argv,
+    }
+
+
+def compare(df, baseline_path, tolerance=1.25):
+    """
+    Print benchmarks that got slower than an earlier report by more
+    than a factor of tolerance. Benchmarks that raised an error count
+    as regressions, since their wall time is not comparable. Those
+    that failed in the baseline have no ratio.
+
+    :return
+    ---
+    n_regressions: int
+    """
+    with open(baseline_path, "r") as file:
+        baseline = pd.DataFrame(json.load(file)["results"])
+
+    merged = df.merge(
+        baseline[["scale", "benchmark", "wall_s", "error"]],
+        on=["scale", "benchmark"],
+        suffixes=("", "_baseline"),
+    )
+    failed = merged["error"].notna()
+    comparable = ~failed & merged["error_baseline"].isna()
+    merged["ratio"] = (merged["wall_s"] / merged["wall_s_baseline"]).where(comparable)
+    slower = merged["ratio"] > tolerance
+
+    print(f"\nCompared to {baseline_path}:")
+    print(
+        merged[["scale", "benchmark", "wall_s_baseline", "wall_s", "ratio", "error"]].to_string(
+            index=False, float_format="%.2f"
+        )
+    )
+    if slower.any():
+        print(f"{slower.sum()} benchmark(s) slower by more than {tolerance}x.")
+    if failed.any():
+        print(f"{failed.sum()} benchmark(s) failed.")
+
+    return int(slower.sum() + failed.sum())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scales", nargs="+", default=["small"], choices=list(scales))
+    parser.add_argument("--output", default="hot_paths.json", help="JSON report path.")
+    parser.add_argument("--folder", help="Where to write synthetic data. Defaults to a temp folder.")
+    parser.add_argument("--no-memory", action="store_true", help="Skip tracemalloc.")
+    parser.add_argument("--compare", help="Earlier JSON report to compare against.")
+    parser.add_argument("--tolerance", type=float, default=1.25)
+    args = parser.parse_args()
+
+    records = []
+    for scale in args.scales:
+        if args.folder is None:
+            with tempfile.TemporaryDirectory() as folder:
+                records.extend(run_scale(scale, scales[scale], folder, not args.no_memory))
+        else:
+            folder = os.path.join(args.folder, scale)
+            records.extend(run_scale(scale, scales[scale], folder, not args.no_memory))
+
+    with open(args.output, "w") as file:
+        json.dump({"environment": environment(), "results": records}, file, indent=2)
+
+    df = pd.DataFrame(records)
+    print()
+    print(
+        df[["scale", "benchmark", "wall_s", "cpu_s", "peak_mb", "error"]].to_string(
+            index=False, float_format="%.2f"
+        )
+    )
+    print(f"Report written to {args.output}")
+
+    if args.compare and compare(df, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
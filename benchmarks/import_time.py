@@ -0,0 +1,156 @@
+"""
+Import-time benchmark for the analysis packages.
+
+Imports a module in fresh, headless interpreters (no DISPLAY, Agg
+matplotlib backend) and fails if the median import time is over
+budget. Also reports which heavy optional dependencies got imported
+and the slowest imports according to python -X importtime.
+
+Usage:
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --module CircleTrack.RecentReversal --budget 10 --repeats 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+repo_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that should only be imported when a function needs them.
+heavy_modules = [
+    "tkinter",
+    "holoviews",
+    "bokeh",
+    "networkx",
+    "ruptures",
+    "statsmodels",
+    "pingouin",
+    "sklearn",
+    "xarray",
+    "seaborn",
+    "pymannkendall",
+]
+
+
+def headless_env():
+    env = dict(os.environ)
+    env.pop("DISPLAY", None)
+    env["MPLBACKEND"] = "Agg"
+    env["PYTHONPATH"] = os.pathsep.join(
+        [repo_folder] + [p for p in [env.get("PYTHONPATH")] if p]
+    )
+
+    return env
+
+
+def time_import(module):
+    """
+    Import a module in a fresh interpreter.
+
+    :return
+    ---
+    wall_time: float
+        Seconds for the whole interpreter run.
+
+    loaded: list of str
+        Heavy modules that were imported.
+
+    importtime: str
+        Output of python -X importtime.
+    """
+    code = (
+        f"import sys, json; import {module}; "
+        f"print(json.dumps([m for m in {heavy_modules!r} if m in sys.modules]))"
+    )
+
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=repo_folder,
+        env=headless_env(),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    wall_time = time.perf_counter() - start
+
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-3000:]}")
+
+    loaded = json.loads(result.stdout.strip().splitlines()[-1])
+
+    return wall_time, loaded, result.stderr
+
+
+def slowest_imports(importtime, n=15):
+    """
+    Parse python -X importtime output into the top-level imports with
+    the largest cumulative time.
+
+    """
+    imports = []
+    for line in importtime.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, name = line[12:].split("|")
+        # Nested imports are indented. Only keep top-level packages.
+        if name.startswith("  ") or "." in name:
+            continue
+        imports.append((int(cumulative) / 1e6, name.strip()))
+
+    return sorted(imports, reverse=True)[:n]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--module", default="CircleTrack.RecentReversal")
+    parser.add_argument("--budget", type=float, default=10.0, help="Seconds.")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--forbid-heavy",
+        action="store_true",
+        help="Also fail if any heavy optional dependency is imported.",
+    )
+    parser.add_argument("--json", help="Write a report to this path.")
+    args = parser.parse_args()
+
+    times = []
+    for _ in range(args.repeats):
+        wall_time, loaded, importtime = time_import(args.module)
+        times.append(wall_time)
+    median = sorted(times)[len(times) // 2]
+
+    print(f"import {args.module}: median {median:.2f} s over {args.repeats} runs "
+          f"(budget {args.budget:.2f} s)")
+    print(f"Heavy modules imported: {', '.join(loaded) if loaded else 'none'}")
+    print("Slowest top-level imports (s):")
+    for seconds, name in slowest_imports(importtime):
+        print(f"    {seconds:7.3f}  {name}")
+
+    passed = median <= args.budget and not (args.forbid_heavy and loaded)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(
+                {
+                    "module": args.module,
+                    "times": times,
+                    "median": median,
+                    "budget": args.budget,
+                    "heavy_modules": loaded,
+                    "passed": passed,
+                },
+                file,
+                indent=2,
+            )
+
+    if not passed:
+        print("FAILED")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
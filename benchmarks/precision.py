@@ -0,0 +1,154 @@
+"""
+Validate the float32 precision mode against float64.
+
+Builds a synthetic cohort (see CircleTrack.SyntheticData), loads it in
+float64 and float32 mode, and compares spatial information, PV
+correlations and spatial decoder error. Fails if any difference is
+larger than its tolerance.
+
+Usage:
+    python benchmarks/precision.py
+    python benchmarks/precision.py --neurons 200 --frames 18000 --json precision.json
+"""
+import os
+import sys
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import json
+import tempfile
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+from CircleTrack.SyntheticData import make_cohort, load_cohort
+
+
+def imaging_mb(data):
+    return (
+        sum(
+            session.imaging[key].nbytes
+            for sessions in data.values()
+            for session_type, session in sessions.items()
+            if session_type != "CellReg"
+            for key in ["C", "S"]
+        )
+        / 1e6
+    )
+
+
+def spatial_info(session):
+    from CaImaging.PlaceFields import PlaceFields
+
+    behavior = session.behavior.data["df"]
+    PF = PlaceFields(
+        np.asarray(behavior["t"]),
+        np.asarray(behavior["x"]),
+        np.asarray(behavior["y"]),
+        session.imaging["S"],
+        bin_size=session.meta["spatial_bin_size"],
+        circular=True,
+        fps=session.behavior.meta["fps"],
+        shuffle_test=False,
+        velocity_threshold=session.meta["threshold"],
+    )
+
+    return np.asarray(PF.data["spatial_info"], dtype=np.float64)
+
+
+def compare(R64, R32, mouse, session_pair):
+    """
+    Largest differences between float64 and float32 results.
+
+    """
+    data64, data32 = [R.data[mouse][session_pair[0]] for R in [R64, R32]]
+    si64, si32 = spatial_info(data64), spatial_info(data32)
+
+    pv64, pv32 = [R.session_pairwise_PV_corr_efficient(mouse, nbins=100) for R in [R64, R32]]
+
+    errors = []
+    for R in [R64, R32]:
+        d = R.find_decoding_error(mouse, session_pair, show_plot=False)[1]
+        errors.append(np.nanmean(d))
+    plt.close("all")
+
+    return {
+        "mouse": mouse,
+        "spatial_info_rel": float(
+            np.nanmax(np.abs(si64 - si32) / np.maximum(np.abs(si64), 1e-12))
+        ),
+        "PV_corr_abs": float(np.nanmax(np.abs(pv64 - pv32))),
+        "decoder_error_abs": float(abs(errors[0] - errors[1])),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--mice", type=int, default=2)
+    parser.add_argument("--neurons", type=int, default=60)
+    parser.add_argument("--frames", type=int, default=4500)
+    parser.add_argument("--si-tol", type=float, default=1e-3, help="Relative.")
+    parser.add_argument("--pv-tol", type=float, default=1e-3, help="Absolute (rho).")
+    parser.add_argument("--decoder-tol", type=float, default=0.1, help="Spatial bins.")
+    parser.add_argument("--json", help="Write a report to this path.")
+    args = parser.parse_args()
+
+    from CircleTrack.RecentReversal import RecentReversal
+
+    mice = [f"Synthetic{i}" for i in range(args.mice)]
+    with tempfile.TemporaryDirectory() as folder:
+        cohort = make_cohort(
+            folder, mice, n_neurons=args.neurons, n_frames=args.frames
+        )
+        R = {
+            precision: RecentReversal(
+                mice,
+                save_figs=False,
+                data=load_cohort(cohort, precision=precision),
+                precision=precision,
+            )
+            for precision in ["float64", "float32"]
+        }
+        results = [
+            compare(R["float64"], R["float32"], mouse, ("Goals3", "Goals4"))
+            for mouse in mice
+        ]
+        memory = {precision: imaging_mb(R[precision].data) for precision in R}
+
+    tolerances = {
+        "spatial_info_rel": args.si_tol,
+        "PV_corr_abs": args.pv_tol,
+        "decoder_error_abs": args.decoder_tol,
+    }
+    worst = {key: max(result[key] for result in results) for key in tolerances}
+    passed = all(worst[key] <= tolerances[key] for key in tolerances)
+
+    print(
+        f"Imaging data: {memory['float64']:.1f} MB (float64), "
+        f"{memory['float32']:.1f} MB (float32)"
+    )
+    for key, tolerance in tolerances.items():
+        status = "ok" if worst[key] <= tolerance else "FAILED"
+        print(f"{key}: max difference {worst[key]:.2e} (tolerance {tolerance:.0e}) {status}")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(
+                {
+                    "results": results,
+                    "tolerances": tolerances,
+                    "memory_mb": memory,
+                    "passed": passed,
+                },
+                file,
+                indent=2,
+            )
+
+    if not passed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,108 @@
 import os
+import re
+import importlib
 import pickle as pkl
-import tkinter as tk
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
-from CaImaging.util import get_data_paths, search_for_folders
-
-tkroot = tk.Tk()
-tkroot.withdraw()
-from tkinter import filedialog
+from CaImaging.util import get_data_paths
 import pandas as pd
 
 
+class lazy_import:
+    def __init__(self, module, attr=None):
+        """
+        Stand-in for a module (or an object inside a module) that is
+        only imported the first time it is used. Lets heavy optional
+        dependencies stay out of import time.
+
+        Usage:
+            nx = lazy_import("networkx")
+            multipletests = lazy_import("statsmodels.stats.multitest", "multipletests")
+
+        :parameters
+        ---
+        module: str
+            Full module name.
+
+        attr: str or None
+            Name of the object inside the module. If None, stands in for
+            the module itself.
+        """
+        self.lazy_module = module
+        self.lazy_attr = attr
+        self.lazy_obj = None
+
+    def load(self):
+        if self.lazy_obj is None:
+            obj = importlib.import_module(self.lazy_module)
+            if self.lazy_attr is not None:
+                obj = getattr(obj, self.lazy_attr)
+            self.lazy_obj = obj
+
+        return self.lazy_obj
+
+    def __getattr__(self, name):
+        if name.startswith("lazy_"):
+            raise AttributeError(name)
+
+        return getattr(self.load(), name)
+
+    def __reduce__(self):
+        # Pickle (e.g., for joblib workers) as the recipe, not the module.
+        return lazy_import, (self.lazy_module, self.lazy_attr)
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+    def __repr__(self):
+        name = self.lazy_module
+        if self.lazy_attr is not None:
+            name += f".{self.lazy_attr}"
+
+        return f"lazy_import({name})"
+
+
+@lru_cache(maxsize=None)
+def tk_root():
+    """
+    Hidden tkinter root, made the first time a dialog is needed so that
+    importing analysis code works on machines without a display.
+
+    """
+    import tkinter as tk
+
+    tkroot = tk.Tk()
+    tkroot.withdraw()
+
+    return tkroot
+
+
+def ask_directory():
+    """
+    Open a dialog box to select a folder.
+
+    """
+    from tkinter import filedialog
+
+    tk_root()
+
+    return filedialog.askdirectory()
+
+
+@lru_cache(maxsize=None)
+def load_holoviews():
+    """
+    Import holoviews and load the bokeh plotting extension, once.
+
+    """
+    import holoviews as hv
+
+    hv.extension("bokeh")
+
+    return hv
+
+
 def make_pattern_dict():
     """
     Makes the dictionary that tells get_data_paths() where each data
@@ -43,7 +136,7 @@ def grab_paths(session_folder=None):
     pattern_dict = make_pattern_dict()
 
     if session_folder is None:
-        session_folder = filedialog.askdirectory()
+        session_folder = ask_directory()
 
     paths = get_data_paths(session_folder, pattern_dict)
 
@@ -78,6 +171,108 @@ def find_timestamp_file(timestamp_paths, camera_type):
     return files[0]
 
 
+def folder_mtime(folder):
+    """
+    Latest modification time of a folder and its immediate subfolders.
+    Files written into a subfolder (e.g., a new session inside a date
+    folder, or timestamps inside a camera folder) do not change the
+    parent folder's own modification time.
+
+    """
+    mtimes = [os.stat(folder).st_mtime]
+    mtimes.extend(f.stat().st_mtime for f in os.scandir(folder) if f.is_dir())
+
+    return max(mtimes)
+
+
+def walk_for_folders(folder, pattern):
+    """
+    Find folders whose names match a regex pattern using os.scandir.
+    Matching folders are not searched further.
+
+    :parameters
+    ---
+    folder: str
+        Folder to search.
+
+    pattern: str
+        Regex pattern for folder names.
+
+    :return
+    ---
+    matches: list of str
+        Paths to matching folders.
+    """
+    pattern = re.compile(pattern)
+    matches = []
+    to_search = [folder]
+    while to_search:
+        try:
+            entries = list(os.scandir(to_search.pop()))
+        except OSError:
+            continue
+
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+
+            if pattern.search(entry.name):
+                matches.append(entry.path)
+            else:
+                to_search.append(entry.path)
+
+    return matches
+
+
+def find_session_folders(
+    project_folder, pattern="^H?[0-9]+_M?[0-9]+_S?[0-9]+$", n_threads=16
+):
+    """
+    Find session folders in a project, searching each top-level folder
+    (usually a mouse) in its own thread since the work is I/O-bound.
+
+    :parameters
+    ---
+    project_folder: str
+        Project folder to search.
+
+    pattern: str
+        Regex pattern for session folder names.
+
+    n_threads: int
+        Number of threads.
+
+    :return
+    ---
+    session_folders: list of str
+        Sorted paths to session folders.
+    """
+    top_folders = [f.path for f in os.scandir(project_folder) if f.is_dir()]
+
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        matches = pool.map(lambda folder: walk_for_folders(folder, pattern), top_folders)
+
+    return sorted(folder for folders in matches for folder in folders)
+
+
+def write_atomic(fpath, write):
+    """
+    Write a file next to its destination and then move it over the
+    destination so readers never see a partial file.
+
+    :parameters
+    ---
+    fpath: str
+        Destination.
+
+    write: callable
+        write(tmp_path) writes the file.
+    """
+    tmp_path = fpath + ".tmp"
+    write(tmp_path)
+    os.replace(tmp_path, fpath)
+
+
 class Session_Metadata:
     def __init__(self, session_folder=None, overwrite=False):
         """
@@ -100,7 +295,7 @@ class Session_Metadata:
         """
         # If minian_folder is not specified, open a dialog box.
         if session_folder is None:
-            self.session_folder = filedialog.askdirectory()
+            self.session_folder = ask_directory()
         else:
             self.session_folder = session_folder
 
@@ -128,12 +323,15 @@ class Session_Metadata:
 
     def save(self):
         """
-        Pickle the dict to disk. .
+        Pickle the dict to disk.
 
 
         """
-        with open(self.full_path, "wb") as file:
-            pkl.dump(self.filepaths, file)
+        def write(fpath):
+            with open(fpath, "wb") as file:
+                pkl.dump(self.filepaths, file)
+
+        write_atomic(self.full_path, write)
 
     def load(self):
         """
@@ -156,6 +354,7 @@ class Metadata_CSV:
         session=-1,
         filename="Metadata.csv",
         overwrite=False,
+        n_threads=16,
     ):
         """
         Makes a CSV file containing the metadata of all the sessions
@@ -163,10 +362,15 @@ class Metadata_CSV:
         locations as well as individual files within those folders.
         For example, ezTrack outputs or timestamps.dat.
 
+        Folders are searched and sessions are indexed across a thread
+        pool. Use update() to only re-index sessions whose folders
+        changed since the CSV was written.
+
         :param folder:
         """
+        self.n_threads = n_threads
         if folder is None:
-            self.project_folder = filedialog.askdirectory()
+            self.project_folder = ask_directory()
         else:
             self.project_folder = folder
         self.filename = filename
@@ -190,12 +394,32 @@ class Metadata_CSV:
                 self.save()
                 self.df = pd.read_csv(fname)
 
-    def build(self):
-        self.session_folders = search_for_folders(
-            self.project_folder, "^H?[0-9]+_M?[0-9]+_S?[0-9]+$"
-        )
-        for folder in self.session_folders:
-            Session_Metadata(folder, overwrite=True)
+    def build(self, session_folders=None, mtimes=None):
+        """
+        Index sessions and make the project DataFrame.
+
+        :parameters
+        ---
+        session_folders: list of str or None
+            Session folders in the project. If None, they are searched for.
+
+        mtimes: dict or None
+            {session folder: modification time} of sessions that were
+            already indexed and have not changed. All other sessions
+            get re-indexed.
+        """
+        if session_folders is None:
+            session_folders = find_session_folders(
+                self.project_folder, n_threads=self.n_threads
+            )
+        self.session_folders = session_folders
+
+        mtimes = dict() if mtimes is None else dict(mtimes)
+        stale = [folder for folder in self.session_folders if folder not in mtimes]
+
+        with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+            indexed = pool.map(self.index_session, stale)
+            mtimes.update(zip(stale, indexed))
 
         mouse_names = self.get_metadata("mouse")
 
@@ -214,12 +438,56 @@ class Metadata_CSV:
             "Metadata": [
                 os.path.join(folder, "metadata.pkl") for folder in self.session_folders
             ],
+            "Mtime": [mtimes[folder] for folder in self.session_folders],
         }
 
         self.df = pd.DataFrame(master_dict)
 
+    def index_session(self, session_folder):
+        """
+        Rebuild metadata.pkl for one session.
+
+        :return
+        ---
+        mtime: float
+            Modification time of the session folder after indexing.
+        """
+        Session_Metadata(session_folder, overwrite=True)
+
+        return folder_mtime(session_folder)
+
+    def update(self):
+        """
+        Re-index new sessions and sessions whose folders changed since
+        the CSV was written, then save.
+
+        """
+        session_folders = find_session_folders(
+            self.project_folder, n_threads=self.n_threads
+        )
+
+        mtimes = dict()
+        if "Mtime" in self.df:
+            last_mtimes = dict(zip(self.df["Path"], self.df["Mtime"]))
+            with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+                current = pool.map(folder_mtime, session_folders)
+
+            mtimes = {
+                folder: mtime
+                for folder, mtime in zip(session_folders, current)
+                if last_mtimes.get(folder) == mtime
+            }
+
+        n_stale = len(session_folders) - len(mtimes)
+        self.build(session_folders, mtimes)
+        self.save()
+        print(f"Re-indexed {n_stale} of {len(session_folders)} sessions")
+
     def save(self):
-        self.df.to_csv(os.path.join(self.project_folder, self.filename), index=False)
+        write_atomic(
+            os.path.join(self.project_folder, self.filename),
+            lambda fpath: self.df.to_csv(fpath, index=False),
+        )
 
     def get_session_type(self):
         session_types = [